@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Compare publishing annotation events to nsqd over HTTP one at a time, as
+NamespacedNsqd does, with publishing them in batches over TCP with
+BatchWriter.
+
+Events are published from one greenlet, yielding between them as a web
+worker serving several requests does, to fake nsqd servers on localhost
+which count the messages they receive and wait ``--latency`` milliseconds
+before answering each request.
+
+Usage: python bench/batch_writer.py [--events N] [--latency MS]
+"""
+from __future__ import division, print_function
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import json
+import struct
+import time
+
+import gevent
+import gevent.pywsgi
+import gevent.server
+
+from h import queue
+
+from benchutil import make_annotation, print_table
+
+OK = struct.pack('>ll', 6, 0) + 'OK'
+
+
+class FakeNsqd(object):
+    """nsqd's TCP and HTTP publishing interfaces, counting messages."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.received = 0
+        self.requests = 0
+        self.tcp = gevent.server.StreamServer(('127.0.0.1', 0), self.handle)
+        self.http = gevent.pywsgi.WSGIServer(('127.0.0.1', 0), self.app,
+                                             log=None)
+        self.tcp.start()
+        self.http.start()
+
+    def stop(self):
+        self.tcp.stop()
+        self.http.stop()
+
+    def _reply(self):
+        self.requests += 1
+        if self.latency:
+            gevent.sleep(self.latency)
+
+    def handle(self, sock, address):
+        stream = sock.makefile('rb')
+        if stream.read(4) != '  V2':
+            return
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            command = line.split()[0]
+            if command == 'NOP':
+                continue
+            size, = struct.unpack('>l', stream.read(4))
+            body = stream.read(size)
+            if command == 'MPUB':
+                self.received += struct.unpack('>l', body[:4])[0]
+            elif command == 'PUB':
+                self.received += 1
+            self._reply()
+            sock.sendall(OK)
+
+    def app(self, environ, start_response):
+        body = environ['wsgi.input'].read()
+        if environ['PATH_INFO'] == '/mput':
+            self.received += len(body.split('\n'))
+        else:
+            self.received += 1
+        self._reply()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['OK']
+
+
+def run(writer, server, events):
+    """
+    Publish the events, and return the time the publishing greenlet spent
+    and the time until the server had all of them.
+    """
+    start = time.time()
+    for data in events:
+        writer.publish('annotations', data)
+        gevent.sleep(0)
+    published = time.time() - start
+    while server.received < len(events):
+        gevent.sleep(0.001)
+    return published, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=2000,
+                        help='number of annotation events to publish')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds nsqd takes to answer a request')
+    args = parser.parse_args()
+
+    events = [json.dumps({'action': 'create',
+                          'annotation': make_annotation(i, text_size=100),
+                          'src_client_id': None})
+              for i in range(args.events)]
+
+    rows = []
+    writers = [
+        ('HTTP per event', lambda s: queue.NamespacedNsqd(
+            None, '127.0.0.1', http_port=s.http.server_port)),
+        ('BatchWriter', lambda s: queue.BatchWriter(
+            None, '127.0.0.1', tcp_port=s.tcp.server_port,
+            http_port=s.http.server_port)),
+    ]
+    for label, make_writer in writers:
+        server = FakeNsqd(args.latency / 1000)
+        try:
+            published, total = run(make_writer(server), server, events)
+        finally:
+            server.stop()
+        rows.append([label, published * 1000, total * 1000,
+                     args.events / total, server.requests])
+
+    print('{} events of about {} bytes:'.format(
+        args.events, sum(len(e) for e in events) // len(events)))
+    print_table(['writer', 'publishing ms', 'until received ms',
+                 'events/s', 'requests'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the benchmark scripts in this directory.
+"""
+from __future__ import division, print_function
+
+import contextlib
+import imp
+import random
+import subprocess
+import sys
+import time
+
+
+def best_of(func, number, repeat=3):
+    """
+    Return the best time per call, in seconds, of ``repeat`` runs of
+    ``number`` calls to ``func``.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            func()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def percentile(values, p):
+    """Return the ``p``th percentile of some values, by nearest rank."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[int(round(p / 100 * (len(ordered) - 1)))]
+
+
+def print_table(headers, rows):
+    """Print rows of values as a table with aligned columns."""
+    rows = [[_format(v) for v in row] for row in rows]
+    widths = [max(len(str(h)), *[len(r[i]) for r in rows])
+              for i, h in enumerate(headers)]
+    for row in [[str(h) for h in headers]] + rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip())
+
+
+def _format(value):
+    if isinstance(value, float):
+        if abs(value) >= 1000:
+            return '{:.0f}'.format(value)
+        return '{:.4g}'.format(value)
+    return str(value)
+
+
+def page_uri(i):
+    """Return the URI of the ``i``th of a set of synthetic pages."""
+    return 'https://example{}.com/articles/{}/'.format(i % 97, i)
+
+
+def make_annotation(i, uri=None, text_size=600):
+    """
+    Return a synthetic annotation, of about 1.4KB as JSON with the default
+    ``text_size``, readable by everyone.
+    """
+    rand = random.Random(i)
+    uri = uri or page_uri(i)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+             'adipiscing', 'elit', u'caf\xe9', 'annotation']
+    text = ''
+    while len(text) < text_size:
+        text += rand.choice(words) + ' '
+    user = 'acct:user{}@example.com'.format(rand.randint(0, 500))
+    return {
+        'id': 'annotation{:06d}'.format(i),
+        'user': user,
+        'consumer': 'bench',
+        'uri': uri,
+        'text': text.strip(),
+        'tags': rand.sample(['climate', 'feedback', 'science', 'news',
+                             'review', 'todo'], 2),
+        'created': '2015-06-{:02d}T12:00:00+00:00'.format(i % 28 + 1),
+        'updated': '2015-06-{:02d}T12:00:00+00:00'.format(i % 28 + 1),
+        'permissions': {
+            'read': ['group:__world__'],
+            'update': [user],
+            'delete': [user],
+            'admin': [user],
+        },
+        'target': [{
+            'source': uri,
+            'selector': [
+                {'type': 'TextQuoteSelector', 'exact': 'dolor sit amet',
+                 'prefix': 'lorem ipsum ', 'suffix': ' consectetur'},
+                {'type': 'TextPositionSelector', 'start': i, 'end': i + 14},
+            ],
+        }],
+        'document': {
+            'title': 'Article {}'.format(i),
+            'link': [{'href': uri}],
+        },
+    }
+
+
+def load_module_at(rev, path, name):
+    """
+    Load the module at ``path`` as it was in git revision ``rev``, as a
+    module called ``name``, for comparison with the current one. Relative
+    imports in it are resolved against the current tree.
+    """
+    source = subprocess.check_output(['git', 'show',
+                                      '{}:{}'.format(rev, path)])
+    module = imp.new_module(name)
+    module.__file__ = path
+    module.__package__ = name.rpartition('.')[0] or None
+    sys.modules[name] = module
+    exec(compile(source, path, 'exec'), module.__dict__)
+    return module
+
+
+@contextlib.contextmanager
+def scratch_index(host, index):
+    """
+    Point the annotation store at a new Elasticsearch index called
+    ``index``, created as ``hypothesis init_db`` creates one, and delete the
+    index afterwards. Any existing index of that name is deleted first.
+    """
+    from h.api import db
+
+    es = db.store_from_settings({'es.host': host, 'es.index': index})
+    db.delete_db()
+    db.create_db()
+    try:
+        yield es
+    finally:
+        db.delete_db()
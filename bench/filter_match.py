@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Time matching annotations against streamer filters with FilterHandler.
+
+With ``--baseline REV``, FilterHandler is also loaded from h/streamer.py as
+it was in git revision REV, for example the revision before filters were
+compiled. Both are then checked to give the same result for every
+combination of a set of filters, annotations and actions, and timed on the
+same matches.
+
+Usage: python bench/filter_match.py [--baseline REV] [--number N]
+"""
+from __future__ import division, print_function
+
+import argparse
+import itertools
+
+from h import streamer
+
+from benchutil import best_of, load_module_at, make_annotation, print_table
+
+FIELD_VALUES = [
+    ('/uri', 'equals', u'HTTPS://Example1.com/articles/1'),
+    ('/uri', 'one_of', ['https://example1.com/articles/1/',
+                        'https://example2.com/articles/2/']),
+    ('/tags', 'matches', u'Climate'),
+    ('/tags', 'one_of', ['news', 'todo']),
+    ('/text', 'matches', u'CAF\xc9'),
+    ('/user', 'equals', 'acct:user1@example.com'),
+    ('/text', 'lenge', 100),
+    ('/text', 'lenl', 100),
+    ('/created', 'gt', '2015-06-10'),
+    ('/created', 'le', '2015-06-10'),
+    (['/text', '/quote'], 'matches', u'lorem'),
+]
+
+BENCHMARKS = [
+    ('single /uri one_of clause',
+     [{'field': '/uri', 'operator': 'one_of',
+       'value': ['https://example1.com/articles/1/',
+                 'https://example2.com/articles/2/']}]),
+    ('multi-field clause',
+     [{'field': ['/text', '/quote'], 'operator': 'matches',
+       'value': u'Lorem'}]),
+]
+
+
+def _filter(clauses, policy='include_any'):
+    return {'match_policy': policy,
+            'actions': {'create': True, 'update': True, 'delete': False},
+            'clauses': clauses}
+
+
+def _clause(field, operator, value):
+    return {'field': field, 'operator': operator, 'value': value,
+            'options': {}}
+
+
+def combinations():
+    """Yield (filter, annotation, action) combinations to compare."""
+    clauses = [_clause(*fv) for fv in FIELD_VALUES]
+    filters = [_filter([c], policy) for c in clauses
+               for policy in ('include_any', 'include_all')]
+    filters.extend(_filter(list(pair), policy)
+                   for pair in itertools.combinations(clauses, 2)
+                   for policy in ('include_any', 'include_all'))
+    filters.append(_filter([]))
+
+    annotations = [make_annotation(i) for i in range(1, 4)]
+    annotations.append(dict(annotations[0], uri=u'https://EXAMPLE1.com/'
+                                                u'articles/1',
+                            quote=u'Lorem ipsum'))
+    annotations.append({'id': 'empty', 'uri': 'https://example.org'})
+    for filter_json, annotation, action in itertools.product(
+            filters, annotations, ['create', 'delete', 'past', None]):
+        yield filter_json, annotation, action
+
+
+def _outcome(handler_cls, filter_json, annotation, action):
+    try:
+        return handler_cls(filter_json).match(annotation, action)
+    except Exception as exc:
+        return type(exc).__name__
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--baseline', metavar='REV',
+                        help='git revision to compare FilterHandler with')
+    parser.add_argument('--number', type=int, default=20000,
+                        help='matches to time per measurement')
+    args = parser.parse_args()
+
+    handlers = [('current', streamer.FilterHandler)]
+    if args.baseline:
+        baseline = load_module_at(args.baseline, 'h/streamer.py',
+                                  'h._baseline_streamer')
+        handlers.insert(0, (args.baseline, baseline.FilterHandler))
+
+        combos = list(combinations())
+        differences = [c for c in combos
+                       if _outcome(baseline.FilterHandler, *c) !=
+                       _outcome(streamer.FilterHandler, *c)]
+        print('Compared {} filter/annotation/action combinations: {} '
+              'differences'.format(len(combos), len(differences)))
+        for filter_json, annotation, action in differences[:10]:
+            print('  {!r} {!r} {!r}'.format(filter_json['clauses'],
+                                            annotation.get('id'), action))
+
+    annotation = make_annotation(1)
+    rows = []
+    for label, clauses in BENCHMARKS:
+        row = [label]
+        for _, handler_cls in handlers:
+            handler = handler_cls(_filter(clauses))
+            row.append(best_of(lambda: handler.match(annotation, 'create'),
+                               args.number) * 1e6)
+        rows.append(row)
+
+    print('Microseconds per match:')
+    print_table(['filter'] + [name for name, _ in handlers], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Measure how much the permessage-deflate extension shrinks the messages the
+streamer sends, and what compressing them costs.
+
+The cases are a batch of past annotations, as sent in answer to a
+``more_hits`` request; a run of single annotation notifications compressed
+with one context kept for the socket, as by default; and the same run with
+``server_no_context_takeover``, where each message is compressed alone.
+
+Usage: python bench/permessage_deflate.py [--batch N] [--messages N]
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import time
+
+from h import streamer
+
+from benchutil import make_annotation, print_table
+
+
+def _packet(annotations, action):
+    return json.dumps(streamer._annotation_packet(annotations, action))
+
+
+def measure(messages, no_context_takeover):
+    deflate = streamer.PerMessageDeflate(
+        no_context_takeover=no_context_takeover)
+    plain = compressed = 0
+    start = time.time()
+    for message in messages:
+        plain += len(message)
+        if len(message) >= deflate.threshold:
+            compressed += len(deflate.compress(message))
+        else:
+            compressed += len(message)
+    elapsed = time.time() - start
+    return [plain, compressed, compressed / plain,
+            elapsed / len(messages) * 1e6]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--batch', type=int, default=200,
+                        help='annotations in a batch of past annotations')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='single annotation notifications to send')
+    args = parser.parse_args()
+
+    batch = [_packet([make_annotation(i) for i in range(args.batch)],
+                     'past')]
+    singles = [_packet([make_annotation(i)], 'create')
+               for i in range(args.messages)]
+
+    rows = [
+        ['{} past annotations'.format(args.batch)] + measure(batch, False),
+        ['single, context takeover'] + measure(singles, False),
+        ['single, no context takeover'] + measure(singles, True),
+    ]
+
+    print('Bytes sent, and compression time per message:')
+    print_table(['case', 'plain', 'compressed', 'ratio', 'us/message'],
+                rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the size and speed of the annotation queue message formats: plain
+JSON, and the versioned format with each registered codec.
+
+The "envelope only" column is the time to decode a message and read its
+action, without decoding the annotation, as the streamer and notification
+worker do for events they skip.
+
+Usage: python bench/queue_codec.py [--number N]
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+
+from h import queue
+
+from benchutil import best_of, make_annotation, print_table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--number', type=int, default=10000,
+                        help='calls to time per measurement')
+    args = parser.parse_args()
+
+    data = {'action': 'create',
+            'annotation': make_annotation(1),
+            'src_client_id': 'abc123'}
+
+    formats = [('plain JSON', None)]
+    formats.extend(('v1 ' + name, name)
+                   for name in sorted(queue._codecs_by_name))
+
+    rows = []
+    for label, codec in formats:
+        body = queue.encode_message(data, codec=codec)
+        assert dict(queue.decode_message(body)) == data
+
+        def encode():
+            queue.encode_message(data, codec=codec)
+
+        def decode():
+            dict(queue.decode_message(body))
+
+        def envelope():
+            queue.decode_message(body)['action']
+
+        rows.append([label, len(body),
+                     best_of(encode, args.number) * 1e6,
+                     best_of(decode, args.number) * 1e6,
+                     best_of(envelope, args.number) * 1e6])
+
+    print('Annotation event of {} bytes as plain JSON, times per message:'
+          .format(len(json.dumps(data))))
+    print_table(['format', 'bytes', 'encode us', 'decode us',
+                 'envelope only us'], rows)
+
+
+if __name__ == '__main__':
+    main()
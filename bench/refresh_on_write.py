@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the throughput of a burst of annotation writes with and without
+``es.refresh_on_write``, which makes each write refresh the index.
+
+This needs an Elasticsearch with the ICU analysis plugin, as the app does.
+For each setting a scratch index, ``--index``, is created on it, and
+deleted afterwards. ``--concurrency`` greenlets save synthetic annotations
+with Annotation.save(), as that many API requests would. The time until
+all of them show up in searches is also reported, since without refreshing
+they only do so at the index's next periodic refresh.
+
+Usage: python bench/refresh_on_write.py [--es URL] [--writes N] ...
+"""
+from __future__ import division, print_function
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import time
+
+import gevent.pool
+
+from h.models import Annotation
+
+from benchutil import make_annotation, print_table, scratch_index
+
+
+def searchable(es):
+    return es.conn.count(index=es.index,
+                         doc_type=Annotation.__type__)['count']
+
+
+def run(es, writes, concurrency):
+    """
+    Save the annotations, and return the time taken to save them and the
+    time until they were all searchable.
+    """
+    pool = gevent.pool.Pool(concurrency)
+    start = time.time()
+    for i in range(writes):
+        pool.spawn(Annotation(make_annotation(i)).save)
+    pool.join(raise_error=True)
+    saved = time.time() - start
+    while searchable(es) < writes:
+        gevent.sleep(0.01)
+    return saved, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--es', default='http://localhost:9200',
+                        help='Elasticsearch URL')
+    parser.add_argument('--index', default='h-bench-refresh',
+                        help='name of the scratch index to create')
+    parser.add_argument('--writes', type=int, default=2000,
+                        help='number of annotations to save')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of annotations saved at once')
+    args = parser.parse_args()
+
+    rows = []
+    for refresh in (True, False):
+        with scratch_index(args.es, args.index) as es:
+            Annotation.refresh_on_write = refresh
+            saved, visible = run(es, args.writes, args.concurrency)
+        rows.append([str(refresh).lower(), saved * 1000,
+                     args.writes / saved, visible * 1000])
+
+    print('{} annotations saved, {} at a time:'.format(args.writes,
+                                                       args.concurrency))
+    print_table(['refresh_on_write', 'saving ms', 'writes/s',
+                 'all searchable ms'], rows)
+
+
+if __name__ == '__main__':
+    main()
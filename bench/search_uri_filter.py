@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Compare searching annotations by uri with match clauses, as by default, and
+with a single terms filter, as with ``h.search.filter_context``.
+
+This needs an Elasticsearch with the ICU analysis plugin, as the app does.
+A scratch index, ``--index``, is created on it, filled with synthetic
+annotations of ``--pages`` pages, and deleted afterwards.
+
+First, normalize_uri() is checked to give the same terms as the index's
+"uri" analyzer for a set of URIs, since the terms filter relies on it. Then
+the same random uri searches are run both ways, checking that they return
+the same annotations, and their latencies are compared. The lookup of
+equivalent document URIs is cached, and is the same both ways.
+
+Exits with status 1 if anything differs.
+
+Usage: python bench/search_uri_filter.py [--es URL] [--index NAME] ...
+"""
+from __future__ import division, print_function
+
+import argparse
+import random
+import sys
+import time
+
+from webob.multidict import MultiDict
+
+from h.api import search
+from h.models import Annotation
+
+from benchutil import (make_annotation, page_uri, percentile, print_table,
+                       scratch_index)
+
+SAMPLE_URIS = [
+    'http://example.com/',
+    'https://example.com',
+    'HTTPS://Example.COM/Articles/1/',
+    'https://example.com/articles/1?page=2#comments',
+    'http://www.example.com:8080/a/b/c.html',
+    'example.com/path/',
+    'urn:x-pdf:6ea2a5e9f9a5ec4b1ec4cf4a3eee8b32',
+    'file:///home/user/document.pdf',
+    u'https://example.com/caf\xe9/',
+    'https://example.com/%7Euser/',
+]
+
+
+def check_analyzer(es):
+    """Return the sample URIs normalize_uri() analyzes differently."""
+    differences = []
+    for uri in SAMPLE_URIS:
+        res = es.conn.indices.analyze(index=es.index, analyzer='uri',
+                                      text=uri)
+        expected = sorted(set(t['token'] for t in res['tokens']))
+        actual = sorted(search.normalize_uri(uri))
+        if expected != actual:
+            differences.append((uri, expected, actual))
+    return differences
+
+
+def index_annotations(es, count, pages, rand):
+    batch = []
+    for i in range(count):
+        batch.append(('index', Annotation(make_annotation(
+            i, uri=page_uri(rand.randrange(pages))))))
+        if len(batch) == 500 or i == count - 1:
+            errors = Annotation.bulk(batch, refresh=False)
+            assert not any(errors), errors
+            batch = []
+    es.conn.indices.refresh(index=es.index)
+
+
+def run_search(uri, limit, filtered):
+    params = MultiDict({'uri': uri, 'limit': str(limit)})
+    start = time.time()
+    result = search.search(params, filtered=filtered)
+    elapsed = time.time() - start
+    return elapsed, result['total'], [r['id'] for r in result['rows']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--es', default='http://localhost:9200',
+                        help='Elasticsearch URL')
+    parser.add_argument('--index', default='h-bench-search',
+                        help='name of the scratch index to create')
+    parser.add_argument('--annotations', type=int, default=20000,
+                        help='number of annotations to index')
+    parser.add_argument('--pages', type=int, default=2000,
+                        help='number of distinct pages annotated')
+    parser.add_argument('--queries', type=int, default=500,
+                        help='number of searches to run each way')
+    parser.add_argument('--limit', type=int, default=20,
+                        help='limit param of each search')
+    args = parser.parse_args()
+
+    rand = random.Random(0)
+    with scratch_index(args.es, args.index) as es:
+        differences = check_analyzer(es)
+        print('Checked normalize_uri() on {} URIs: {} differences'.format(
+            len(SAMPLE_URIS), len(differences)))
+        for uri, expected, actual in differences:
+            print('  {!r}: analyzer {!r}, normalize_uri {!r}'.format(
+                uri, expected, actual))
+
+        index_annotations(es, args.annotations, args.pages, rand)
+
+        # Query each page with a scheme and case the annotations don't
+        # have, so that only the analyzed terms can match.
+        uris = [page_uri(rand.randrange(args.pages)).replace(
+                'https://', 'HTTP://') for _ in range(args.queries)]
+        for uri in uris[:20]:
+            run_search(uri, args.limit, False)
+            run_search(uri, args.limit, True)
+
+        times = {False: [], True: []}
+        mismatches = 0
+        for uri in uris:
+            results = {}
+            # Alternate which way runs first, so neither gains from the
+            # other warming Elasticsearch's caches.
+            for filtered in rand.sample([False, True], 2):
+                elapsed, total, ids = run_search(uri, args.limit, filtered)
+                times[filtered].append(elapsed * 1000)
+                results[filtered] = (total, ids)
+            if results[False] != results[True]:
+                mismatches += 1
+
+    print('{} searches over {} annotations of {} pages: {} with different '
+          'results'.format(args.queries, args.annotations, args.pages,
+                           mismatches))
+    rows = [[label, sum(times[f]) / len(times[f]), percentile(times[f], 50),
+             percentile(times[f], 95)]
+            for label, f in [('match clauses', False),
+                             ('terms filter', True)]]
+    print_table(['uri query', 'mean ms', 'p50 ms', 'p95 ms'], rows)
+
+    if differences or mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
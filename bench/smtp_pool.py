@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Compare sending notification mail with a new SMTP connection for each
+message, as ``Mailer.send_immediately`` does, with sending it over an
+SMTPPool of persistent connections.
+
+The mail goes to a fake SMTP server on localhost which accepts and discards
+every message, and waits ``--delay`` milliseconds before each reply, as a
+remote server's round trip takes.
+
+Usage: python bench/smtp_pool.py [--messages N] [--delay MS]
+"""
+from __future__ import division, print_function
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import time
+
+import gevent
+import gevent.server
+from pyramid_mailer.message import Message
+from repoze.sendmail.mailer import SMTPMailer
+
+from h.notification.smtp import SMTPPool
+
+from benchutil import print_table
+
+
+class FakeMailer(object):
+    """The parts of a pyramid_mailer Mailer which are used here."""
+
+    default_sender = 'notification@example.com'
+
+    def __init__(self, port):
+        self.smtp_mailer = SMTPMailer('127.0.0.1', port)
+
+    def send_immediately(self, message):
+        message.sender = message.sender or self.default_sender
+        self.smtp_mailer.send(message.sender, message.send_to,
+                              message.to_message())
+
+
+class SMTPSink(object):
+    """An SMTP server which discards messages, counting connections."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.connections = 0
+        self.messages = 0
+        self.server = gevent.server.StreamServer(('127.0.0.1', 0),
+                                                 self.handle)
+        self.server.start()
+
+    def handle(self, sock, address):
+        self.connections += 1
+        stream = sock.makefile('rb')
+
+        def reply(line):
+            gevent.sleep(self.delay)
+            sock.sendall(line + '\r\n')
+
+        reply('220 localhost ESMTP sink')
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ('EHLO', 'HELO'):
+                reply('250 localhost')
+            elif command == 'DATA':
+                reply('354 End data with <CR><LF>.<CR><LF>')
+                while stream.readline() not in ('.\r\n', ''):
+                    pass
+                self.messages += 1
+                reply('250 OK')
+            elif command == 'QUIT':
+                reply('221 Bye')
+                return
+            else:
+                reply('250 OK')
+
+
+def _message(i):
+    return Message(subject='Reply to your annotation {}'.format(i),
+                   recipients=['user{}@example.com'.format(i)],
+                   body='Someone replied to your annotation.\n' * 20,
+                   html='<p>Someone replied to your annotation.</p>' * 20)
+
+
+def send_immediately(mailer, count):
+    for i in range(count):
+        mailer.send_immediately(_message(i))
+
+
+def send_pooled(mailer, count, size):
+    pool = SMTPPool(mailer, size)
+    results = [pool.send(_message(i)) for i in range(count)]
+    gevent.joinall(results)
+    assert all(r.successful() for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=200,
+                        help='number of messages to send')
+    parser.add_argument('--delay', type=float, default=5,
+                        help='milliseconds the server takes to reply')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 8],
+                        help='pool sizes to try')
+    args = parser.parse_args()
+
+    cases = [('connection per message',
+              lambda m: send_immediately(m, args.messages))]
+    cases.extend(('pool of {}'.format(size),
+                  lambda m, size=size: send_pooled(m, args.messages, size))
+                 for size in args.sizes)
+
+    rows = []
+    for label, send in cases:
+        sink = SMTPSink(args.delay / 1000)
+        mailer = FakeMailer(sink.server.server_port)
+        start = time.time()
+        try:
+            send(mailer)
+        finally:
+            elapsed = time.time() - start
+            sink.server.stop()
+        assert sink.messages == args.messages
+        rows.append([label, elapsed * 1000, args.messages / elapsed,
+                     sink.connections])
+
+    print('{} messages, {}ms per server reply:'.format(args.messages,
+                                                      args.delay))
+    print_table(['sending', 'total ms', 'messages/s', 'connections'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Compare broadcasting annotation events to every connected streamer socket
+with broadcasting them only to the candidates from a SubscriptionIndex.
+
+Each socket has a filter for one of ``--pages`` pages, as a client on that
+page sends. Both ways run the same broadcast_from_queue, including the
+permission check and filter match for each socket considered, and send
+events to the same sockets.
+
+Usage: python bench/subscription_index.py [--sockets N ...] [--pages N]
+"""
+from __future__ import division, print_function
+
+import argparse
+import random
+import time
+
+from pyramid.security import Everyone
+
+from h import streamer
+
+from benchutil import make_annotation, page_uri, print_table
+
+
+class FakeSocket(object):
+    terminated = False
+    coalesce_window = 0
+    effective_principals = frozenset([Everyone])
+
+    def __init__(self, i, uri):
+        self.client_id = 'socket{}'.format(i)
+        self.filter = streamer.FilterHandler({
+            'match_policy': 'include_any',
+            'actions': {'create': True, 'update': True, 'delete': True},
+            'clauses': [{'field': '/uri', 'operator': 'one_of',
+                         'value': [uri], 'options': {}}],
+        })
+        self.received = 0
+
+    def enqueue(self, data, key=None):
+        self.received += 1
+
+
+def broadcast(events, sockets):
+    start = time.time()
+    streamer.broadcast_from_queue(events, sockets)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sockets', type=int, nargs='+',
+                        default=[1000, 10000],
+                        help='numbers of connected sockets to try')
+    parser.add_argument('--pages', type=int, default=2000,
+                        help='number of distinct pages the sockets are on')
+    parser.add_argument('--events', type=int, default=200,
+                        help='number of annotation events to broadcast')
+    args = parser.parse_args()
+
+    rand = random.Random(0)
+    events = []
+    for i in range(args.events):
+        annotation = make_annotation(i, uri=page_uri(rand.randrange(
+            args.pages)))
+        events.append(streamer.QueueEvent({'action': 'create',
+                                           'annotation': annotation,
+                                           'src_client_id': None}))
+
+    rows = []
+    for count in args.sockets:
+        sockets = [FakeSocket(i, page_uri(i % args.pages))
+                   for i in range(count)]
+        index = streamer.SubscriptionIndex()
+        for socket in sockets:
+            index.add(socket)
+
+        scan_time = broadcast(events, sockets)
+        scan_received = [s.received for s in sockets]
+        for socket in sockets:
+            socket.received = 0
+        index_time = broadcast(events, index)
+        assert [s.received for s in sockets] == scan_received
+
+        rows.append([count, len(events) / scan_time,
+                     len(events) / index_time, sum(scan_received)])
+
+    print('Events broadcast per second, over {} pages:'.format(args.pages))
+    print_table(['sockets', 'full scan', 'index', 'sent'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,15 @@ def store_from_settings(settings):
     if 'es.compatibility' in settings:
         es.compatibility_mode = settings['es.compatibility']
 
+    # By default every annotation write refreshes the index so that it shows
+    # up in searches straight away. Under bursts of writes this limits
+    # indexing throughput, so it can be turned off, in which case writes
+    # become searchable at the index's next periodic refresh (every second
+    # by default). The API returns the saved annotation either way, so the
+    # client that made the change always sees it.
+    Annotation.refresh_on_write = asbool(
+        settings.get('es.refresh_on_write', True))
+
     # We want search results to be filtered according to their
     # read-permissions, which is done in the store itself.
     es.authorization_enabled = True
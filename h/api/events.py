@@ -6,3 +6,15 @@ class AnnotationEvent(object):
         self.request = request
         self.annotation = annotation
         self.action = action
+
+
+class AnnotationBatchEvent(object):
+    """An event representing actions on several annotations at once.
+
+    ``events`` is the list of :class:`AnnotationEvent` for the individual
+    actions, in the order they were performed.
+    """
+
+    def __init__(self, request, events):
+        self.request = request
+        self.events = events
@@ -1,24 +1,56 @@
 # -*- coding: utf-8 -*-
-"""Publish annotations events into the distributed message queue."""
-import json
+"""
+Publish annotations events into the distributed message queue.
 
+Events are published only once the request's transaction has been
+committed, by the process's queue outbox, so that the request doesn't wait
+on the queue and failed requests publish nothing.
+"""
+import transaction
+
+from h import queue
+from h.api.events import AnnotationBatchEvent
 from h.api.events import AnnotationEvent
 
 
+def _message(event):
+    codec = event.request.registry.settings.get('nsq.codec')
+    return queue.encode_message({
+        'action': event.action,
+        'annotation': event.annotation,
+        'src_client_id': event.request.headers.get('X-Client-Id'),
+    }, codec=codec)
+
+
+def _publish_after_commit(request, topic, messages):
+    writer = request.get_queue_writer()
+    outbox = request.get_queue_outbox()
+
+    def hook(success):
+        if success:
+            outbox.put(writer, topic, messages)
+
+    transaction.get().addAfterCommitHook(hook)
+
+
 def annotation(event):
     """Publish an annotation event in NSQ."""
-    request = event.request
-    annotation = event.annotation
-    action = event.action
-    queue = request.get_queue_writer()
-    data = {
-        'action': action,
-        'annotation': annotation,
-        'src_client_id': request.headers.get('X-Client-Id'),
-    }
-    queue.publish('annotations', json.dumps(data))
+    _publish_after_commit(event.request, 'annotations', [_message(event)])
+
+
+def annotation_batch(event):
+    """Publish a batch of annotation events in NSQ in one round trip."""
+    if not event.events:
+        return
+    _publish_after_commit(event.request,
+                          'annotations',
+                          [_message(e) for e in event.events])
 
 
 def includeme(config):
+    # Messages are published by an after-commit hook, so requests must be
+    # run in a transaction for any to be published.
+    config.include('pyramid_tm')
     config.include('h.queue')
     config.add_subscriber(annotation, AnnotationEvent)
+    config.add_subscriber(annotation_batch, AnnotationBatchEvent)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid.security import Allow, Authenticated, ALL_PERMISSIONS
 
 from .models import Annotation
@@ -50,3 +51,14 @@ def create_root(_):
     r = Root()
     r.add('annotations', Annotations())
     return r
+
+
+def annotation_factory(request):
+    """
+    Returns the annotation with the id in the matched route, located in a new
+    traversal tree so that the root's permissions apply to it.
+    """
+    try:
+        return create_root(request)['annotations'][request.matchdict['id']]
+    except KeyError:
+        raise HTTPNotFound()
@@ -4,14 +4,122 @@ All search (Annotation.search(), Annotation.search_raw()) and Elasticsearch
 stuff should be encapsulated in this module.
 
 """
+import base64
+import collections
+import json
 import logging
+import re
+import time
 
 import webob.multidict
 
 from h.api import models
+from h.api.events import AnnotationBatchEvent
+from h.api.events import AnnotationEvent
 
 log = logging.getLogger(__name__)
 
+# Sort fields for which results can be paged through with a cursor.
+CURSOR_SORT_FIELDS = ('created', 'updated')
+
+# Fields that annotation counts can be broken down by, and the unanalyzed
+# Elasticsearch fields that are aggregated for them, so that the values
+# counted are whole values rather than index tokens.
+AGGREGATION_FIELDS = {
+    'tags': 'tags.raw',
+    'user': 'user.raw',
+    'uri': 'uri.raw',
+}
+
+# The maximum number of replies returned for a thread.
+MAX_THREAD_SIZE = 1000
+
+
+class URICache(object):
+
+    """A process-local LRU cache mapping URIs to equivalent-URI sets.
+
+    Entries expire ``ttl`` seconds after they were stored, so that changes
+    to document equivalence made by other processes are picked up
+    eventually. The ``hits`` and ``misses`` counters record how often a
+    lookup was answered without a round trip to Elasticsearch.
+
+    """
+
+    def __init__(self, maxsize=1000, ttl=300, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, uri):
+        """Return the cached URIs for ``uri``, or raise KeyError.
+
+        A cached value of ``None`` means that no document is known for the
+        URI.
+
+        """
+        try:
+            expires, uris = self._entries.pop(uri)
+        except KeyError:
+            self.misses += 1
+            raise
+        if expires <= self.clock():
+            self.misses += 1
+            raise KeyError(uri)
+
+        # Reinsert the entry to mark it as most recently used.
+        self._entries[uri] = (expires, uris)
+        self.hits += 1
+        return uris
+
+    def set(self, uri, uris):
+        """Store the equivalent URIs (or None) for ``uri``."""
+        if self.maxsize <= 0:
+            return
+        if uris is not None:
+            uris = tuple(uris)
+        self._entries.pop(uri, None)
+        while len(self._entries) >= self.maxsize:
+            self._entries.popitem(last=False)
+        self._entries[uri] = (self.clock() + self.ttl, uris)
+
+    def invalidate(self, uris):
+        """Drop every entry for, or equivalent to, any of the given URIs."""
+        uris = set(uris)
+        for key, (_, value) in list(self._entries.items()):
+            if key in uris or (value is not None and uris.intersection(value)):
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries)}
+
+
+uri_cache = URICache()
+
+
+def _equivalent_uris(uri):
+    """Return the URIs of the document known for ``uri``, or None."""
+    try:
+        return uri_cache.get(uri)
+    except KeyError:
+        pass
+
+    doc = models.Document.get_by_uri(uri)
+    uris = tuple(doc.uris()) if doc else None
+    uri_cache.set(uri, uris)
+    return uris
+
 
 def _match_clause_for_uri(uri):
     """Return an Elasticsearch match clause dict for the given URI."""
@@ -21,9 +129,9 @@ def _match_clause_for_uri(uri):
     # Attempt to expand the query to include URIs for other representations of
     # the same document, using information we may have on hand about the
     # document.
-    doc = models.Document.get_by_uri(uri)
-    if doc:
-        uri_matchers = [{"match": {"uri": u}} for u in doc.uris()]
+    uris = _equivalent_uris(uri)
+    if uris is not None:
+        uri_matchers = [{"match": {"uri": u}} for u in uris]
         return {
             "bool": {
                 "minimum_should_match": 1,
@@ -34,7 +142,157 @@ def _match_clause_for_uri(uri):
         return {"match": {"uri": uri}}
 
 
-def build_query(request_params):
+def _uri_analyzer_patterns():
+    """Return the regexes used by the "uri" analyzer of the annotation index.
+
+    These are read from the index analysis settings so that URIs normalized
+    here always agree with the terms Elasticsearch stores.
+
+    """
+    analysis = models.Annotation.__analysis__
+    return (re.compile(analysis['char_filter']['strip_scheme']['pattern']),
+            re.compile(analysis['filter']['path_url']['patterns'][0]),
+            re.compile(analysis['filter']['rstrip_slash']['pattern']))
+
+_STRIP_SCHEME, _PATH_URL, _RSTRIP_SLASH = _uri_analyzer_patterns()
+
+
+def normalize_uri(uri):
+    """Return the terms the "uri" analyzer produces for the given URI.
+
+    This mirrors the analysis chain configured for the ``uri`` field (strip
+    the scheme, capture host and path, strip a trailing slash, lowercase) so
+    that URIs can be used in unanalyzed ``term`` and ``terms`` filters.
+
+    """
+    token = _STRIP_SCHEME.sub('', uri, count=1)
+
+    # Like Elasticsearch's pattern_capture filter, emit every non-empty
+    # captured group, falling back to the original token if there are none.
+    captures = [m.group(1) for m in _PATH_URL.finditer(token) if m.group(1)]
+    tokens = captures or [token]
+
+    terms = []
+    for t in tokens:
+        t = _RSTRIP_SLASH.sub('', t).lower()
+        if t not in terms:
+            terms.append(t)
+    return terms
+
+
+def _terms_filter_for_uri(uri):
+    """Return an Elasticsearch terms filter dict for the given URI.
+
+    The filter matches annotations of the URI or of any equivalent URI. It
+    is equivalent to the clause returned by :func:`_match_clause_for_uri`,
+    but is a single unscored filter that Elasticsearch can cache.
+
+    """
+    if not uri:
+        return None
+
+    uris = _equivalent_uris(uri)
+    if uris is None:
+        uris = [uri]
+
+    terms = []
+    for u in uris:
+        for term in normalize_uri(u):
+            if term not in terms:
+                terms.append(term)
+    return {"terms": {"uri": terms}}
+
+
+class InvalidCursorError(ValueError):
+    """Raised for a "cursor" param that can't be used to page results."""
+
+
+def encode_cursor(sort_values):
+    """Return an opaque cursor string for a search hit's sort values."""
+    return base64.urlsafe_b64encode(json.dumps(sort_values)).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the sort values encoded in a cursor string.
+
+    :raises InvalidCursorError: if the cursor is not one returned by
+        :func:`encode_cursor`
+
+    """
+    try:
+        padded = str(cursor) + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+    except (TypeError, UnicodeError, ValueError):
+        raise InvalidCursorError('invalid cursor')
+    if not isinstance(values, list) or len(values) != 2:
+        raise InvalidCursorError('invalid cursor')
+    value, uid = values
+    if (not isinstance(value, (int, long, float, basestring)) or
+            isinstance(value, bool) or not isinstance(uid, basestring)):
+        raise InvalidCursorError('invalid cursor')
+    return values
+
+
+def cursor_filter(sort, order, sort_values):
+    """Return a filter dict for the hits that sort after the given values.
+
+    Results are sorted by ``sort`` and then by ``_uid`` as a tie-breaker, so
+    the hits after a cursor are those with a later ``sort`` value, or with
+    the same ``sort`` value and a later ``_uid``. Unlike "from", the cost of
+    this filter does not grow with the depth of the page.
+
+    """
+    value, uid = sort_values
+    op = "gt" if order == "asc" else "lt"
+    return {
+        "or": [
+            {"range": {sort: {op: value}}},
+            {"and": [
+                {"term": {sort: value}},
+                {"range": {"_uid": {op: uid}}},
+            ]},
+        ]
+    }
+
+
+def _source_filter(fields_params):
+    """Return an Elasticsearch "_source" filter dict for "fields" params.
+
+    Each param is a comma-separated list of (possibly dotted) field names.
+    Fields prefixed with "-" are excluded rather than included.
+
+    """
+    include = []
+    exclude = []
+    for param in fields_params:
+        for field in param.split(","):
+            field = field.strip()
+            if field.startswith("-"):
+                field = field[1:].strip()
+                if field:
+                    exclude.append(field)
+            elif field:
+                include.append(field)
+
+    source = {}
+    if include:
+        source["include"] = include
+    if exclude:
+        source["exclude"] = exclude
+    return source
+
+
+def _match_filter(key, value):
+    """Return a cached filter dict equivalent to a match query on ``key``.
+
+    The match query is wrapped rather than replaced with a "term" filter so
+    that the value is still analyzed exactly as it would be in the query.
+
+    """
+    return {"fquery": {"query": {"match": {key: value}}, "_cache": True}}
+
+
+def build_query(request_params, filtered=False):
     """Return an Elasticsearch query dict for the given h search API params.
 
     Translates the HTTP request params accepted by the h search API into an
@@ -44,10 +302,20 @@ def build_query(request_params):
         h search API
     :type request_params: webob.multidict.NestedMultiDict
 
+    :param filtered: whether to run clauses that don't need scoring in
+        filter context. Results are always sorted by a field, so scoring is
+        only kept for the full-text "any" param; every other param becomes a
+        cached filter that matches exactly the same annotations. The "uri"
+        param becomes a single "terms" filter.
+    :type filtered: bool
+
     :returns: an Elasticsearch query dict corresponding to the given h search
         API params
     :rtype: dict
 
+    :raises InvalidCursorError: if the "cursor" param is invalid, or is
+        given with a "sort" param that cursors can't be used with
+
     """
     # NestedMultiDict objects are read-only, so we need to copy to make it
     # modifiable.
@@ -67,23 +335,51 @@ def build_query(request_params):
     except (ValueError, KeyError):
         size = 20
 
+    sort = request_params.pop("sort", "updated")
+    order = request_params.pop("order", "desc")
+
     query = {
         "from": from_,
         "size": size,
         "sort": [
             {
-                request_params.pop("sort", "updated"): {
+                sort: {
                     "ignore_unmapped": True,
-                    "order": request_params.pop("order", "desc")
+                    "order": order
                 }
-            }
+            },
+            # Break ties so that the order of results, and so cursors,
+            # are stable.
+            {"_uid": {"order": order}}
         ]
     }
 
+    if "fields" in request_params:
+        source = _source_filter(request_params.getall("fields"))
+        del request_params["fields"]
+        if source:
+            query["_source"] = source
+
     matches = []
-    uri_match_clause = _match_clause_for_uri(request_params.pop("uri", None))
-    if uri_match_clause:
-        matches.append(uri_match_clause)
+    filters = []
+
+    cursor = request_params.pop("cursor", None)
+    if cursor:
+        if sort not in CURSOR_SORT_FIELDS:
+            raise InvalidCursorError(
+                'cursors can only be used when sorting by {}'.format(
+                    ' or '.join(CURSOR_SORT_FIELDS)))
+        filters.append(cursor_filter(sort, order, decode_cursor(cursor)))
+        query["from"] = 0
+    uri = request_params.pop("uri", None)
+    if filtered:
+        uri_filter = _terms_filter_for_uri(uri)
+        if uri_filter:
+            filters.append(uri_filter)
+    else:
+        uri_match_clause = _match_clause_for_uri(uri)
+        if uri_match_clause:
+            matches.append(uri_match_clause)
 
     if "any" in request_params:
         matches.append({
@@ -96,15 +392,27 @@ def build_query(request_params):
         del request_params["any"]
 
     for key, value in request_params.items():
-        matches.append({"match": {key: value}})
+        if filtered:
+            filters.append(_match_filter(key, value))
+        else:
+            matches.append({"match": {key: value}})
     matches = matches or [{"match_all": {}}]
 
     query["query"] = {"bool": {"must": matches}}
 
+    if filters:
+        query["query"] = {
+            "filtered": {
+                "query": query["query"],
+                "filter": (filters[0] if len(filters) == 1
+                           else {"bool": {"must": filters}})
+            }
+        }
+
     return query
 
 
-def search(request_params, user=None):
+def search(request_params, user=None, filtered=False):
     """Search with the given params and return the matching annotations.
 
     :param request_params: the HTTP request params that were posted to the
@@ -114,8 +422,13 @@ def search(request_params, user=None):
     :param user: the authorized user, or None
     :type user: h.accounts.models.User or None
 
+    :param filtered: passed on to :func:`build_query`
+    :type filtered: bool
+
     :returns: a dict with keys "rows" (the list of matching annotations, as
-        dicts) and "total" (the number of matching annotations, an int)
+        dicts), "total" (the number of matching annotations, an int) and
+        "cursor" (a string to pass as the "cursor" param to get the next
+        page of results, or None)
     :rtype: dict
 
     """
@@ -123,14 +436,128 @@ def search(request_params, user=None):
               user.id if user else 'None',
               request_params.get('uri'))
 
-    query = build_query(request_params)
+    query = build_query(request_params, filtered=filtered)
     results = models.Annotation.search_raw(query, user=user, raw_result=True)
 
     total = results['hits']['total']
     docs = results['hits']['hits']
     rows = [models.Annotation(d['_source'], id=d['_id']) for d in docs]
 
-    return {"rows": rows, "total": total}
+    cursor = None
+    sort = query["sort"][0].keys()[0]
+    if docs and 'sort' in docs[-1] and sort in CURSOR_SORT_FIELDS:
+        cursor = encode_cursor(docs[-1]['sort'])
+
+    return {"rows": rows, "total": total, "cursor": cursor}
+
+
+def count(request_params, user=None, filtered=False):
+    """Count the annotations matching the given params.
+
+    Takes the same params as :func:`search`, plus any number of "aggs"
+    params naming fields from :data:`AGGREGATION_FIELDS` to break the count
+    down by. No annotations are fetched from Elasticsearch.
+
+    :param request_params: the HTTP request params that were posted to the
+        h count API
+    :type request_params: webob.multidict.NestedMultiDict
+
+    :param user: the authorized user, or None
+    :type user: h.accounts.models.User or None
+
+    :param filtered: passed on to :func:`build_query`
+    :type filtered: bool
+
+    :returns: a dict with keys "total" (the number of matching annotations,
+        an int) and "aggregations" (a dict mapping each requested field to a
+        list of {"value": ..., "count": ...} dicts, most common first)
+    :rtype: dict
+
+    """
+    request_params = request_params.copy()
+    request_params.pop("cursor", None)
+
+    fields = []
+    if "aggs" in request_params:
+        for field in request_params.getall("aggs"):
+            if field in AGGREGATION_FIELDS and field not in fields:
+                fields.append(field)
+        del request_params["aggs"]
+
+    query = build_query(request_params, filtered=filtered)
+    for key in ("from", "size", "sort", "_source"):
+        query.pop(key, None)
+    if fields:
+        query["aggs"] = {f: {"terms": {"field": AGGREGATION_FIELDS[f]}}
+                         for f in fields}
+
+    results = models.Annotation.search_raw(query,
+                                           params={"search_type": "count"},
+                                           user=user,
+                                           raw_result=True)
+
+    aggregations = {}
+    for field in fields:
+        buckets = results["aggregations"][field]["buckets"]
+        aggregations[field] = [{"value": b["key"], "count": b["doc_count"]}
+                               for b in buckets]
+
+    return {"total": results["hits"]["total"], "aggregations": aggregations}
+
+
+def thread(root, user=None):
+    """Return an annotation and all of its replies, as a tree.
+
+    All replies are fetched with a single query for the annotations that
+    have the root's id in their "references". Replies are filtered for the
+    given user in the same way as search results. A reply whose parent is
+    not visible is attached to its nearest visible ancestor instead.
+
+    :param root: the annotation at the root of the thread
+    :type root: h.models.Annotation
+
+    :param user: the authorized user, or None
+    :type user: h.accounts.models.User or None
+
+    :returns: a dict with keys "annotation" (the annotation), "replies"
+        (a list of dicts of the same form for its direct replies, oldest
+        first) and "total" (the number of replies in the whole thread, which
+        is more than the number returned if there are more than
+        :data:`MAX_THREAD_SIZE`)
+    :rtype: dict
+
+    """
+    # "references" is analyzed, so the id must be analyzed in the same way
+    # to match it.
+    references = {"match_phrase": {"references": root["id"]}}
+    query = {
+        "query": {
+            "filtered": {
+                "filter": {"fquery": {"query": references}}
+            }
+        },
+        "sort": [{"created": {"ignore_unmapped": True, "order": "asc"}}],
+        "size": MAX_THREAD_SIZE,
+    }
+    results = models.Annotation.search_raw(query, user=user, raw_result=True)
+    replies = [models.Annotation(d['_source'], id=d['_id'])
+               for d in results['hits']['hits']]
+
+    nodes = {root["id"]: {"annotation": root, "replies": []}}
+    for reply in replies:
+        nodes[reply["id"]] = {"annotation": reply, "replies": []}
+
+    for reply in replies:
+        parent = nodes[root["id"]]
+        for ref in reversed(reply.get("references", [])):
+            if ref in nodes and ref != reply["id"]:
+                parent = nodes[ref]
+                break
+        parent["replies"].append(nodes[reply["id"]])
+
+    result = nodes[root["id"]]
+    result["total"] = results['hits']['total']
+    return result
 
 
 def index(user=None):
@@ -141,3 +568,40 @@ def index(user=None):
 
     """
     return search(webob.multidict.NestedMultiDict({"limit": 20}), user=user)
+
+
+def invalidate_uri_cache(event):
+    """Drop cached URI equivalences touched by an annotation's document.
+
+    Saving an annotation may create a document or merge existing documents
+    together, which changes which URIs are considered equivalent.
+
+    """
+    if event.action == 'read':
+        return
+
+    annotation = event.annotation
+    document = annotation.get('document')
+    if not isinstance(document, dict):
+        document = {}
+    # Links are stored as clients send them, so they may not all be dicts
+    uris = [link.get('href')
+            for link in document.get('link') or []
+            if isinstance(link, dict)]
+    uris.append(annotation.get('uri'))
+    uri_cache.invalidate(u for u in uris if u)
+
+
+def invalidate_uri_cache_for_batch(event):
+    for e in event.events:
+        invalidate_uri_cache(e)
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if 'h.search.uri_cache_size' in settings:
+        uri_cache.maxsize = int(settings['h.search.uri_cache_size'])
+    if 'h.search.uri_cache_ttl' in settings:
+        uri_cache.ttl = int(settings['h.search.uri_cache_ttl'])
+    config.add_subscriber(invalidate_uri_cache, AnnotationEvent)
+    config.add_subscriber(invalidate_uri_cache_for_batch, AnnotationBatchEvent)
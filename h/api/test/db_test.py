@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+
+from h.api import db
+
+
+@patch.object(db, 'Annotation')
+def test_store_from_settings_refreshes_on_write_by_default(annotation):
+    db.store_from_settings({})
+
+    assert annotation.refresh_on_write is True
+
+
+@patch.object(db, 'Annotation')
+def test_store_from_settings_refresh_on_write(annotation):
+    db.store_from_settings({'es.refresh_on_write': 'false'})
+
+    assert annotation.refresh_on_write is False
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import json
+
+from mock import MagicMock
+from pyramid.interfaces import ITweens
+from pyramid.testing import DummyRequest
+import transaction
+
+from h.api import queue
+from h.queue import JSONCodec
+from h.queue import decode_message
+from h.api.events import AnnotationBatchEvent
+from h.api.events import AnnotationEvent
+
+
+def _request():
+    request = DummyRequest()
+    request.get_queue_writer = MagicMock()
+    request.get_queue_outbox = MagicMock()
+    return request
+
+
+def test_annotation_publishes_after_commit():
+    request = _request()
+    outbox = request.get_queue_outbox.return_value
+    transaction.begin()
+    queue.annotation(AnnotationEvent(request, {'id': 1}, 'create'))
+    assert not outbox.put.called
+    transaction.commit()
+    writer, topic, messages = outbox.put.call_args[0]
+    assert writer == request.get_queue_writer.return_value
+    assert topic == 'annotations'
+    assert [dict(decode_message(m)) for m in messages] == [{'action': 'create',
+                                                  'annotation': {'id': 1},
+                                                  'src_client_id': None}]
+
+
+def test_annotation_not_published_on_abort():
+    request = _request()
+    outbox = request.get_queue_outbox.return_value
+    transaction.begin()
+    queue.annotation(AnnotationEvent(request, {'id': 1}, 'create'))
+    transaction.abort()
+    assert not outbox.put.called
+
+
+def test_annotation_batch_publishes_once_after_commit():
+    request = _request()
+    outbox = request.get_queue_outbox.return_value
+    events = [AnnotationEvent(request, {'id': 1}, 'create'),
+              AnnotationEvent(request, {'id': 2}, 'delete')]
+    transaction.begin()
+    queue.annotation_batch(AnnotationBatchEvent(request, events))
+    transaction.commit()
+    assert outbox.put.call_count == 1
+    messages = outbox.put.call_args[0][2]
+    assert [decode_message(m)['action'] for m in messages] == ['create',
+                                                            'delete']
+
+
+def test_annotation_batch_empty():
+    request = _request()
+    transaction.begin()
+    queue.annotation_batch(AnnotationBatchEvent(request, []))
+    transaction.commit()
+    assert not request.get_queue_outbox.return_value.put.called
+
+
+def test_annotation_writes_plain_json_by_default():
+    request = _request()
+    outbox = request.get_queue_outbox.return_value
+    transaction.begin()
+    queue.annotation(AnnotationEvent(request, {'id': 1}, 'create'))
+    transaction.commit()
+    [message] = outbox.put.call_args[0][2]
+    assert json.loads(message) == {'action': 'create',
+                                   'annotation': {'id': 1},
+                                   'src_client_id': None}
+
+
+def test_annotation_uses_codec_setting():
+    request = _request()
+    request.registry.settings['nsq.codec'] = 'json'
+    outbox = request.get_queue_outbox.return_value
+    transaction.begin()
+    queue.annotation(AnnotationEvent(request, {'id': 1}, 'create'))
+    transaction.commit()
+    [message] = outbox.put.call_args[0][2]
+    assert message[1:2] == chr(JSONCodec.id)
+
+
+def test_includeme_runs_requests_in_transactions(config):
+    config.include('h.api.queue')
+    config.commit()
+    tweens = config.registry.queryUtility(ITweens)
+    assert 'pyramid_tm.tm_tween_factory' in [n for n, _ in tweens.implicit()]
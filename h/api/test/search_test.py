@@ -1,9 +1,20 @@
+import base64
 import mock
+import pytest
 from webob import multidict
 
+from h.api import models
 from h.api import search
 
 
+@pytest.fixture(autouse=True)
+def uri_cache(request):
+    """Start every test with an empty URI equivalence cache."""
+    search.uri_cache.clear()
+    request.addfinalizer(search.uri_cache.clear)
+    return search.uri_cache
+
+
 def test_build_query_offset_defaults_to_0():
     """If no offset is given then "from": 0 is used in the query by default."""
     query = search.build_query(
@@ -85,10 +96,18 @@ def test_build_query_sort_is_by_updated():
         request_params=multidict.NestedMultiDict())
 
     sort = query["sort"]
-    assert len(sort) == 1
+    assert len(sort) == 2
     assert sort[0].keys() == ["updated"]
 
 
+def test_build_query_sort_is_tie_broken_by_uid():
+    """Results with equal sort values are ordered by _uid."""
+    query = search.build_query(
+        request_params=multidict.NestedMultiDict({"order": "asc"}))
+
+    assert query["sort"][1] == {"_uid": {"order": "asc"}}
+
+
 def test_build_query_sort_includes_ignore_unmapped():
     """'ignore_unmapped': True is used in the sort clause."""
     query = search.build_query(
@@ -104,7 +123,8 @@ def test_build_query_with_custom_sort():
         request_params=multidict.NestedMultiDict({"sort": "title"}))
 
     sort = query["sort"]
-    assert sort == [{'title': {'ignore_unmapped': True, 'order': 'desc'}}]
+    assert sort == [{'title': {'ignore_unmapped': True, 'order': 'desc'}},
+                    {'_uid': {'order': 'desc'}}]
 
 
 def test_build_query_order_defaults_to_desc():
@@ -291,6 +311,247 @@ def test_build_query_for_uri_with_multiple_representations(models):
     }
 
 
+@mock.patch("h.api.search.models")
+def test_build_query_for_uri_caches_document_lookups(models):
+    """Repeated searches for a URI only look up its document once."""
+    doc = mock.MagicMock()
+    doc.uris.return_value = ["http://example.com/", "http://example2.com/"]
+    models.Document.get_by_uri.return_value = doc
+    params = multidict.NestedMultiDict({"uri": "http://example.com/"})
+
+    query1 = search.build_query(request_params=params)
+    query2 = search.build_query(request_params=params)
+
+    assert query1 == query2
+    models.Document.get_by_uri.assert_called_once_with("http://example.com/")
+    assert search.uri_cache.hits == 1
+
+
+@mock.patch("h.api.search.models")
+def test_build_query_for_uri_caches_missing_documents(models):
+    """URIs with no known document are cached too."""
+    models.Document.get_by_uri.return_value = None
+    params = multidict.NestedMultiDict({"uri": "http://example.com/"})
+
+    search.build_query(request_params=params)
+    query = search.build_query(request_params=params)
+
+    assert query["query"] == {
+        "bool": {"must": [{"match": {"uri": "http://example.com/"}}]}}
+    assert models.Document.get_by_uri.call_count == 1
+
+
+def test_uri_cache_get_missing_raises_keyerror():
+    cache = search.URICache()
+
+    with pytest.raises(KeyError):
+        cache.get("http://example.com/")
+    assert cache.misses == 1
+
+
+def test_uri_cache_get_returns_stored_uris():
+    cache = search.URICache()
+    cache.set("http://example.com/", ["http://example.com/", "urn:x-pdf:1"])
+
+    assert cache.get("http://example.com/") == (
+        "http://example.com/", "urn:x-pdf:1")
+    assert cache.hits == 1
+
+
+def test_uri_cache_entries_expire():
+    clock = mock.Mock(return_value=1000)
+    cache = search.URICache(ttl=10, clock=clock)
+    cache.set("http://example.com/", None)
+
+    clock.return_value = 1010
+
+    with pytest.raises(KeyError):
+        cache.get("http://example.com/")
+
+
+def test_uri_cache_evicts_least_recently_used():
+    cache = search.URICache(maxsize=2)
+    cache.set("http://a.com/", None)
+    cache.set("http://b.com/", None)
+    cache.get("http://a.com/")
+
+    cache.set("http://c.com/", None)
+
+    assert cache.get("http://a.com/") is None
+    with pytest.raises(KeyError):
+        cache.get("http://b.com/")
+
+
+def test_uri_cache_invalidate_drops_equivalent_entries():
+    cache = search.URICache()
+    cache.set("http://a.com/", ["http://a.com/", "http://b.com/"])
+    cache.set("http://c.com/", None)
+    cache.set("http://d.com/", None)
+
+    cache.invalidate(["http://b.com/", "http://c.com/"])
+
+    assert len(cache) == 1
+    assert cache.get("http://d.com/") is None
+
+
+def test_invalidate_uri_cache_uses_document_links(uri_cache):
+    uri_cache.set("http://a.com/", ["http://a.com/", "http://b.com/"])
+    uri_cache.set("http://c.com/", None)
+    annotation = {
+        "uri": "http://c.com/",
+        "document": {"link": [{"href": "http://b.com/"}]},
+    }
+
+    search.invalidate_uri_cache(mock.Mock(annotation=annotation,
+                                          action="create"))
+
+    assert len(uri_cache) == 0
+
+
+def test_invalidate_uri_cache_skips_malformed_links(uri_cache):
+    uri_cache.set("http://a.com/", None)
+    uri_cache.set("http://b.com/", None)
+    annotation = {
+        "uri": "http://a.com/",
+        "document": {"link": ["http://x.com/", None, {"href": "http://b.com/"}]},
+    }
+
+    search.invalidate_uri_cache(mock.Mock(annotation=annotation,
+                                          action="create"))
+
+    assert len(uri_cache) == 0
+
+
+def test_invalidate_uri_cache_ignores_reads(uri_cache):
+    uri_cache.set("http://a.com/", None)
+
+    search.invalidate_uri_cache(mock.Mock(annotation={"uri": "http://a.com/"},
+                                          action="read"))
+
+    assert len(uri_cache) == 1
+
+
+@pytest.mark.parametrize("uri,terms", [
+    ("http://example.com/", ["example.com"]),
+    ("https://Example.com/Foo/?bar=baz#qux", ["example.com/foo"]),
+    ("example.com", ["example.com"]),
+    ("http://localhost:5000/a/b", ["localhost:5000/a/b"]),
+    ("urn:x-pdf:6c7a2d6f9a0c2e", ["x-pdf:6c7a2d6f9a0c2e"]),
+    ("doi:10.1000/182", ["10.1000/182"]),
+])
+def test_normalize_uri(uri, terms):
+    """normalize_uri() mirrors the "uri" analyzer of the index."""
+    assert search.normalize_uri(uri) == terms
+
+
+@mock.patch("h.api.search.models")
+def test_build_query_filtered_for_uri(models):
+    """In filtered mode the 'uri' param becomes a "terms" filter."""
+    models.Document.get_by_uri.return_value = None
+
+    query = search.build_query(
+        request_params=multidict.NestedMultiDict(
+            {"uri": "http://example.com/"}),
+        filtered=True)
+
+    assert query["query"] == {
+        "filtered": {
+            "query": {"bool": {"must": [{"match_all": {}}]}},
+            "filter": {"terms": {"uri": ["example.com"]}}
+        }
+    }
+
+
+@mock.patch("h.api.search.models")
+def test_build_query_filtered_for_uri_with_multiple_representations(models):
+    """All of the document's URIs go into the one "terms" filter."""
+    doc = mock.MagicMock()
+    doc.uris.return_value = [
+        "http://example.com/", "https://example.com", "urn:x-pdf:abc"]
+    models.Document.get_by_uri.return_value = doc
+
+    query = search.build_query(
+        request_params=multidict.NestedMultiDict(
+            {"uri": "http://example.com/", "user": "bob"}),
+        filtered=True)
+
+    assert query["query"]["filtered"]["filter"]["bool"]["must"][0] == {
+        "terms": {"uri": ["example.com", "x-pdf:abc"]}}
+
+
+def _flatten_filtered(query):
+    """Return the scored clauses and the unwrapped filters of a query."""
+    filtered = query["query"].get("filtered")
+    if filtered is None:
+        return query["query"]["bool"]["must"], []
+
+    matches = filtered["query"]["bool"]["must"]
+    filters = filtered["filter"]
+    filters = filters["bool"]["must"] if "bool" in filters else [filters]
+    return matches, [f["fquery"]["query"] if "fquery" in f else f
+                     for f in filters]
+
+
+@pytest.mark.parametrize("params", [
+    [],
+    [("user", "bob")],
+    [("tags", "foo"), ("tags", "bar")],
+    [("user", "bob"), ("text", "hello"), ("foo.bar", "arbitrary")],
+    [("any", "howdy"), ("user", "bob")],
+    [("any", "howdy"), ("any", "there")],
+    [("offset", "10"), ("limit", "5"), ("sort", "created"), ("order", "asc"),
+     ("quote", "foo")],
+])
+def test_build_query_filtered_is_equivalent(params):
+    """Filtered queries match exactly what unfiltered queries match.
+
+    Every clause other than the full-text "any" clause moves unchanged into
+    a filter; nothing else about the query differs.
+
+    """
+    request_params = multidict.MultiDict(params)
+
+    plain = search.build_query(request_params)
+    filtered = search.build_query(request_params, filtered=True)
+
+    plain_matches, _ = _flatten_filtered(plain)
+    matches, filters = _flatten_filtered(filtered)
+
+    assert all("multi_match" in m or "match_all" in m for m in matches)
+    assert ([m for m in matches if "match_all" not in m] +
+            filters) == [m for m in plain_matches if "match_all" not in m]
+    for key in ("from", "size", "sort"):
+        assert filtered[key] == plain[key]
+
+
+def test_build_query_filtered_caches_filters():
+    """Filters for ordinary params are marked as cacheable."""
+    query = search.build_query(
+        request_params=multidict.NestedMultiDict({"user": "bob"}),
+        filtered=True)
+
+    assert query["query"]["filtered"]["filter"] == {
+        "fquery": {"query": {"match": {"user": "bob"}}, "_cache": True}}
+
+
+@mock.patch("h.api.search.models")
+def test_build_query_filtered_uri_is_equivalent(models):
+    """The "uri" terms filter holds the terms each match clause analyzes to."""
+    doc = mock.MagicMock()
+    doc.uris.return_value = ["http://example.com/", "urn:x-pdf:abc"]
+    models.Document.get_by_uri.return_value = doc
+    params = multidict.NestedMultiDict({"uri": "http://example.com/"})
+
+    plain = search.build_query(params)
+    filtered = search.build_query(params, filtered=True)
+
+    should = plain["query"]["bool"]["must"][0]["bool"]["should"]
+    terms = filtered["query"]["filtered"]["filter"]["terms"]["uri"]
+    assert terms == [t
+                     for clause in should
+                     for t in search.normalize_uri(clause["match"]["uri"])]
+
+
 def test_build_query_with_single_text_param():
     """'text' params are returned in the query dict in "match" clauses."""
     query = search.build_query(
@@ -394,6 +655,281 @@ def test_search_with_user_object(search_raw):
     assert first_call[1]["user"] == user
 
 
+def test_build_query_fetches_whole_source_by_default():
+    query = search.build_query(
+        request_params=multidict.NestedMultiDict())
+
+    assert "_source" not in query
+
+
+def test_build_query_with_fields():
+    """'fields' params become "_source" include and exclude lists."""
+    params = multidict.MultiDict()
+    params.add("fields", "text, tags,-document")
+    params.add("fields", "-target.selector")
+    params.add("fields", "user")
+
+    query = search.build_query(request_params=params)
+
+    assert query["_source"] == {
+        "include": ["text", "tags", "user"],
+        "exclude": ["document", "target.selector"],
+    }
+    assert query["query"] == {"bool": {"must": [{"match_all": {}}]}}
+
+
+def test_build_query_with_empty_fields():
+    query = search.build_query(
+        request_params=multidict.NestedMultiDict({"fields": " ,-"}))
+
+    assert "_source" not in query
+
+
+def test_cursor_round_trip():
+    cursor = search.encode_cursor([1435000000000, "annotation#abc"])
+
+    assert search.decode_cursor(cursor) == [1435000000000, "annotation#abc"]
+
+
+def test_decode_cursor_with_invalid_cursor():
+    for invalid_cursor in ("foo", "!!!", search.encode_cursor([1, 2, 3]),
+                           search.encode_cursor({"a": 1}),
+                           search.encode_cursor([{}, {}]),
+                           search.encode_cursor([1, 2]),
+                           search.encode_cursor([True, "annotation#abc"]),
+                           search.encode_cursor([[1], "annotation#abc"]),
+                           u"\xe9abc",
+                           base64.urlsafe_b64encode("\xff\xfe")):
+        with pytest.raises(search.InvalidCursorError):
+            search.decode_cursor(invalid_cursor)
+
+
+def test_build_query_with_cursor():
+    """A cursor becomes a filter for the hits after it, and "from" is 0."""
+    cursor = search.encode_cursor([1435000000000, "annotation#abc"])
+    query = search.build_query(
+        request_params=multidict.NestedMultiDict(
+            {"cursor": cursor, "offset": 40}))
+
+    assert query["from"] == 0
+    assert query["query"]["filtered"]["filter"] == {
+        "or": [
+            {"range": {"updated": {"lt": 1435000000000}}},
+            {"and": [
+                {"term": {"updated": 1435000000000}},
+                {"range": {"_uid": {"lt": "annotation#abc"}}},
+            ]},
+        ]
+    }
+
+
+def test_build_query_with_cursor_ascending():
+    cursor = search.encode_cursor([1435000000000, "annotation#abc"])
+    query = search.build_query(
+        request_params=multidict.NestedMultiDict(
+            {"cursor": cursor, "sort": "created", "order": "asc"}))
+
+    cursor_filter = query["query"]["filtered"]["filter"]
+    assert cursor_filter["or"][0] == {
+        "range": {"created": {"gt": 1435000000000}}}
+
+
+def test_build_query_with_invalid_cursor():
+    """Invalid cursors are rejected, rather than the first page returned."""
+    with pytest.raises(search.InvalidCursorError):
+        search.build_query(
+            request_params=multidict.NestedMultiDict(
+                {"cursor": "foo", "offset": 40}))
+
+
+def test_build_query_rejects_cursor_for_other_sorts():
+    cursor = search.encode_cursor(["foo", "annotation#abc"])
+    with pytest.raises(search.InvalidCursorError):
+        search.build_query(
+            request_params=multidict.NestedMultiDict(
+                {"cursor": cursor, "sort": "title"}))
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_search_returns_cursor_for_last_hit(search_raw):
+    search_raw.return_value = {"hits": {"total": 5, "hits": [
+        {"_id": "a", "_source": {}, "sort": [2, "annotation#a"]},
+        {"_id": "b", "_source": {}, "sort": [1, "annotation#b"]},
+    ]}}
+
+    result = search.search(multidict.NestedMultiDict({"limit": 2}))
+
+    assert search.decode_cursor(result["cursor"]) == [1, "annotation#b"]
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_search_returns_no_cursor_without_hits(search_raw):
+    search_raw.return_value = {"hits": {"total": 0, "hits": []}}
+
+    result = search.search(multidict.NestedMultiDict())
+
+    assert result["cursor"] is None
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_count_does_not_fetch_annotations(search_raw):
+    """count() uses a count search type with no paging or sorting."""
+    search_raw.return_value = {"hits": {"total": 42, "hits": []}}
+
+    result = search.count(multidict.NestedMultiDict(
+        {"user": "bob", "limit": 10, "fields": "text"}))
+
+    query = search_raw.call_args[0][0]
+    assert search_raw.call_args[1]["params"] == {"search_type": "count"}
+    assert query == {"query": {"bool": {"must": [{"match": {"user": "bob"}}]}}}
+    assert result == {"total": 42, "aggregations": {}}
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_count_ignores_cursor(search_raw):
+    search_raw.return_value = {"hits": {"total": 0, "hits": []}}
+
+    search.count(multidict.NestedMultiDict({"cursor": "foo"}))
+
+    query = search_raw.call_args[0][0]
+    assert query == {"query": {"bool": {"must": [{"match_all": {}}]}}}
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_count_passes_user_to_search_raw(search_raw):
+    search_raw.return_value = {"hits": {"total": 0, "hits": []}}
+    user = mock.MagicMock()
+
+    search.count(multidict.NestedMultiDict(), user=user)
+
+    assert search_raw.call_args[1]["user"] == user
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_count_with_aggregations(search_raw):
+    """'aggs' params add terms aggregations for the supported fields."""
+    search_raw.return_value = {
+        "hits": {"total": 3, "hits": []},
+        "aggregations": {
+            "tags": {"buckets": [{"key": "foo", "doc_count": 2},
+                                 {"key": "bar", "doc_count": 1}]},
+            "user": {"buckets": [{"key": "bob", "doc_count": 3}]},
+        }
+    }
+    params = multidict.MultiDict()
+    params.add("aggs", "tags")
+    params.add("aggs", "user")
+    params.add("aggs", "permissions")
+    params.add("aggs", "tags")
+
+    result = search.count(params)
+
+    query = search_raw.call_args[0][0]
+    assert query["aggs"] == {"tags": {"terms": {"field": "tags.raw"}},
+                             "user": {"terms": {"field": "user.raw"}}}
+    assert query["query"] == {"bool": {"must": [{"match_all": {}}]}}
+    assert result == {
+        "total": 3,
+        "aggregations": {
+            "tags": [{"value": "foo", "count": 2},
+                     {"value": "bar", "count": 1}],
+            "user": [{"value": "bob", "count": 3}],
+        }
+    }
+
+
+@pytest.mark.parametrize("field,aggregated", [
+    ("tags", "tags.raw"),
+    ("user", "user.raw"),
+    ("uri", "uri.raw"),
+])
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_count_aggregates_unanalyzed_fields(search_raw, field, aggregated):
+    """Whole values are counted, rather than the tokens they analyze to."""
+    search_raw.return_value = {
+        "hits": {"total": 0, "hits": []},
+        "aggregations": {field: {"buckets": []}},
+    }
+
+    search.count(multidict.NestedMultiDict({"aggs": field}))
+
+    query = search_raw.call_args[0][0]
+    assert query["aggs"] == {field: {"terms": {"field": aggregated}}}
+    mapping = models.Annotation.__mapping__[field]
+    assert mapping["fields"]["raw"]["index"] == "not_analyzed"
+
+
+def _hit(id_, references):
+    return {"_id": id_, "_source": {"references": references}}
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_thread_queries_by_references(search_raw):
+    """thread() fetches all replies with one "references" query."""
+    search_raw.return_value = {"hits": {"total": 0, "hits": []}}
+    user = mock.MagicMock()
+
+    result = search.thread({"id": "root"}, user=user)
+
+    query = search_raw.call_args[0][0]
+    assert query["query"] == {
+        "filtered": {"filter": {"fquery": {"query": {
+            "match_phrase": {"references": "root"}}}}}}
+    assert query["sort"][0]["created"]["order"] == "asc"
+    assert search_raw.call_args[1]["user"] == user
+    assert result == {"annotation": {"id": "root"}, "replies": [], "total": 0}
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_thread_returns_total_replies(search_raw):
+    """The total shows when a thread has more replies than were returned."""
+    search_raw.return_value = {"hits": {"total": 5000, "hits": [
+        _hit("a", ["root"]),
+    ]}}
+
+    result = search.thread({"id": "root"})
+
+    assert result["total"] == 5000
+    assert len(result["replies"]) == 1
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_thread_builds_tree(search_raw):
+    search_raw.return_value = {"hits": {"total": 4, "hits": [
+        _hit("a", ["root"]),
+        _hit("b", ["root"]),
+        _hit("c", ["root", "a"]),
+        _hit("d", ["root", "a", "c"]),
+    ]}}
+
+    result = search.thread({"id": "root"})
+
+    def ids(node):
+        return [node["annotation"]["id"], [ids(r) for r in node["replies"]]]
+
+    assert ids(result) == [
+        "root", [
+            ["a", [["c", [["d", []]]]]],
+            ["b", []],
+        ]]
+
+
+@mock.patch("annotator.annotation.Annotation.search_raw")
+def test_thread_attaches_orphans_to_nearest_visible_ancestor(search_raw):
+    """Replies to missing or unreadable annotations aren't dropped."""
+    search_raw.return_value = {"hits": {"total": 2, "hits": [
+        _hit("a", ["root"]),
+        _hit("c", ["root", "a", "hidden"]),
+        _hit("d", ["root", "gone"]),
+    ]}}
+
+    result = search.thread({"id": "root"})
+
+    replies = result["replies"]
+    assert [r["annotation"]["id"] for r in replies] == ["a", "d"]
+    assert replies[0]["replies"][0]["annotation"]["id"] == "c"
+
+
 @mock.patch("h.api.search.search")
 def test_index_limit_is_20(search_func):
     """index() calls search with "limit": 20."""
@@ -6,9 +6,16 @@
 from mock import patch, MagicMock, Mock
 import pytest
 from pytest import fixture, raises
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid.testing import DummyRequest, DummyResource
+from webob import Request
+from webob.multidict import MultiDict
 
 from .. import views
+from ..models import Annotation
+from ..resources import annotation_factory
+from ..resources import create_root
 
 
 class DictMock(Mock):
@@ -85,6 +92,8 @@ def test_index():
     assert links['annotation']['update']['url'] == host + '/annotations/:id'
     assert links['search']['method'] == 'GET'
     assert links['search']['url'] == host + '/search'
+    assert links['count']['method'] == 'GET'
+    assert links['count']['url'] == host + '/count'
 
 
 @patch('h.api.views._create_annotation')
@@ -109,6 +118,161 @@ def test_create_annotation(user):
     annotation.save.assert_called_once()
 
 
+def _fake_bulk(operations):
+    """Stand in for Annotation.bulk(), giving new annotations ids."""
+    for i, (_, annotation) in enumerate(operations):
+        if 'id' not in annotation:
+            annotation['id'] = 'new{}'.format(i)
+    return [None] * len(operations)
+
+
+@pytest.fixture()
+def bulk_request(config):
+    """A request for the bulk view, allowed everything by default."""
+    request = DummyRequest(root=create_root(None))
+    request.has_permission = MagicMock(return_value=True)
+    request.registry.notify = MagicMock()
+    return request
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_bulk(user, bulk_request):
+    existing = {'u1': views.Annotation(_old_annotation),
+                'd1': views.Annotation(dict(_old_annotation, id='d1'))}
+    views.Annotation.fetch_all = MagicMock(
+        side_effect=lambda ids: [existing.get(i) for i in ids])
+    views.Annotation.bulk = MagicMock(side_effect=_fake_bulk)
+    bulk_request.json_body = [
+        {'action': 'create', 'annotation': {'text': 'new', 'id': 'evil'}},
+        {'action': 'update', 'id': 'u1', 'annotation': {'text': 'changed'}},
+        {'action': 'delete', 'id': 'd1'},
+    ]
+
+    result = views.bulk(bulk_request)
+
+    views.Annotation.fetch_all.assert_called_once_with(['u1', 'd1'])
+    operations = views.Annotation.bulk.call_args[0][0]
+    assert [action for action, _ in operations] == [
+        'index', 'index', 'delete']
+    created = operations[0][1]
+    assert created['text'] == 'new'
+    assert created['user'] == 'alice'
+    assert created['id'] == 'new0'
+    assert existing['u1']['text'] == 'changed'
+    assert [r['status'] for r in result['results']] == ['success'] * 3
+    assert [r['action'] for r in result['results']] == [
+        'create', 'update', 'delete']
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_bulk_publishes_one_batch_event(user, bulk_request):
+    views.Annotation.fetch_all = MagicMock(return_value=[])
+    views.Annotation.bulk = MagicMock(side_effect=_fake_bulk)
+    bulk_request.json_body = [
+        {'action': 'create', 'annotation': {'text': 'one'}},
+        {'action': 'create', 'annotation': {'text': 'two'}},
+    ]
+
+    views.bulk(bulk_request)
+
+    assert bulk_request.registry.notify.call_count == 1
+    event = bulk_request.registry.notify.call_args[0][0]
+    assert [e.action for e in event.events] == ['create', 'create']
+    assert [e.annotation['text'] for e in event.events] == ['one', 'two']
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_bulk_reports_errors_per_operation(user, bulk_request):
+    annotation = views.Annotation(_old_annotation)
+    views.Annotation.fetch_all = MagicMock(
+        side_effect=lambda ids: [annotation if i == 'u1' else None
+                                 for i in ids])
+    views.Annotation.bulk = MagicMock(return_value=['MapperParsing'])
+    bulk_request.has_permission = MagicMock(
+        side_effect=lambda permission, context: permission == 'update')
+    bulk_request.json_body = [
+        {'action': 'update', 'id': 'missing', 'annotation': {}},
+        {'action': 'delete', 'id': 'u1'},
+        {'action': 'frobnicate'},
+        'not an operation',
+        {'action': 'create'},
+        {'action': 'update', 'id': 'u1',
+         'annotation': {'permissions': {'read': ['bob']}}},
+        {'action': 'update', 'id': 'u1', 'annotation': {'text': 'ok'}},
+    ]
+
+    result = views.bulk(bulk_request)
+
+    assert [r['status_code'] for r in result['results']] == [
+        404, 403, 400, 400, 400, 401, 500]
+    assert len(views.Annotation.bulk.call_args[0][0]) == 1
+    event = bulk_request.registry.notify.call_args[0][0]
+    assert event.events == []
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_bulk_rejects_ids_which_arent_strings(user, bulk_request):
+    views.Annotation.fetch_all = MagicMock(return_value=[])
+    views.Annotation.bulk = MagicMock(side_effect=_fake_bulk)
+    bulk_request.json_body = [
+        {'action': 'update', 'id': ['x'], 'annotation': {}},
+        {'action': 'delete', 'id': {'x': 1}},
+        {'action': 'delete'},
+    ]
+
+    result = views.bulk(bulk_request)
+
+    views.Annotation.fetch_all.assert_called_once_with([])
+    assert [r['status_code'] for r in result['results']] == [400, 400, 400]
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_bulk_doesnt_swallow_other_errors(user, bulk_request):
+    views.Annotation.fetch_all = MagicMock(return_value=[])
+    bulk_request.json_body = [{'action': 'create', 'annotation': {}}]
+
+    with patch('h.api.views._new_annotation') as new_annotation:
+        new_annotation.side_effect = RuntimeError('filter creation failed')
+        with raises(RuntimeError):
+            views.bulk(bulk_request)
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_bulk_inherits_root_acl(config, user, bulk_request):
+    """Admins may delete any annotation, as they may through traversal."""
+    config.testing_securitypolicy('admin', groupids=['group:admin'])
+    config.set_authorization_policy(ACLAuthorizationPolicy())
+    del bulk_request.has_permission
+    private = Annotation({'id': 'a', 'user': 'acct:bob@example.com',
+                          'permissions': {'delete': ['acct:bob@example.com']}})
+    views.Annotation.fetch_all = MagicMock(return_value=[private])
+    views.Annotation.bulk = MagicMock(side_effect=_fake_bulk)
+    bulk_request.json_body = [{'action': 'delete', 'id': 'a'}]
+
+    result = views.bulk(bulk_request)
+
+    assert result['results'][0]['status'] == 'success'
+    assert private.__parent__ is bulk_request.root['annotations']
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_bulk_without_a_list(user, bulk_request):
+    bulk_request.json_body = {'action': 'create'}
+
+    views.bulk(bulk_request)
+
+    assert views._api_error.call_args[1]['status_code'] == 400
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_bulk_too_many_operations(user, bulk_request):
+    bulk_request.json_body = [{}] * (views.MAX_BATCH_SIZE + 1)
+
+    views.bulk(bulk_request)
+
+    assert views._api_error.call_args[1]['status_code'] == 400
+
+
 @pytest.mark.usefixtures('replace_io')
 def test_read():
     annotation = DummyResource()
@@ -119,6 +283,122 @@ def test_read():
     assert result == annotation, "Annotation should have been returned"
 
 
+@pytest.mark.usefixtures('replace_io')
+def test_annotations_batch():
+    """It returns the found annotations that the user may read."""
+    readable = DummyResource(id='a')
+    unreadable = DummyResource(id='c')
+    views.Annotation.fetch_all = MagicMock(
+        return_value=[readable, None, unreadable])
+    request = DummyRequest(root=create_root(None))
+    request.params = MultiDict({'ids': 'a, b,c'})
+    request.has_permission = MagicMock(
+        side_effect=lambda permission, context: context is readable)
+
+    result = views.annotations_batch(request)
+
+    views.Annotation.fetch_all.assert_called_once_with(['a', 'b', 'c'])
+    request.has_permission.assert_any_call('read', readable)
+    request.has_permission.assert_any_call('read', unreadable)
+    assert result == {'rows': [readable], 'total': 1}
+    assert readable.__name__ == 'a'
+    assert readable.__parent__ is request.root['annotations']
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_annotations_batch_inherits_root_acl(config):
+    """Admins may read any annotation, as they may through traversal."""
+    config.testing_securitypolicy('admin', groupids=['group:admin'])
+    config.set_authorization_policy(ACLAuthorizationPolicy())
+    private = Annotation({'id': 'a', 'user': 'acct:bob@example.com',
+                          'permissions': {'read': ['acct:bob@example.com']}})
+    views.Annotation.fetch_all = MagicMock(return_value=[private])
+    request = DummyRequest(root=create_root(None))
+    request.params = MultiDict({'ids': 'a'})
+
+    result = views.annotations_batch(request)
+
+    assert result == {'rows': [private], 'total': 1}
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_annotations_batch_with_repeated_ids_params():
+    views.Annotation.fetch_all = MagicMock(return_value=[])
+    request = DummyRequest(root=create_root(None))
+    request.params = MultiDict([('ids', 'a,b'), ('ids', 'b,c'), ('ids', '')])
+
+    views.annotations_batch(request)
+
+    views.Annotation.fetch_all.assert_called_once_with(['a', 'b', 'c'])
+
+
+@pytest.mark.usefixtures('replace_io')
+def test_annotations_batch_too_many_ids():
+    views.Annotation.fetch_all = MagicMock()
+    ids = ','.join(str(i) for i in range(views.MAX_BATCH_SIZE + 1))
+    request = DummyRequest()
+    request.params = MultiDict({'ids': ids})
+
+    views.annotations_batch(request)
+
+    assert views._api_error.call_args[1]['status_code'] == 400
+    assert not views.Annotation.fetch_all.called
+
+
+@patch('h.api.search.search')
+@pytest.mark.usefixtures('replace_io', 'user')
+def test_search_invalid_cursor(search):
+    search.side_effect = views.h.api.search.InvalidCursorError('bad cursor')
+    request = DummyRequest()
+
+    result = views.search(request)
+
+    assert result == views._api_error.return_value
+    views._api_error.assert_called_once_with(request, 'bad cursor',
+                                             status_code=400)
+
+
+@patch('h.api.search.thread')
+@patch('h.api.resources.Annotation')
+def test_thread_route(annotation_cls, search_thread, config, user):
+    """The thread is found even if the annotation has a thread field."""
+    annotation = Annotation({'id': 'a', 'thread': 'x/y'})
+    annotation_cls.fetch.return_value = annotation
+    search_thread.return_value = {'annotation': {'id': 'a'}, 'replies': []}
+    config.set_root_factory(create_root)
+    config.set_authorization_policy(ACLAuthorizationPolicy())
+    config.testing_securitypolicy('acct:bob@example.com')
+    config.include('h.api.views')
+    app = config.make_wsgi_app()
+
+    response = Request.blank('/annotations/a/thread',
+                             accept='application/json').get_response(app)
+
+    assert response.status_int == 200
+    annotation_cls.fetch.assert_called_once_with('a')
+    search_thread.assert_called_once_with(annotation, user=user)
+
+
+@patch('h.api.resources.Annotation')
+def test_thread_route_not_found(annotation_cls):
+    annotation_cls.fetch.return_value = None
+    request = DummyRequest(matchdict={'id': 'a'})
+
+    with raises(HTTPNotFound):
+        annotation_factory(request)
+
+
+@patch('h.api.search.thread')
+@pytest.mark.usefixtures('replace_io')
+def test_thread(search_thread, user):
+    annotation = DummyResource()
+
+    result = views.thread(annotation, DummyRequest())
+
+    search_thread.assert_called_once_with(annotation, user=user)
+    assert result == search_thread.return_value
+
+
 @patch('h.api.views._update_annotation')
 @pytest.mark.usefixtures('replace_io')
 def test_update(mock_update_annotation):
@@ -4,9 +4,11 @@
 
 import logging
 
+from pyramid.settings import asbool
 from pyramid.view import view_config
 
 from h.api.auth import get_user
+from h.api.events import AnnotationBatchEvent
 from h.api.events import AnnotationEvent
 from h.api.models import Annotation
 from h.api.resources import Root
@@ -19,6 +21,9 @@ log = logging.getLogger(__name__)
 # These annotation fields are not to be set by the user.
 PROTECTED_FIELDS = ['created', 'updated', 'user', 'consumer', 'id']
 
+# The maximum number of annotations that can be fetched at once by id.
+MAX_BATCH_SIZE = 200
+
 
 def api_config(**kwargs):
     """Extend Pyramid's @view_config decorator with modified defaults."""
@@ -66,6 +71,11 @@ def index(context, request):
                 'url': request.resource_url(context, 'search'),
                 'desc': 'Basic search API'
             },
+            'count': {
+                'method': 'GET',
+                'url': request.resource_url(context, 'count'),
+                'desc': 'Count the annotations matching a search'
+            },
         }
     }
 
@@ -75,7 +85,22 @@ def search(request):
     """Search the database for annotations matching with the given query."""
     # The search results are filtered for the authenticated user
     user = get_user(request)
-    return h.api.search.search(request.params, user)
+    settings = request.registry.settings
+    filtered = asbool(settings.get('h.search.filter_context', False))
+    try:
+        return h.api.search.search(request.params, user, filtered=filtered)
+    except h.api.search.InvalidCursorError as err:
+        return _api_error(request, str(err), status_code=400)
+
+
+@api_config(context=Root, name='count')
+def count(request):
+    """Count the annotations matching the given query."""
+    # The counts are filtered for the authenticated user
+    user = get_user(request)
+    settings = request.registry.settings
+    filtered = asbool(settings.get('h.search.filter_context', False))
+    return h.api.search.count(request.params, user, filtered=filtered)
 
 
 @api_config(context=Root, name='access_token')
@@ -110,6 +135,41 @@ def annotations_index(request):
     return h.api.search.index(user=user)
 
 
+@api_config(context=Annotations, request_method='GET', request_param='ids')
+def annotations_batch(request):
+    """Return the annotations with the given ids, fetched in one request.
+
+    Annotations that don't exist, or that the user isn't allowed to read,
+    are left out of the results.
+    """
+    ids = []
+    for param in request.params.getall('ids'):
+        for id_ in param.split(','):
+            id_ = id_.strip()
+            if id_ and id_ not in ids:
+                ids.append(id_)
+
+    if len(ids) > MAX_BATCH_SIZE:
+        return _api_error(request,
+                          'Too many ids. At most {} annotations can be '
+                          'fetched at once.'.format(MAX_BATCH_SIZE),
+                          status_code=400)  # Client Error: Bad Request
+
+    # Locate the annotations in the resource tree, as traversal would, so
+    # that permissions granted on the root apply to them too.
+    parent = request.root['annotations']
+    rows = []
+    for id_, annotation in zip(ids, Annotation.fetch_all(ids)):
+        if annotation is None:
+            continue
+        annotation.__name__ = id_
+        annotation.__parent__ = parent
+        if request.has_permission('read', annotation):
+            rows.append(annotation)
+
+    return {'rows': rows, 'total': len(rows)}
+
+
 @api_config(context=Annotations, request_method='POST', permission='create')
 def create(request):
     """Read the POSTed JSON-encoded annotation and persist it."""
@@ -133,6 +193,76 @@ def create(request):
     return annotation
 
 
+@api_config(context=Root, name='bulk', request_method='POST',
+            permission='create')
+def bulk(request):
+    """Create, update and delete several annotations at once.
+
+    Reads a JSON-encoded list of operations of the form
+    ``{"action": ..., "id": ..., "annotation": {...}}`` and performs all of
+    them with a single write to the database. Each operation is checked as
+    the corresponding single-annotation view would check it, and the result
+    of each is returned in the same order.
+    """
+    user = get_user(request)
+
+    try:
+        operations = request.json_body
+    except ValueError:
+        return _api_error(request,
+                          'No JSON payload sent. No annotations changed.',
+                          status_code=400)  # Client Error: Bad Request
+
+    if not isinstance(operations, list):
+        return _api_error(request,
+                          'Expected a list of operations.',
+                          status_code=400)  # Client Error: Bad Request
+
+    if len(operations) > MAX_BATCH_SIZE:
+        return _api_error(request,
+                          'Too many operations. At most {} annotations can '
+                          'be changed at once.'.format(MAX_BATCH_SIZE),
+                          status_code=400)  # Client Error: Bad Request
+
+    # Fetch all the annotations being updated or deleted in one request.
+    ids = [op['id'] for op in operations
+           if isinstance(op, dict) and op.get('action') in ('update', 'delete')
+           and isinstance(op.get('id'), basestring) and op['id']]
+    existing = dict(zip(ids, Annotation.fetch_all(ids)))
+
+    results = [None] * len(operations)
+    pending = []
+    for i, op in enumerate(operations):
+        try:
+            action, annotation = _bulk_operation(request, user, op, existing)
+        except _BulkError as err:
+            results[i] = _bulk_error(err.reason, err.status_code)
+        else:
+            pending.append((i, action, annotation))
+
+    errors = Annotation.bulk([
+        ('delete' if action == 'delete' else 'index', annotation)
+        for _, action, annotation in pending
+    ])
+
+    events = []
+    for (i, action, annotation), error in zip(pending, errors):
+        if error is not None:
+            log.error('Bulk %s failed for annotation: %s', action, error)
+            results[i] = _bulk_error('Could not save annotation.', 500)
+            continue
+        results[i] = {'status': 'success', 'action': action,
+                      'id': annotation['id']}
+        if action != 'delete':
+            results[i]['annotation'] = annotation
+        events.append(AnnotationEvent(request, annotation, action))
+
+    # Notify any subscribers
+    request.registry.notify(AnnotationBatchEvent(request, events))
+
+    return {'results': results}
+
+
 @api_config(context=Annotation, request_method='GET', permission='read')
 def read(context, request):
     """Return the annotation (simply how it was stored in the database)."""
@@ -144,6 +274,14 @@ def read(context, request):
     return annotation
 
 
+@api_config(route_name='thread', request_method='GET', permission='read')
+def thread(context, request):
+    """Return the annotation together with all of its replies, as a tree."""
+    # The replies are filtered for the authenticated user
+    user = get_user(request)
+    return h.api.search.thread(context, user=user)
+
+
 @api_config(context=Annotation, request_method='PUT', permission='update')
 def update(context, request):
     """Update the fields we received and store the updated version."""
@@ -209,8 +347,71 @@ def _api_error(request, reason, status_code):
     return response_info
 
 
-def _create_annotation(fields, user):
-    """Create and store an annotation."""
+class _BulkError(Exception):
+    """An operation of a bulk request which can't be carried out."""
+
+    def __init__(self, reason, status_code):
+        super(_BulkError, self).__init__(reason, status_code)
+        self.reason = reason
+        self.status_code = status_code
+
+
+class _UpdateError(RuntimeError):
+    """An update which isn't allowed, with a reason and status code."""
+
+
+def _bulk_error(reason, status_code):
+    return {'status': 'failure', 'reason': reason, 'status_code': status_code}
+
+
+def _bulk_operation(request, user, op, existing):
+    """Check one operation of a bulk request and apply it to an annotation.
+
+    Returns the action and the annotation to be written (or deleted), or
+    raises _BulkError with a reason and status code.
+    """
+    if not isinstance(op, dict):
+        raise _BulkError('Operation must be an object.', 400)
+
+    action = op.get('action')
+    fields = op.get('annotation')
+
+    if action == 'create':
+        if not isinstance(fields, dict):
+            raise _BulkError('No annotation sent. Annotation not created.',
+                             400)
+        return action, _new_annotation(fields, user)
+
+    if action not in ('update', 'delete'):
+        raise _BulkError('Unknown action: {}'.format(action), 400)
+
+    id_ = op.get('id')
+    if not isinstance(id_, basestring):
+        raise _BulkError('Annotation id must be a string.', 400)
+    annotation = existing.get(id_)
+    if annotation is None:
+        raise _BulkError('Annotation not found.', 404)
+    annotation.__name__ = id_
+    annotation.__parent__ = request.root['annotations']
+    if not request.has_permission(action, annotation):
+        raise _BulkError('Not authorized to {} annotation.'.format(action),
+                         403)
+
+    if action == 'update':
+        if not isinstance(fields, dict):
+            raise _BulkError('No annotation sent. Annotation not updated.',
+                             400)
+        has_admin_permission = request.has_permission('admin', annotation)
+        try:
+            _apply_update(annotation, fields, has_admin_permission)
+        except _UpdateError as err:
+            raise _BulkError(*err.args)
+
+    return action, annotation
+
+
+def _new_annotation(fields, user):
+    """Create an annotation owned by the given user, without storing it."""
 
     # Some fields are not to be set by the user, ignore them
     for field in PROTECTED_FIELDS:
@@ -222,6 +423,13 @@ def _create_annotation(fields, user):
     annotation['user'] = user.id
     annotation['consumer'] = user.consumer.key
 
+    return annotation
+
+
+def _create_annotation(fields, user):
+    """Create and store an annotation."""
+    annotation = _new_annotation(fields, user)
+
     # Save it in the database
     annotation.save()
 
@@ -232,6 +440,14 @@ def _create_annotation(fields, user):
 
 
 def _update_annotation(annotation, fields, has_admin_permission):
+    _apply_update(annotation, fields, has_admin_permission)
+
+    # Save the annotation in the database, overwriting the old version.
+    annotation.save()
+
+
+def _apply_update(annotation, fields, has_admin_permission):
+    """Update the annotation with the given fields, without storing it."""
     # Some fields are not to be set by the user, ignore them
     for field in PROTECTED_FIELDS:
         fields.pop(field, None)
@@ -242,7 +458,7 @@ def _update_annotation(annotation, fields, has_admin_permission):
         fields['permissions'] != annotation.get('permissions', {})
     )
     if changing_permissions and not has_admin_permission:
-        raise RuntimeError("Not authorized to change annotation permissions.",
+        raise _UpdateError("Not authorized to change annotation permissions.",
                            401)  # Unauthorized
 
     # Update the annotation with the new data
@@ -252,9 +468,6 @@ def _update_annotation(annotation, fields, has_admin_permission):
     if annotation.get('deleted', False):
         _anonymize_deletes(annotation)
 
-    # Save the annotation in the database, overwriting the old version.
-    annotation.save()
-
 
 def _anonymize_deletes(annotation):
     """Clear the author and remove the user from the annotation permissions."""
@@ -274,4 +487,8 @@ def _anonymize_deletes(annotation):
 
 
 def includeme(config):
+    # Annotations are dicts, so a view name on one would be shadowed by a
+    # field of the same name. The thread is routed to instead.
+    config.add_route('thread', '/annotations/{id}/thread',
+                     factory='h.api.resources.annotation_factory')
     config.scan(__name__)
@@ -104,6 +104,7 @@ def create_api(global_config, **settings):
 
     config.include('h.auth')
     config.include('h.api.db')
+    config.include('h.api.search')
     config.include('h.api.views')
 
     if config.registry.feature('queue'):
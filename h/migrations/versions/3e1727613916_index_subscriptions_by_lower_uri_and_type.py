@@ -0,0 +1,24 @@
+"""Index subscriptions by lower(uri) and lower(type)
+
+Revision ID: 3e1727613916
+Revises: 29d0200ba8a9
+Create Date: 2015-06-16 10:41:02.263175
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e1727613916'
+down_revision = '29d0200ba8a9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('subs_lower_uri_type_idx_subscriptions',
+                    'subscriptions',
+                    [sa.text('lower(uri)'), sa.text('lower(type)')])
+
+
+def downgrade():
+    op.drop_index('subs_lower_uri_type_idx_subscriptions', 'subscriptions')
@@ -1,13 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 from annotator import annotation, document
+from annotator import elasticsearch as es_model
 from pyramid.i18n import TranslationStringFactory
 from pyramid.security import Allow, Authenticated, Everyone, ALL_PERMISSIONS
 
 _ = TranslationStringFactory(__package__)
 
 
+# An unanalyzed copy of a field, for aggregating on its whole values. Values
+# longer than Lucene's limit on the size of a term would make Elasticsearch
+# reject the whole annotation, so long values are left out of it.
+RAW_FIELD = {'type': 'string', 'index': 'not_analyzed', 'ignore_above': 256}
+
+
 class Annotation(annotation.Annotation):
+    # Whether writes refresh the index, so that they are visible to searches
+    # immediately. If not, they become visible at the index's next periodic
+    # refresh. See h.api.db.store_from_settings.
+    refresh_on_write = True
+
     def __acl__(self):
         acl = []
         # Convert annotator-store roles to pyramid principals
@@ -42,7 +54,13 @@ class Annotation(annotation.Annotation):
         'created': {'type': 'date'},
         'updated': {'type': 'date'},
         'quote': {'type': 'string', 'analyzer': 'uni_normalizer'},
-        'tags': {'type': 'string', 'analyzer': 'uni_normalizer'},
+        'tags': {
+            'type': 'string',
+            'analyzer': 'uni_normalizer',
+            'fields': {
+                'raw': RAW_FIELD,
+            },
+        },
         'text': {'type': 'string', 'analyzer': 'uni_normalizer'},
         'deleted': {'type': 'boolean'},
         'uri': {
@@ -55,9 +73,17 @@ class Annotation(annotation.Annotation):
                     'index_analyzer': 'uri_parts',
                     'search_analyzer': 'uri_parts',
                 },
+                'raw': RAW_FIELD,
+            },
+        },
+        'user': {
+            'type': 'string',
+            'index': 'analyzed',
+            'analyzer': 'user',
+            'fields': {
+                'raw': RAW_FIELD,
             },
         },
-        'user': {'type': 'string', 'index': 'analyzed', 'analyzer': 'user'},
         'consumer': {'type': 'string'},
         'target': {
             'properties': {
@@ -177,6 +203,108 @@ class Annotation(annotation.Annotation):
     def get_analysis(cls):
         return cls.__analysis__
 
+    def save(self, refresh=None):
+        if refresh is None:
+            refresh = self.refresh_on_write
+        super(Annotation, self).save(refresh=refresh)
+
+    @classmethod
+    def fetch_all(cls, ids):
+        """Fetch the annotations with the given ids in a single request.
+
+        Returns a list with the annotation for each id, in the same order as
+        ``ids``, or ``None`` in place of any annotation that wasn't found.
+        """
+        if not ids:
+            return []
+        res = cls.es.conn.mget(index=cls.es.index,
+                               doc_type=cls.__type__,
+                               body={'ids': list(ids)})
+        return [cls(d['_source'], id=d['_id']) if d.get('found') else None
+                for d in res['docs']]
+
+    @classmethod
+    def bulk(cls, operations, refresh=None):
+        """Index and delete several annotations with a single bulk request.
+
+        :param operations: a list of ``(action, annotation)`` pairs, where
+            action is ``'index'`` or ``'delete'``. Annotations to be indexed
+            are prepared as :meth:`save` would prepare them, and are given
+            an id if they don't already have one. Their document metadata
+            is saved beforehand, once for each distinct set of document
+            links, since annotator merges documents with their own
+            requests.
+
+        :param refresh: whether to refresh the index afterwards (default:
+            :attr:`refresh_on_write`)
+
+        :returns: a list with, for each operation, ``None`` if it succeeded
+            or else the error reported by Elasticsearch
+        """
+        cls._save_documents([ann for action, ann in operations
+                             if action == 'index'])
+
+        body = []
+        for action, ann in operations:
+            header = {'_index': cls.es.index, '_type': cls.__type__}
+            if 'id' in ann:
+                header['_id'] = ann['id']
+            if action == 'index':
+                ann._prepare_save(save_document=False)
+                body.append({'index': header})
+                body.append(ann)
+            else:
+                body.append({'delete': header})
+
+        if not body:
+            return []
+
+        if refresh is None:
+            refresh = cls.refresh_on_write
+        res = cls.es.conn.bulk(body=body, refresh=refresh)
+
+        errors = []
+        for (action, ann), item in zip(operations, res['items']):
+            # Elasticsearch reports an index request without an id as a
+            # "create", so read the item whatever its operation type.
+            (result,) = item.values()
+            if 'error' in result:
+                errors.append(result['error'])
+                continue
+            if action == 'index':
+                ann['id'] = result['_id']
+            errors.append(None)
+        return errors
+
+    @staticmethod
+    def _save_documents(annotations):
+        """Save the document metadata of several annotations.
+
+        Annotations of the same page usually carry the same document links,
+        so the document is only saved for the first annotation with each
+        set of links. Documents without links are each saved.
+        """
+        seen = set()
+        for ann in annotations:
+            if 'document' not in ann:
+                continue
+            links = ann['document'].get('link', [])
+            key = frozenset(l['href'] for l in links
+                            if isinstance(l, dict) and 'href' in l)
+            if key and key in seen:
+                continue
+            seen.add(key)
+            document.Document(ann['document']).save()
+
+    def _prepare_save(self, save_document=True):
+        """Do everything annotator's save() does, short of indexing."""
+        annotation._add_default_permissions(self)
+        if save_document and 'document' in self:
+            d = document.Document(self['document'])
+            d.save()
+        es_model._add_created(self)
+        es_model._add_updated(self)
+
 
 class Document(document.Document):
     __analysis__ = {}
@@ -28,6 +28,16 @@ class Subscriptions(Base):
             )
         ).all()
 
+    @classmethod
+    def get_active_subscriptions_for_uri_and_type(cls, uri, ttype):
+        return cls.query.filter(
+            and_(
+                cls.active,
+                func.lower(cls.uri) == func.lower(uri),
+                func.lower(cls.type) == func.lower(ttype)
+            )
+        ).all()
+
     @classmethod
     def get_subscriptions_for_uri(cls, uri):
         return cls.query.filter(
@@ -50,5 +60,11 @@ class Subscriptions(Base):
                 'active': self.active}
 
 
+# Lookups are by case-insensitive uri and type
+sa.Index('subs_lower_uri_type_idx_subscriptions',
+         func.lower(Subscriptions.uri),
+         func.lower(Subscriptions.type))
+
+
 def includeme(_):
     pass
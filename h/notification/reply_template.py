@@ -121,8 +121,13 @@ def generate_notifications(request, annotation, action):
         'parent': parent_values(annotation)
     }
 
-    subscriptions = Subscriptions.get_active_subscriptions_for_a_type(
-        types.REPLY_TYPE)
+    # Only the parent's author can be notified about the reply
+    parent_user = data['parent'].get('user')
+    if not parent_user or parent_user == annotation['user']:
+        return
+
+    subscriptions = Subscriptions.get_active_subscriptions_for_uri_and_type(
+        parent_user, types.REPLY_TYPE)
     for subscription in subscriptions:
         data['subscription'] = subscription.__json__(request)
 
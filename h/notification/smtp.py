@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import logging
+import smtplib
+import socket
+
+import gevent
+import gevent.event
+import gevent.queue
+from repoze.sendmail.encoding import encode_message
+
+log = logging.getLogger(__name__)
+
+
+class SMTPPool(object):
+    """
+    Sends mail over a pool of persistent connections to an SMTP server.
+
+    Messages are sent by ``size`` greenlets, each of which opens a
+    connection the first time it has a message to send, and keeps it open
+    for the messages after that. The server and credentials are those of
+    ``mailer``, a :py:class:`pyramid_mailer.mailer.Mailer`.
+
+    Sending only yields to other greenlets if the socket module has been
+    patched by gevent, as it is in the web and worker processes.
+    """
+
+    def __init__(self, mailer, size=4):
+        self.mailer = mailer
+        self.size = size
+        self.queue = gevent.queue.Queue()
+        self.workers = []
+
+    def send(self, message):
+        """
+        Send a :py:class:`pyramid_mailer.message.Message`.
+
+        Returns a :py:class:`gevent.event.AsyncResult` which is set when the
+        message has been delivered to the server, or fails to be.
+        """
+        message.sender = message.sender or self.mailer.default_sender
+        data = encode_message(message.to_message())
+        result = gevent.event.AsyncResult()
+        self.queue.put((message.sender, message.send_to, data, result))
+        if not self.workers:
+            self.workers = [gevent.spawn(self._work)
+                            for _ in range(self.size)]
+        return result
+
+    def _work(self):
+        connection = None
+        for sender, recipients, data, result in self.queue:
+            reused = connection is not None
+            try:
+                if connection is None:
+                    connection = self._connect()
+                try:
+                    connection.sendmail(sender, recipients, data)
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    if not reused:
+                        raise
+                    # The server may close connections which have been idle
+                    log.info("SMTP connection lost, reconnecting")
+                    _close(connection)
+                    connection = None
+                    connection = self._connect()
+                    connection.sendmail(sender, recipients, data)
+            except smtplib.SMTPServerDisconnected as exc:
+                connection = None
+                result.set_exception(exc)
+            except smtplib.SMTPException as exc:
+                # The server refused the message, but the connection is fine
+                result.set_exception(exc)
+            except Exception as exc:
+                _close(connection)
+                connection = None
+                result.set_exception(exc)
+            else:
+                result.set(None)
+
+    def _connect(self):
+        config = self.mailer.smtp_mailer
+        connection = config.smtp_factory()
+        connection.ehlo()
+        if connection.has_extn('starttls') and not config.no_tls:
+            connection.starttls()
+            connection.ehlo()
+        elif config.force_tls:
+            raise RuntimeError('TLS is not available but TLS is required')
+        if config.username is not None and config.password is not None:
+            connection.login(config.username, config.password)
+        return connection
+
+
+def _close(connection):
+    if connection is None:
+        return
+    try:
+        connection.close()
+    except Exception:
+        pass
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from h.notification.models import Subscriptions
+
+
+def test_get_active_subscriptions_for_uri_and_type(db_session):
+    db_session.add_all([
+        Subscriptions(uri='acct:Luke@example.com', type='reply', active=True),
+        Subscriptions(uri='acct:luke@example.com', type='other', active=True),
+        Subscriptions(uri='acct:leia@example.com', type='reply', active=True),
+        Subscriptions(uri='acct:luke@example.com', type='reply',
+                      active=False),
+    ])
+    db_session.flush()
+
+    result = Subscriptions.get_active_subscriptions_for_uri_and_type(
+        'acct:luke@example.com', 'REPLY')
+
+    assert [(s.uri, s.type, s.active) for s in result] == [
+        ('acct:Luke@example.com', 'reply', True)]
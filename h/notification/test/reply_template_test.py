@@ -345,11 +345,26 @@ def test_action_create():
 
         annotation = store_fake_data[1]
         with patch('h.notification.reply_template.Subscriptions') as mock_subs:
-            mock_subs.get_active_subscriptions_for_a_type.return_value = []
+            mock_subs.get_active_subscriptions_for_uri_and_type.return_value = []
             msgs = rt.generate_notifications(request, annotation, 'create')
             with raises(StopIteration):
                 msgs.next()
-            assert mock_subs.get_active_subscriptions_for_a_type.called
+            mock_subs.get_active_subscriptions_for_uri_and_type.assert_called_with(
+                'acct:elephant@nomouse.pls', 'reply')
+
+
+def test_action_create_own_reply():
+    """Replies to the user's own annotations don't look up subscriptions"""
+    with patch('h.notification.reply_template.Annotation') as mock_annotation:
+        mock_annotation.fetch = MagicMock(side_effect=fake_fetch)
+        request = _create_request()
+
+        annotation = store_fake_data[3]
+        with patch('h.notification.reply_template.Subscriptions') as mock_subs:
+            msgs = rt.generate_notifications(request, annotation, 'create')
+            with raises(StopIteration):
+                msgs.next()
+            assert not mock_subs.get_active_subscriptions_for_uri_and_type.called
 
 
 class MockSubscription(Mock):
@@ -368,7 +383,7 @@ def test_check_conditions_false_stops_sending():
 
         annotation = store_fake_data[1]
         with patch('h.notification.reply_template.Subscriptions') as mock_subs:
-            mock_subs.get_active_subscriptions_for_a_type.return_value = [
+            mock_subs.get_active_subscriptions_for_uri_and_type.return_value = [
                 MockSubscription(id=1, uri='acct:elephant@nomouse.pls')
             ]
             with patch('h.notification.reply_template.check_conditions') as mock_conditions:
@@ -386,7 +401,7 @@ def test_send_if_everything_is_okay():
 
         annotation = store_fake_data[1]
         with patch('h.notification.reply_template.Subscriptions') as mock_subs:
-            mock_subs.get_active_subscriptions_for_a_type.return_value = [
+            mock_subs.get_active_subscriptions_for_uri_and_type.return_value = [
                 MockSubscription(id=1, uri='acct:elephant@nomouse.pls')
             ]
             with patch('h.notification.reply_template.check_conditions') as mock_conditions:
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import SocketServer
+import socket
+import threading
+
+import gevent
+from mock import Mock
+from pyramid_mailer.message import Message
+import pytest
+from repoze.sendmail.mailer import SMTPMailer
+
+from h.notification.smtp import SMTPPool
+
+
+class SMTPSink(SocketServer.ThreadingTCPServer):
+    """
+    An SMTP server which accepts all mail, except for recipients at
+    ``refused.example.com``, and records it.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 SMTPHandler)
+        self.connections = 0
+        self.sockets = []
+        self.messages = []
+
+    def drop_connections(self):
+        for sock in self.sockets:
+            sock.shutdown(socket.SHUT_RDWR)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class SMTPHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        self.server.sockets.append(self.connection)
+        self.reply('220 sink')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply('250 sink')
+            elif command == 'RCPT':
+                if 'refused.example.com' in line:
+                    self.reply('550 refused')
+                else:
+                    recipients.append(line.split(':', 1)[1].strip())
+                    self.reply('250 ok')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                for line in iter(self.rfile.readline, '.\r\n'):
+                    data.append(line)
+                self.server.messages.append((recipients, ''.join(data)))
+                recipients = []
+                self.reply('250 ok')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+
+
+@pytest.fixture
+def sink(request):
+    server = SMTPSink()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return server
+
+
+def _pool(sink, size=1):
+    mailer = Mock(smtp_mailer=SMTPMailer('127.0.0.1', sink.port),
+                  default_sender='noreply@example.com')
+    return SMTPPool(mailer, size)
+
+
+def _message(recipient='bob@example.com'):
+    return Message(subject='Hello', recipients=[recipient], body='Hi')
+
+
+def test_send_delivers_message(sink):
+    pool = _pool(sink)
+    result = pool.send(_message())
+    result.get(timeout=5)
+    [(recipients, data)] = sink.messages
+    assert recipients == ['<bob@example.com>']
+    assert 'Subject: Hello' in data
+
+
+def test_send_reuses_connection(sink):
+    pool = _pool(sink)
+    results = [pool.send(_message()) for _ in range(5)]
+    gevent.joinall(results, timeout=5)
+    assert all(r.successful() for r in results)
+    assert len(sink.messages) == 5
+    assert sink.connections == 1
+
+
+def test_send_reconnects_after_connection_lost(sink):
+    pool = _pool(sink)
+    pool.send(_message()).get(timeout=5)
+    sink.drop_connections()
+    result = pool.send(_message())
+    result.get(timeout=5)
+    assert len(sink.messages) == 2
+    assert sink.connections == 2
+
+
+def test_send_refused_recipient(sink):
+    pool = _pool(sink)
+    refused = pool.send(_message('bob@refused.example.com'))
+    accepted = pool.send(_message())
+    gevent.joinall([refused, accepted], timeout=5)
+    assert not refused.successful()
+    assert accepted.successful()
+    assert sink.connections == 1
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import json
+
+import gevent
+import gevent.event
+from mock import MagicMock, Mock, patch
+import pytest
+from pyramid.testing import DummyRequest
+
+from h.notification import worker
+
+
+@pytest.fixture
+def pool(request):
+    patcher = patch('h.notification.worker.SMTPPool')
+    request.addfinalizer(patcher.stop)
+    return patcher.start().return_value
+
+
+@pytest.fixture
+def notifications(request):
+    patcher = patch('h.notification.worker.generate_notifications')
+    request.addfinalizer(patcher.stop)
+    generate = patcher.start()
+    generate.return_value = [('subject', 'body', 'html', ['bob@example.com'])]
+    return generate
+
+
+def _run():
+    request = DummyRequest()
+    request.get_queue_reader = MagicMock()
+    with patch('h.notification.worker.get_mailer'):
+        worker.run(request)
+    reader = request.get_queue_reader.return_value
+    handle_message = reader.on_message.connect.call_args[0][0]
+    return request, reader, handle_message
+
+
+def _message(action='create'):
+    body = json.dumps({'action': action, 'annotation': {'id': 'abc'}})
+    return Mock(body=body)
+
+
+def test_run_reads_asynchronously(pool):
+    request, reader, _ = _run()
+    request.get_queue_reader.assert_called_once_with(
+        'annotations', 'notification', async=True, max_in_flight=20)
+    reader.start.assert_called_once_with(block=True)
+
+
+def test_finishes_after_delivery(pool, notifications):
+    result = gevent.event.AsyncResult()
+    pool.send.return_value = result
+    _, reader, handle_message = _run()
+    message = _message()
+
+    handle_message(reader, message)
+    gevent.sleep(0)
+    assert not message.finish.called
+
+    result.set(None)
+    gevent.sleep(0.01)
+    message.finish.assert_called_once_with()
+    assert not message.requeue.called
+
+
+def test_requeues_when_delivery_fails(pool, notifications):
+    result = gevent.event.AsyncResult()
+    pool.send.return_value = result
+    _, reader, handle_message = _run()
+    message = _message()
+
+    handle_message(reader, message)
+    result.set_exception(IOError())
+    gevent.sleep(0.01)
+    message.requeue.assert_called_once_with()
+    assert not message.finish.called
+
+
+def test_finishes_other_actions_immediately(pool, notifications):
+    _, reader, handle_message = _run()
+    message = _message('update')
+
+    handle_message(reader, message)
+    message.finish.assert_called_once_with()
+    assert not notifications.called
+    assert not pool.send.called
@@ -1,10 +1,15 @@
-import json
+import logging
 
+import gevent
 from pyramid_mailer import get_mailer
 from pyramid_mailer.message import Message
 
 from ..models import Annotation
+from ..queue import decode_message
 from .reply_template import generate_notifications
+from .smtp import SMTPPool
+
+log = logging.getLogger(__name__)
 
 
 def run(request):
@@ -15,20 +20,50 @@ def run(request):
     It is safe to run several of these worker functions as they all read from
     the same channel. NSQ will distribute messages among available workers in a
     round-robin fashion.
+
+    Mail is sent over ``h.notification.smtp_connections`` connections at
+    once, and up to ``h.notification.max_in_flight`` messages are handled
+    at once. Messages are only finished once their notifications have been
+    delivered to the mail server, and are requeued if that fails.
     """
+    settings = request.registry.settings
+    connections = int(settings.get('h.notification.smtp_connections', 4))
+    max_in_flight = int(settings.get('h.notification.max_in_flight', 20))
+    pool = SMTPPool(get_mailer(request), connections)
+
     def handle_message(reader, message=None):
         if message is None:
             return
-        data = json.loads(message.body)
+        data = decode_message(message.body)
         action = data['action']
+        if action != 'create':
+            message.finish()
+            return
         annotation = Annotation(**data['annotation'])
-        mailer = get_mailer(request)
         notifications = generate_notifications(request, annotation, action)
+        results = []
         for (subject, body, html, recipients) in notifications:
             m = Message(subject=subject, recipients=recipients,
                         body=body, html=html)
-            mailer.send_immediately(m)
+            results.append(pool.send(m))
+        gevent.spawn(finish_after_delivery, message, results)
 
-    reader = request.get_queue_reader('annotations', 'notification')
+    reader = request.get_queue_reader('annotations', 'notification',
+                                      async=True,
+                                      max_in_flight=max_in_flight)
     reader.on_message.connect(handle_message)
     reader.start(block=True)
+
+
+def finish_after_delivery(message, results):
+    """
+    Finish ``message`` once all of ``results`` are set, or requeue it if
+    any of them failed.
+    """
+    gevent.joinall(results)
+    for result in results:
+        if not result.successful():
+            log.error("failed to send notification: %s", result.exception)
+            message.requeue()
+            return
+    message.finish()
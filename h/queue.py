@@ -1,6 +1,150 @@
-from pyramid.settings import aslist
+import collections
+import json
+import logging
+import struct
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.queue
+from gnsq import protocol as nsq
+from pyramid.settings import asbool, aslist
 import gnsq
 
+from h import stats
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = logging.getLogger(__name__)
+
+# The version of the message format written by encode_message when given a
+# codec. Messages of version 0 are plain JSON objects, which always start
+# with "{", and are still written by default so that consumers which only
+# understand JSON keep working.
+MESSAGE_VERSION = 1
+_MESSAGE_HEADER = struct.Struct('!BBI')
+
+
+class JSONCodec(object):
+    name = 'json'
+    id = 1
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj)
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    id = 2
+
+    @staticmethod
+    def dumps(obj):
+        return msgpack.packb(obj)
+
+    @staticmethod
+    def loads(data):
+        return msgpack.unpackb(data, encoding='utf-8')
+
+
+_codecs_by_name = {}
+_codecs_by_id = {}
+
+
+def register_codec(codec):
+    """
+    Make a codec available for encoding and decoding messages.
+
+    A codec has a unique ``name`` and one-byte ``id``, and ``dumps`` and
+    ``loads`` functions for serializing objects of JSON types.
+    """
+    _codecs_by_name[codec.name] = codec
+    _codecs_by_id[codec.id] = codec
+
+
+register_codec(JSONCodec)
+if msgpack is not None:
+    register_codec(MsgpackCodec)
+
+
+def encode_message(data, codec=None):
+    """
+    Encode an annotation event message, a dict with an ``annotation`` and
+    other envelope fields such as the ``action``.
+
+    Without a ``codec`` the message is encoded as a plain JSON object.
+    Given the name of a registered codec, the envelope fields are encoded
+    with it separately from the annotation, so that they can be read
+    without decoding it, behind a header naming the codec. Only consumers
+    which use :py:func:`decode_message` can read these messages.
+    """
+    if codec is None:
+        return json.dumps(data)
+
+    codec = _codecs_by_name[codec]
+    envelope = dict(data)
+    annotation = envelope.pop('annotation')
+    envelope = codec.dumps(envelope)
+    header = _MESSAGE_HEADER.pack(MESSAGE_VERSION, codec.id, len(envelope))
+    return header + envelope + codec.dumps(annotation)
+
+
+def decode_message(body):
+    """
+    Decode a message encoded by :py:func:`encode_message`, or a plain JSON
+    message, into a :py:class:`QueueMessage`.
+    """
+    if body[:1] == '{':
+        return QueueMessage(json.loads(body))
+
+    version, codec_id, length = _MESSAGE_HEADER.unpack_from(body)
+    if version != MESSAGE_VERSION:
+        raise ValueError('Unknown message version: {}'.format(version))
+    try:
+        codec = _codecs_by_id[codec_id]
+    except KeyError:
+        raise ValueError('Unknown message codec: {}'.format(codec_id))
+
+    start = _MESSAGE_HEADER.size
+    fields = codec.loads(body[start:start + length])
+    return QueueMessage(fields,
+                        lambda: codec.loads(body[start + length:]))
+
+
+class QueueMessage(collections.Mapping):
+    """
+    A decoded annotation event message.
+
+    The ``annotation`` is only decoded when it is first looked up, so that
+    consumers can check the other fields first.
+    """
+
+    def __init__(self, fields, load_annotation=None):
+        self._fields = fields
+        self._load_annotation = load_annotation
+
+    def __getitem__(self, key):
+        if key == 'annotation' and self._load_annotation is not None:
+            self._fields['annotation'] = self._load_annotation()
+            self._load_annotation = None
+        return self._fields[key]
+
+    def __iter__(self):
+        if self._load_annotation is not None:
+            yield 'annotation'
+        for key in self._fields:
+            yield key
+
+    def __len__(self):
+        return len(self._fields) + (self._load_annotation is not None)
+
 
 class NamespacedNsqd(object):
     def __init__(self, namespace, *args, **kwargs):
@@ -12,12 +156,216 @@ class NamespacedNsqd(object):
             topic = '{0}-{1}'.format(self.namespace, topic)
         return self.client.publish(topic, data)
 
+    def multipublish(self, topic, messages):
+        if self.namespace is not None:
+            topic = '{0}-{1}'.format(self.namespace, topic)
+        return self.client.multipublish(topic, messages)
+
+
+class BatchWriter(object):
+    """
+    A writer which holds a TCP connection open to nsqd, and publishes the
+    messages given to it in batches with ``MPUB``.
+
+    Messages are buffered for up to ``batch_interval`` seconds, or until
+    ``batch_size`` messages are waiting, and are then published by a
+    background greenlet, so that publishing doesn't wait on nsqd. If a batch
+    can't be published over TCP, it's published over HTTP instead, and the
+    connection is reopened for the next batch. If it can't be published
+    over HTTP either, it's kept and retried after ``retry_delay`` seconds.
 
-def get_reader(request, topic, channel):
+    At most ``max_pending`` messages are held. Messages given to the writer
+    while it's full are dropped and logged. An explicit :py:meth:`flush`
+    waits at most ``flush_timeout`` seconds for one in progress to finish,
+    and otherwise leaves the messages to be published by the next.
+    """
+
+    def __init__(self, namespace, address='localhost', tcp_port=4150,
+                 http_port=4151, batch_size=100, batch_interval=0.05,
+                 max_pending=10000, retry_delay=1, flush_timeout=5):
+        self.client = gnsq.Nsqd(address, tcp_port=tcp_port,
+                                http_port=http_port)
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.flush_timeout = flush_timeout
+        self.pending = {}
+        self.pending_count = 0
+        self.dropped = 0
+        self.flusher = None
+        self._full = gevent.event.Event()
+        self._lock = gevent.lock.Semaphore()
+
+    def publish(self, topic, data):
+        self.multipublish(topic, [data])
+
+    def multipublish(self, topic, messages):
+        if self.namespace is not None:
+            topic = '{0}-{1}'.format(self.namespace, topic)
+        if self.pending_count + len(messages) > self.max_pending:
+            self.dropped += len(messages)
+            log.error("nsq writer full, dropping %d message(s) for %s",
+                      len(messages), topic)
+            return
+        self.pending.setdefault(topic, []).extend(messages)
+        self.pending_count += len(messages)
+        if self.pending_count >= self.batch_size:
+            self._full.set()
+        self._schedule()
+
+    def _schedule(self):
+        if self.flusher is None and self.pending:
+            self.flusher = gevent.spawn(self._flush_later)
+
+    def _flush_later(self):
+        # Only one flusher runs at a time: messages published meanwhile are
+        # left for the next, which is started once this one is done.
+        try:
+            self._full.wait(self.batch_interval)
+            self._full.clear()
+            if not self.flush():
+                gevent.sleep(self.retry_delay)
+        finally:
+            self.flusher = None
+        self._schedule()
+
+    def flush(self):
+        """
+        Publish all the messages waiting to be published.
+
+        Returns whether they were all published. Those which weren't are
+        kept, and published with the next batch.
+        """
+        if not self._lock.acquire(timeout=self.flush_timeout):
+            log.warn("nsq writer is still publishing, flushing later")
+            self._schedule()
+            return False
+
+        failed = []
+        try:
+            pending, self.pending = self.pending, {}
+            self.pending_count = 0
+            for topic, messages in pending.items():
+                try:
+                    self._publish(topic, messages)
+                except Exception:
+                    log.error("can't publish %d message(s) to %s, will retry",
+                              len(messages), topic, exc_info=True)
+                    failed.append((topic, messages))
+        finally:
+            self._lock.release()
+
+        for topic, messages in failed:
+            self._requeue(topic, messages)
+        self._schedule()
+        return not failed
+
+    def _publish(self, topic, messages):
+        try:
+            self._publish_tcp(topic, messages)
+        except Exception:
+            log.warn("can't publish to nsqd over TCP, using HTTP",
+                     exc_info=True)
+            self.client.close_stream()
+            self.client.multipublish_http(topic, messages)
+
+    def _requeue(self, topic, messages):
+        # Failed messages go before those published since, and the oldest
+        # of them are dropped if they no longer fit.
+        room = max(self.max_pending - self.pending_count, 0)
+        if len(messages) > room:
+            dropped = len(messages) - room
+            self.dropped += dropped
+            log.error("nsq writer full, dropping %d message(s) for %s",
+                      dropped, topic)
+            messages = messages[dropped:]
+        if messages:
+            self.pending[topic] = messages + self.pending.get(topic, [])
+            self.pending_count += len(messages)
+
+    def _publish_tcp(self, topic, messages):
+        if not self.client.is_connected:
+            self.client.connect()
+            self.client.identify()
+        self.client.multipublish_tcp(topic, messages)
+        while True:
+            frame, data = self.client.read_response()
+            if frame == nsq.FRAME_TYPE_ERROR:
+                raise data
+            if data != nsq.HEARTBEAT:
+                break
+
+
+class PublishOutbox(object):
+    """
+    Publishes messages from a background greenlet, so that the caller
+    doesn't wait on nsqd, retrying while nsqd can't be reached.
+
+    At most ``maxsize`` messages are held. Messages put while the outbox is
+    full are dropped and logged, as are messages which still can't be
+    published after ``max_attempts`` attempts. ``gauge`` is an optional
+    statsd gauge to which the number of messages held is reported as
+    ``outbox``.
+    """
+
+    def __init__(self, maxsize=10000, retry_delay=0.5, max_retry_delay=30,
+                 max_attempts=10, gauge=None):
+        self.maxsize = maxsize
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.gauge = gauge
+        self.size = 0
+        self.dropped = 0
+        self.queue = gevent.queue.Queue()
+        self.worker = None
+
+    def put(self, writer, topic, messages):
+        """Publish ``messages`` to ``topic`` with ``writer``, soon."""
+        if self.size + len(messages) > self.maxsize:
+            self.dropped += len(messages)
+            log.error("queue outbox full, dropping %d message(s) for %s",
+                      len(messages), topic)
+            return
+        self.queue.put((writer, topic, messages))
+        self._resize(len(messages))
+        if self.worker is None:
+            self.worker = gevent.spawn(self._run)
+
+    def _run(self):
+        for writer, topic, messages in self.queue:
+            delay = self.retry_delay
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    writer.multipublish(topic, messages)
+                    break
+                except Exception:
+                    if attempt == self.max_attempts:
+                        self.dropped += len(messages)
+                        log.error("can't publish to %s, giving up after %d "
+                                  "attempts; dropped messages: %r",
+                                  topic, attempt, messages, exc_info=True)
+                        break
+                    log.warn("can't publish to %s, retrying in %ss",
+                             topic, delay, exc_info=True)
+                    gevent.sleep(delay)
+                    delay = min(delay * 2, self.max_retry_delay)
+            self._resize(-len(messages))
+
+    def _resize(self, delta):
+        self.size += delta
+        if self.gauge is not None:
+            self.gauge.send('outbox', self.size)
+
+
+def get_reader(request, topic, channel, **kwargs):
     """
     Get a :py:class:`gnsq.Reader` instance configured to connect to the
     nsqd reader addresses specified in settings. The reader will read from
-    the specified topic and channel.
+    the specified topic and channel. Other keyword arguments are passed to
+    the reader.
 
     The caller is responsible for adding appropriate `on_message` hooks and
     starting the reader.
@@ -27,7 +375,7 @@ def get_reader(request, topic, channel):
                                                  'localhost:4150'))
     if ns is not None:
         topic = '{0}-{1}'.format(ns, topic)
-    reader = gnsq.Reader(topic, channel, nsqd_tcp_addresses=addrs)
+    reader = gnsq.Reader(topic, channel, nsqd_tcp_addresses=addrs, **kwargs)
     return reader
 
 
@@ -36,15 +384,70 @@ def get_writer(request):
     Get a :py:class:`gnsq.Nsqd` instance configured to connect to the nsqd
     writer address configured in settings. The writer communicates over the
     nsq HTTP API and does not hold a connection open to the nsq instance.
+
+    If the ``nsq.writer.batch`` setting is true, a :py:class:`BatchWriter`
+    shared by the whole process is returned instead, which connects to the
+    nsqd TCP address in the ``nsq.writer.tcp_address`` setting, and holds at
+    most ``nsq.writer.max_pending`` messages.
     """
-    ns = request.registry.settings.get('nsq.namespace')
-    addr = request.registry.settings.get('nsq.writer.address',
-                                         'localhost:4151')
+    registry = request.registry
+    settings = registry.settings
+    if asbool(settings.get('nsq.writer.batch', False)):
+        writer = getattr(registry, 'queue_writer', None)
+        if writer is None:
+            writer = registry.queue_writer = _batch_writer(settings)
+        return writer
+
+    ns = settings.get('nsq.namespace')
+    addr = settings.get('nsq.writer.address', 'localhost:4151')
     hostname, port = addr.split(':', 1)
     nsqd = NamespacedNsqd(ns, hostname, http_port=port)
     return nsqd
 
 
+def _batch_writer(settings):
+    ns = settings.get('nsq.namespace')
+    addr = settings.get('nsq.writer.address', 'localhost:4151')
+    tcp_addr = settings.get('nsq.writer.tcp_address', 'localhost:4150')
+    http_port = addr.split(':', 1)[1]
+    hostname, tcp_port = tcp_addr.split(':', 1)
+    batch_size = int(settings.get('nsq.writer.batch_size', 100))
+    batch_interval = int(settings.get('nsq.writer.batch_interval', 50))
+    max_pending = int(settings.get('nsq.writer.max_pending', 10000))
+    return BatchWriter(ns, hostname,
+                       tcp_port=int(tcp_port),
+                       http_port=http_port,
+                       batch_size=batch_size,
+                       batch_interval=batch_interval / 1000.0,
+                       max_pending=max_pending)
+
+
+def get_outbox(request):
+    """
+    Get the :py:class:`PublishOutbox` shared by the process, which holds at
+    most the number of messages in the ``nsq.outbox.size`` setting, and
+    tries to publish them at most ``nsq.outbox.max_attempts`` times.
+    """
+    registry = request.registry
+    outbox = getattr(registry, 'queue_outbox', None)
+    if outbox is None:
+        settings = registry.settings
+        maxsize = int(settings.get('nsq.outbox.size', 10000))
+        max_attempts = int(settings.get('nsq.outbox.max_attempts', 10))
+        gauge = stats.get_client(request).get_gauge('queue')
+        outbox = registry.queue_outbox = PublishOutbox(
+            maxsize, max_attempts=max_attempts, gauge=gauge)
+    return outbox
+
+
 def includeme(config):
+    # Messages are plain JSON unless a codec is chosen with ``nsq.codec``,
+    # which should only be set once every consumer of the queue decodes
+    # messages with decode_message.
+    codec = config.registry.settings.get('nsq.codec')
+    if codec is not None and codec not in _codecs_by_name:
+        raise ValueError('Unknown queue message codec: {}'.format(codec))
+
     config.add_request_method(get_reader, name='get_queue_reader')
     config.add_request_method(get_writer, name='get_queue_writer')
+    config.add_request_method(get_outbox, name='get_queue_outbox')
@@ -1,33 +1,54 @@
 # -*- coding: utf-8 -*-
 import base64
-import copy
+import collections
 import json
 import logging
+import marshal
 import operator
+import os
 import random
 import re
+import socket as _socket
 import struct
+import time
 import unicodedata
 import weakref
+import zlib
 
 import gevent
+import gevent.event
 import gevent.queue
-from jsonpointer import resolve_pointer
+import gevent.server
+import gevent.socket
+from jsonpointer import JsonPointer, resolve_pointer
+from jwt.compat import constant_time_compare
 from jsonschema import validate
+from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import aslist
+from pyramid.decorator import reify
 from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden
+from pyramid.interfaces import IAuthenticationPolicy, IAuthorizationPolicy
+from pyramid.security import Allow
+from pyramid.settings import asbool
 from pyramid.threadlocal import get_current_request
 import transaction
 from ws4py.exc import HandshakeError
+from ws4py.framing import Frame, OPCODE_BINARY, OPCODE_CONTINUATION
+from ws4py.framing import OPCODE_TEXT
 from ws4py.websocket import WebSocket as _WebSocket
-from ws4py.server.wsgiutils import WebSocketWSGIApplication
+from ws4py.server.wsgiutils import WebSocketWSGIApplication as _WSGIApp
 
 from .api.auth import get_user  # FIXME: should not import from .api
+from .api.search import cursor_filter
 from annotator import document
 from .models import Annotation
+from .queue import decode_message
 
 log = logging.getLogger(__name__)
 
+# The number of events buffered for each streamer process by the relay
+RELAY_BUFFER_SIZE = 10000
+
 
 def uni_fold(text):
     # Convert str to unicode
@@ -39,9 +60,51 @@ def uni_fold(text):
         return text
 
     text = text.lower()
+
+    # ASCII text has no decompositions or combining characters
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        pass
+    else:
+        return text
+
     text = unicodedata.normalize('NFKD', text)
     return u"".join([c for c in text if not unicodedata.combining(c)])
 
+
+class FoldedAnnotation(object):
+    """
+    The values of an annotation's fields, folded with :func:`uni_fold` for
+    matching against filters.
+
+    Each field is resolved and folded the first time it is asked for, so
+    that one view of an annotation can be shared by all the filters it is
+    matched against.
+    """
+
+    def __init__(self, annotation):
+        self.annotation = annotation
+        self._folded = {}
+
+    def get(self, field):
+        """
+        Return the folded value of the field at a JSON pointer, folding
+        each item of a list, or None if there is no value there.
+        """
+        try:
+            return self._folded[field]
+        except KeyError:
+            pass
+
+        value = resolve_pointer(self.annotation, field, None)
+        if isinstance(value, list):
+            value = [uni_fold(v) for v in value]
+        else:
+            value = uni_fold(value)
+        self._folded[field] = value
+        return value
+
 filter_schema = {
     "type": "object",
     "properties": {
@@ -89,7 +152,8 @@ class FilterToElasticFilter(object):
         self.filter = filter_json
         self.query = {
             "sort": [
-                {"updated": {"order": "desc"}}
+                {"updated": {"order": "desc"}},
+                {"_uid": {"order": "desc"}}
             ],
             "query": {
                 "bool": {
@@ -301,8 +365,18 @@ setattr(operator, 'lenle', lenle)
 
 
 class FilterHandler(object):
+    """
+    Matches annotations against a filter.
+
+    The filter is compiled when the handler is created: field pointers are
+    checked, operators looked up and clause values folded once, rather than
+    for every annotation matched.
+    """
+
     def __init__(self, filter_json):
         self.filter = filter_json
+        self.clauses = tuple(self.compile_clause(c)
+                             for c in filter_json['clauses'])
 
     # operators
     operators = {
@@ -322,96 +396,96 @@ class FilterHandler(object):
         'lenle': 'lenle',
     }
 
-    def evaluate_clause(self, clause, target):
-        if isinstance(clause['field'], list):
-            for field in clause['field']:
-                copied = copy.deepcopy(clause)
-                copied['field'] = field
-                result = self.evaluate_clause(copied, target)
-                if result:
-                    return True
-            return False
+    @classmethod
+    def compile_clause(cls, clause):
+        """
+        Compile a clause to a ``(fields, op, value, reversed_order)``
+        tuple for :meth:`evaluate_clause`.
+        """
+        fields = clause['field']
+        if not isinstance(fields, list):
+            fields = [fields]
+        for field in fields:
+            JsonPointer(field)  # raises if the pointer is invalid
+        fields = tuple(fields)
+
+        op = getattr(operator, cls.operators[clause['operator']])
+
+        value = clause['value']
+        if isinstance(value, list):
+            value = [uni_fold(v) for v in value]
         else:
-            field_value = resolve_pointer(target, clause['field'], None)
-            if field_value is None:
-                return False
+            value = uni_fold(value)
 
-            cval = clause['value']
-            fval = field_value
+        # Determining operator order
+        # Normal order: field_value, clause['value']
+        # i.e. condition created > 2000.01.01
+        # Here clause['value'] = '2001.01.01'.
+        # The field_value is target['created']
+        # So the natural order is: ge(field_value, clause['value']
 
-            if isinstance(cval, list):
-                tval = []
-                for cv in cval:
-                    tval.append(uni_fold(cv))
-                cval = tval
-            else:
-                cval = uni_fold(cval)
+        # But!
+        # Reversed operator order for contains (b in a) when the clause
+        # value is a list. But not when the field value is a list too (i.e.
+        # tags matches 'b'), because an annotation can have many tags: that
+        # is decided for each annotation in evaluate_clause.
+        reversed_order = (clause['operator'] in ['one_of', 'matches'] and
+                          isinstance(value, list))
+
+        return fields, op, value, reversed_order
+
+    @staticmethod
+    def evaluate_clause(clause, target):
+        """
+        Evaluate a compiled clause against a :class:`FoldedAnnotation`.
+        """
+        fields, op, cval, reversed_order = clause
+        for field in fields:
+            fval = target.get(field)
+            if fval is None:
+                continue
 
             if isinstance(fval, list):
-                tval = []
-                for fv in fval:
-                    tval.append(uni_fold(fv))
-                fval = tval
+                result = op(fval, cval)
+            elif reversed_order:
+                result = op(cval, fval)
             else:
-                fval = uni_fold(fval)
-
-            reversed_order = False
-            # Determining operator order
-            # Normal order: field_value, clause['value']
-            # i.e. condition created > 2000.01.01
-            # Here clause['value'] = '2001.01.01'.
-            # The field_value is target['created']
-            # So the natural order is: ge(field_value, clause['value']
-
-            # But!
-            # Reversed operator order for contains (b in a)
-            if isinstance(cval, list) or isinstance(fval, list):
-                if clause['operator'] in ['one_of', 'matches']:
-                    reversed_order = True
-                    # But not in every case. (i.e. tags matches 'b')
-                    # Here field_value is a list, because an annotation can
-                    # have many tags.
-                    if isinstance(field_value, list):
-                        reversed_order = False
-
-            if reversed_order:
-                lval = cval
-                rval = fval
-            else:
-                lval = fval
-                rval = cval
+                result = op(fval, cval)
 
-            op = getattr(operator, self.operators[clause['operator']])
-            return op(lval, rval)
+            if result:
+                return True
+        return False
 
     # match_policies
     def include_any(self, target):
-        for clause in self.filter['clauses']:
+        for clause in self.clauses:
             if self.evaluate_clause(clause, target):
                 return True
         return False
 
     def include_all(self, target):
-        for clause in self.filter['clauses']:
+        for clause in self.clauses:
             if not self.evaluate_clause(clause, target):
                 return False
         return True
 
     def exclude_all(self, target):
-        for clause in self.filter['clauses']:
+        for clause in self.clauses:
             if not self.evaluate_clause(clause, target):
                 return True
         return False
 
     def exclude_any(self, target):
-        for clause in self.filter['clauses']:
+        for clause in self.clauses:
             if self.evaluate_clause(clause, target):
                 return False
         return True
 
     def match(self, target, action=None):
+        if not isinstance(target, FoldedAnnotation):
+            target = FoldedAnnotation(target)
         if not action or action == 'past' or action in self.filter['actions']:
-            if len(self.filter['clauses']) > 0:
+            if len(self.clauses) > 0:
                 return getattr(self, self.filter['match_policy'])(target)
             else:
                 return True
@@ -419,10 +493,558 @@ class FilterHandler(object):
             return False
 
 
+def _clause_index_values(clause):
+    """
+    Return the folded values one of which the field of a clause must have
+    for the clause to match, or None if the clause isn't that restrictive.
+    """
+    if not isinstance(clause['field'], basestring):
+        return None
+
+    operator_ = clause['operator']
+    value = clause['value']
+    if operator_ == 'equals' and not isinstance(value, list):
+        values = [value]
+    elif operator_ in ('one_of', 'matches') and isinstance(value, list):
+        values = value
+    else:
+        return None
+
+    try:
+        return frozenset(uni_fold(v) for v in values)
+    except TypeError:  # unhashable values can't be indexed
+        return None
+
+
+def _filter_index_keys(filter_json):
+    """
+    Return a list of ``(field, values)`` pairs such that an annotation can
+    only match the given filter if, for at least one of the pairs, the
+    folded value of the field is in the values. Return None if the filter
+    can't be described this way.
+    """
+    clauses = filter_json['clauses']
+    if not clauses:
+        return None
+
+    keys = [(c['field'], _clause_index_values(c)) for c in clauses]
+
+    if filter_json['match_policy'] == 'include_all':
+        # Every clause must match, so any one indexable clause will do.
+        # Prefer the /uri clause, which is what clients almost always send.
+        keys = [k for k in keys if k[1] is not None]
+        keys.sort(key=lambda k: k[0] != '/uri')
+        return keys[:1] or None
+
+    if filter_json['match_policy'] == 'include_any':
+        # Any clause may match, so they must all be indexable.
+        if any(values is None for _, values in keys):
+            return None
+        return keys
+
+    return None
+
+
+class SubscriptionIndex(object):
+    """
+    The set of connected sockets, indexed by the field values their filters
+    require of an annotation.
+
+    Most filters can only match annotations with one of a few values in
+    some field, typically the ``/uri`` clause a client sends for the page
+    it is on. Indexing sockets by those values lets a broadcast test each
+    event against just the sockets that could match it, rather than against
+    every connected socket. Sockets whose filters can't be indexed this way
+    are candidates for every event, and sockets with no filter for none.
+    """
+
+    def __init__(self):
+        self._sockets = weakref.WeakSet()
+        self._unindexed = weakref.WeakSet()
+        self._index = {}  # field -> folded value -> sockets
+        self._entries = weakref.WeakKeyDictionary()
+
+    def __iter__(self):
+        return iter(self._sockets)
+
+    def __len__(self):
+        return len(self._sockets)
+
+    def add(self, socket):
+        self._sockets.add(socket)
+        self.update(socket)
+
+    def discard(self, socket):
+        self._sockets.discard(socket)
+        self._unindex(socket)
+
+    def update(self, socket):
+        """Re-index a socket, after its filter has changed."""
+        self._unindex(socket)
+        if socket.filter is None:
+            return
+
+        keys = _filter_index_keys(socket.filter.filter)
+        if keys is None:
+            self._unindexed.add(socket)
+            return
+
+        entries = []
+        for field, values in keys:
+            by_value = self._index.setdefault(field, {})
+            for value in values:
+                by_value.setdefault(value, weakref.WeakSet()).add(socket)
+                entries.append((field, value))
+        self._entries[socket] = entries
+
+    def candidates(self, annotation):
+        """
+        Return the sockets whose filters could match an annotation, or a
+        :class:`FoldedAnnotation` of one.
+        """
+        found = set(self._unindexed)
+        for sockets in _index_lookup(self._index, annotation):
+            found.update(sockets)
+        return found
+
+    def _unindex(self, socket):
+        self._unindexed.discard(socket)
+        for field, value in self._entries.pop(socket, ()):
+            by_value = self._index[field]
+            sockets = by_value[value]
+            sockets.discard(socket)
+            if not sockets:
+                del by_value[value]
+                if not by_value:
+                    del self._index[field]
+
+
+def _index_lookup(index, annotation):
+    """
+    Yield the collections in an index of ``field -> folded value -> items``
+    which hold items that could match an annotation, or a
+    :class:`FoldedAnnotation` of one.
+    """
+    if not isinstance(annotation, FoldedAnnotation):
+        annotation = FoldedAnnotation(annotation)
+    for field, by_value in index.items():
+        value = annotation.get(field)
+        if value is None:
+            continue
+        try:
+            items = by_value.get(value)
+        except TypeError:
+            # An unhashable value, such as a list, isn't compared by
+            # equality, so any item indexed on the field could match.
+            for items in by_value.values():
+                yield items
+        else:
+            if items is not None:
+                yield items
+
+
+class Outbox(object):
+    """
+    A bounded queue of messages waiting to be written to a socket.
+
+    The policy decides what happens when a message is put in a full outbox:
+
+    ``drop_oldest``
+        the oldest queued message is dropped
+    ``coalesce``
+        a queued message with the same key as the new one is dropped, or
+        failing that the oldest queued message
+    ``disconnect``
+        the new message is refused, and the socket should be disconnected
+    """
+
+    policies = ('drop_oldest', 'coalesce', 'disconnect')
+
+    def __init__(self, maxsize, policy='drop_oldest'):
+        if policy not in self.policies:
+            raise ValueError('Unknown overflow policy: {}'.format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.messages = collections.deque()
+        self.dropped = 0
+        self._ready = gevent.event.Event()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def full(self):
+        return len(self.messages) >= self.maxsize
+
+    def put(self, message, key=None):
+        """Queue a message, returning False if it was refused."""
+        if self.full():
+            if self.policy == 'disconnect':
+                return False
+            if not (self.policy == 'coalesce' and self._remove(key)):
+                self.messages.popleft()
+            self.dropped += 1
+        self.messages.append((key, message))
+        self._ready.set()
+        return True
+
+    def get(self):
+        """Wait for and return the oldest queued message."""
+        while not self.messages:
+            self._ready.clear()
+            self._ready.wait()
+        return self.messages.popleft()[1]
+
+    def _remove(self, key):
+        if key is None:
+            return False
+        for item in self.messages:
+            if item[0] == key:
+                self.messages.remove(item)
+                return True
+        return False
+
+
+class PerMessageDeflate(object):
+    """
+    The state of the permessage-deflate extension (RFC 7692) on a socket.
+
+    Messages to the client of at least ``threshold`` bytes are compressed,
+    with one compression context kept for the life of the socket unless
+    the client asked for ``server_no_context_takeover``.
+
+    ws4py doesn't know about the extension, and rejects frames with the
+    RSV1 bit set, which marks a compressed message. So frames from the
+    client are passed through :meth:`feed` first, which replaces each
+    compressed message with a plain frame for ws4py to parse.
+    """
+
+    # The largest message from the client that will be inflated
+    max_message_size = 1024 * 1024
+
+    _tail = b'\x00\x00\xff\xff'
+
+    def __init__(self, threshold=1024, no_context_takeover=False,
+                 max_window_bits=15):
+        self.threshold = threshold
+        self.no_context_takeover = no_context_takeover
+        self.max_window_bits = max_window_bits
+        self.wanted = 2
+
+        self._compressor = None
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = b''
+        self._message = None
+
+    def compress(self, data):
+        """Compress the payload of a message."""
+        if self._compressor is None or self.no_context_takeover:
+            self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                                zlib.DEFLATED,
+                                                -self.max_window_bits)
+        data = (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        return data[:-len(self._tail)]
+
+    def decompress(self, data):
+        """Decompress the payload of a message from the client."""
+        data = self._decompressor.decompress(data + self._tail,
+                                             self.max_message_size)
+        if self._decompressor.unconsumed_tail:
+            raise ValueError('Compressed message is too large')
+        return data
+
+    def feed(self, data):
+        """
+        Take bytes from the client, and return the bytes of the frames
+        read so far, with compressed messages decompressed.
+        """
+        self._buffer += data
+        frames = []
+        while True:
+            frame = self._read_frame()
+            if frame is None:
+                return frames
+            raw, fin, rsv1, opcode, payload = frame
+
+            if opcode in (OPCODE_TEXT, OPCODE_BINARY) and rsv1:
+                self._message = (opcode, [payload])
+            elif opcode == OPCODE_CONTINUATION and self._message is not None:
+                self._message[1].append(payload)
+            else:
+                frames.append(raw)
+                continue
+
+            if fin:
+                opcode, payloads = self._message
+                self._message = None
+                body = self.decompress(b''.join(payloads))
+                # ws4py expects frames from the client to be masked
+                frame = Frame(opcode, body, masking_key=b'\x00' * 4, fin=1)
+                frames.append(frame.build())
+
+    def _read_frame(self):
+        buf = self._buffer
+        if len(buf) < 2:
+            self.wanted = 2 - len(buf)
+            return None
+
+        first, second = ord(buf[0]), ord(buf[1])
+        length = second & 0x7f
+        offset = 2
+        if length == 126:
+            offset = 4
+        elif length == 127:
+            offset = 10
+        if len(buf) < offset:
+            self.wanted = offset - len(buf)
+            return None
+        if length == 126:
+            length = struct.unpack('!H', buf[2:4])[0]
+        elif length == 127:
+            length = struct.unpack('!Q', buf[2:10])[0]
+
+        masking_key = None
+        if second & 0x80:
+            masking_key = buf[offset:offset + 4]
+            offset += 4
+
+        end = offset + length
+        if len(buf) < end:
+            self.wanted = end - len(buf)
+            return None
+
+        self._buffer = buf[end:]
+        self.wanted = 2
+        payload = buf[offset:end]
+        if masking_key is not None:
+            payload = bytes(Frame(masking_key=masking_key).unmask(payload))
+        return (buf[:end], first >> 7, (first >> 6) & 1, first & 0x0f,
+                payload)
+
+
+def negotiate_deflate(offers, threshold=1024):
+    """
+    Return the ``Sec-WebSocket-Extensions`` response header value accepting
+    the first acceptable permessage-deflate offer in the request header
+    value ``offers``, and a :class:`PerMessageDeflate` for the socket, or
+    None if there is no acceptable offer.
+    """
+    for offer in offers.split(','):
+        params = [p.strip() for p in offer.split(';')]
+        if params[0] != 'permessage-deflate':
+            continue
+
+        response = ['permessage-deflate']
+        no_context_takeover = False
+        max_window_bits = zlib.MAX_WBITS
+        try:
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                value = value.strip('"')
+                if name == 'server_no_context_takeover' and not value:
+                    no_context_takeover = True
+                    response.append(name)
+                elif name == 'server_max_window_bits':
+                    max_window_bits = int(value)
+                    # zlib can't compress with a window of 8 bits
+                    if not 9 <= max_window_bits <= 15:
+                        raise ValueError(param)
+                    response.append(param)
+                elif name == 'client_max_window_bits':
+                    # We always accept the largest window from the client
+                    if value and not 8 <= int(value) <= 15:
+                        raise ValueError(param)
+                elif name == 'client_no_context_takeover' and not value:
+                    pass
+                else:
+                    raise ValueError(param)
+        except ValueError:
+            continue
+
+        deflate = PerMessageDeflate(threshold=threshold,
+                                    no_context_takeover=no_context_takeover,
+                                    max_window_bits=max_window_bits)
+        return '; '.join(response), deflate
+
+    return None
+
+
+class WebSocketWSGIApplication(_WSGIApp):
+    """
+    The websocket WSGI application, which optionally negotiates the
+    permessage-deflate extension with the client.
+    """
+
+    def __init__(self, deflate=False, deflate_threshold=1024, **kwargs):
+        super(WebSocketWSGIApplication, self).__init__(**kwargs)
+        self.deflate = deflate
+        self.deflate_threshold = deflate_threshold
+
+    def __call__(self, environ, start_response):
+        offers = environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
+        negotiated = None
+        if self.deflate and offers:
+            negotiated = negotiate_deflate(offers, self.deflate_threshold)
+        if negotiated is None:
+            return super(WebSocketWSGIApplication, self).__call__(
+                environ, start_response)
+
+        # ws4py only accepts extensions that it was given and which the
+        # client offers without parameters, so it won't accept this itself.
+        header, deflate = negotiated
+        environ['h.ws.deflate'] = deflate
+
+        def _start_response(status, headers, exc_info=None):
+            if status.startswith('101'):
+                headers = headers + [('Sec-WebSocket-Extensions', header)]
+            return start_response(status, headers, exc_info)
+
+        return super(WebSocketWSGIApplication, self).__call__(
+            environ, _start_response)
+
+
+class PastResultsCache(object):
+    """
+    A short-lived cache of the "past" packets sent in reply to the filters
+    of sockets, which also collapses concurrent requests for the same
+    packet into a single search.
+
+    Entries are dropped when an annotation event matching their filter
+    arrives, so that they don't miss the annotation. A search which is in
+    progress when such an event arrives still returns its results to the
+    sockets waiting for them, but they aren't cached. Entries are indexed
+    by the field values their filters require, as sockets are in a
+    :class:`SubscriptionIndex`, so that an event is only matched against
+    the filters it could match.
+    """
+
+    def __init__(self, ttl=2, maxsize=1000, clock=time.time):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._flights = {}
+        self._index = {}  # field -> folded value -> keys
+        self._unindexed = set()
+        self._index_entries = {}
+
+    def get(self, key, filter_handler, fetch):
+        """
+        Return the cached result for ``key``, or else the result of
+        ``fetch()``, which is cached until an event matching
+        ``filter_handler`` arrives or the TTL expires. Without a filter
+        handler the result can't be invalidated, so isn't cached.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, _, result = entry
+            if expires > self.clock():
+                self.hits += 1
+                return result
+            self._remove(key)
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.hits += 1
+            return flight['result'].get()
+
+        self.misses += 1
+        flight = self._flights[key] = {
+            'filter': filter_handler,
+            'result': gevent.event.AsyncResult(),
+            'stale': False,
+        }
+        try:
+            result = fetch()
+        except Exception as exc:
+            flight['result'].set_exception(exc)
+            raise
+        finally:
+            del self._flights[key]
+        flight['result'].set(result)
+
+        cacheable = filter_handler is not None and not flight['stale']
+        if self.ttl > 0 and cacheable:
+            self._add(key, (self.clock() + self.ttl, filter_handler, result))
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+        return result
+
+    def invalidate(self, annotation):
+        """Drop the results whose filters match an annotation."""
+        self._expire()
+        candidates = set(self._unindexed)
+        for keys in _index_lookup(self._index, annotation):
+            candidates.update(keys)
+        for key in candidates:
+            _, filter_handler, _ = self._entries[key]
+            if filter_handler.match(annotation):
+                self._remove(key)
+        for flight in self._flights.values():
+            if flight['filter'] is None or flight['filter'].match(annotation):
+                flight['stale'] = True
+
+    def clear(self):
+        self._entries.clear()
+        self._index.clear()
+        self._unindexed.clear()
+        self._index_entries.clear()
+
+    def _expire(self):
+        # Entries are kept in the order they were added, and so expire in
+        # that order too.
+        now = self.clock()
+        while self._entries:
+            key, (expires, _, _) = next(self._entries.iteritems())
+            if expires > now:
+                break
+            self._remove(key)
+
+    def _add(self, key, entry):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        keys = _filter_index_keys(entry[1].filter)
+        if keys is None:
+            self._unindexed.add(key)
+            return
+        index_entries = []
+        for field, values in keys:
+            by_value = self._index.setdefault(field, {})
+            for value in values:
+                by_value.setdefault(value, set()).add(key)
+                index_entries.append((field, value))
+        self._index_entries[key] = index_entries
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._unindexed.discard(key)
+        for field, value in self._index_entries.pop(key, ()):
+            by_value = self._index[field]
+            keys = by_value[value]
+            keys.discard(key)
+            if not keys:
+                del by_value[value]
+                if not by_value:
+                    del self._index[field]
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+past_cache = PastResultsCache()
+
+
 class WebSocket(_WebSocket):
     # Class attributes
     event_queue = None
-    instances = weakref.WeakSet()
+    instances = SubscriptionIndex()
     origins = []
 
     # Instance attributes
@@ -431,13 +1053,37 @@ class WebSocket(_WebSocket):
     request = None
     query = None
 
-    offsetFrom = 0
+    cursor = None
     received = 0
 
+    # Messages to the client are queued, and written by a greenlet for each
+    # socket, so that a slow client only holds up its own messages. See
+    # Outbox for the overflow policies.
+    outbox_size = 100
+    overflow_policy = 'drop_oldest'
+    outbox = None
+    writer = None
+    disconnected = False
+
+    # If set, annotation events are held back for this many seconds, and
+    # only the latest event for each annotation in that time is sent.
+    coalesce_window = 0
+    pending = None
+
+    # The PerMessageDeflate state, if the extension was negotiated
+    deflate = None
+    _parser_wants = None
+
+    # If set, annotation events are read from the relay listening on this
+    # unix socket, rather than from a queue reader of this process's own.
+    relay_socket = None
+
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('heartbeat_freq', 30.0)
         super(WebSocket, self).__init__(*args, **kwargs)
         self.request = get_current_request()
+        if self.environ is not None:
+            self.deflate = self.environ.get('h.ws.deflate')
 
     def __new__(cls, *args, **kwargs):
         instance = super(WebSocket, cls).__new__(cls, *args, **kwargs)
@@ -447,10 +1093,13 @@ class WebSocket(_WebSocket):
     @classmethod
     def start_reader(cls, request):
         cls.event_queue = gevent.queue.Queue()
-        reader_id = 'stream-{}#ephemeral'.format(_random_id())
-        reader = request.get_queue_reader('annotations', reader_id)
-        reader.on_message.connect(cls.on_queue_message)
-        reader.start(block=False)
+        if cls.relay_socket:
+            gevent.spawn(read_relay, cls.relay_socket, cls.event_queue)
+        else:
+            reader_id = 'stream-{}#ephemeral'.format(_random_id())
+            reader = request.get_queue_reader('annotations', reader_id)
+            reader.on_message.connect(cls.on_queue_message)
+            reader.start(block=False)
         gevent.spawn(broadcast_from_queue, cls.event_queue, cls.instances)
 
     @classmethod
@@ -464,15 +1113,179 @@ class WebSocket(_WebSocket):
         if self.event_queue is None:
             self.start_reader(self.request)
 
+    def send(self, payload, binary=False):
+        deflate = self.deflate
+        if deflate is not None and isinstance(payload, basestring):
+            if isinstance(payload, unicode):
+                payload = payload.encode('utf-8')
+            if len(payload) >= deflate.threshold:
+                opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+                frame = Frame(opcode, deflate.compress(payload), fin=1,
+                              rsv1=1)
+                self._write(frame.build())
+                return
+        super(WebSocket, self).send(payload, binary)
+
+    def process(self, bytes):
+        deflate = self.deflate
+        if deflate is None:
+            return super(WebSocket, self).process(bytes)
+
+        if not bytes and self.reading_buffer_size > 0:
+            return False
+
+        try:
+            frames = deflate.feed(bytes)
+        except (ValueError, zlib.error):
+            log.exception("Decompressing streamer message")
+            self.close(1007, 'Invalid compressed message')
+            return False
+
+        # Give ws4py's parser the frames in the sized pieces it asks for, as
+        # it would have read them from the socket itself, then read as much
+        # from the socket as is needed to complete the next frame.
+        for frame in frames:
+            while frame:
+                wants = self._parser_wants or self.reading_buffer_size
+                if not super(WebSocket, self).process(frame[:wants]):
+                    return False
+                self._parser_wants = self.reading_buffer_size
+                frame = frame[wants:]
+        self.reading_buffer_size = deflate.wanted
+        return True
+
+    def closed(self, code, reason=None):
+        self.instances.discard(self)
+        if self.writer is not None:
+            self.writer.kill(block=False)
+
+    def enqueue(self, data, key=None):
+        """
+        Queue a message to be sent to the client.
+
+        Messages about the same thing, such as the same annotation, should
+        be given the same key, which the ``coalesce`` overflow policy uses.
+        """
+        if self.disconnected:
+            return
+
+        if self.outbox is None:
+            self.outbox = Outbox(self.outbox_size, self.overflow_policy)
+            self.writer = gevent.spawn(self._write_outbox)
+
+        full = self.outbox.full()
+        if not self.outbox.put((time.time(), data), key):
+            # Don't try to send a close frame to a client that isn't reading
+            log.info("disconnecting slow streamer client %s", self.client_id)
+            fanout_stats.disconnected += 1
+            # The socket isn't terminated until ws4py notices the connection
+            # is closed, so take it out of broadcasts now.
+            self.disconnected = True
+            self.instances.discard(self)
+            self.writer.kill(block=False)
+            self.close_connection()
+        elif full:
+            fanout_stats.dropped += 1
+
+    def coalesce(self, annotation, action):
+        """
+        Queue an annotation event to be sent at the end of the coalescing
+        window, in place of any earlier event for the same annotation.
+        """
+        if self.pending is None:
+            self.pending = collections.OrderedDict()
+            gevent.spawn_later(self.coalesce_window, self.flush_pending)
+
+        key = annotation.get('id') or id(annotation)
+        if self.pending.pop(key, None) is not None:
+            fanout_stats.coalesced += 1
+        self.pending[key] = (action, annotation)
+
+    def flush_pending(self):
+        """
+        Send the events held back by :meth:`coalesce`, in a packet for each
+        action.
+        """
+        pending, self.pending = self.pending, None
+        if not pending or self.terminated:
+            return
+
+        by_action = collections.OrderedDict()
+        for action, annotation in pending.values():
+            by_action.setdefault(action, []).append(annotation)
+        for action, annotations in by_action.items():
+            packet = _annotation_packet(annotations, action)
+            self.enqueue(json.dumps(packet))
+
+    def _write_outbox(self):
+        while not self.terminated:
+            queued, data = self.outbox.get()
+            try:
+                self.send(data)
+            except Exception:
+                if not self.terminated:
+                    log.exception("Sending to streamer client %s",
+                                  self.client_id)
+                return
+            fanout_stats.record_write(time.time() - queued)
+
+    @reify
+    def effective_principals(self):
+        """
+        The effective principals of the socket's request, against which to
+        check annotation ACLs, or None if permissions for the request can't
+        be decided that way.
+
+        The request of a socket, and so its principals, don't change once
+        it is open, so these are only worked out once.
+        """
+        registry = self.request.registry
+        authn_policy = registry.queryUtility(IAuthenticationPolicy)
+        authz_policy = registry.queryUtility(IAuthorizationPolicy)
+        if authn_policy is None:
+            return None
+        if not isinstance(authz_policy, ACLAuthorizationPolicy):
+            return None
+        return frozenset(self.request.effective_principals)
+
     def send_annotations(self):
         request = self.request
         user = get_user(request)
-        annotations = Annotation.search_raw(query=self.query.query, user=user)
-        self.received = len(annotations)
 
-        packet = _annotation_packet(annotations, 'past')
-        data = json.dumps(packet)
-        self.send(data)
+        # Page on from the last annotation sent rather than with an offset,
+        # so that deep pages cost no more than the first one.
+        query = dict(self.query.query)
+        if self.cursor is not None:
+            query['query'] = {
+                'filtered': {
+                    'query': query['query'],
+                    'filter': cursor_filter('updated', 'desc', self.cursor),
+                }
+            }
+
+        def fetch():
+            results = Annotation.search_raw(query=query, user=user,
+                                            raw_result=True)
+            docs = results['hits']['hits']
+            annotations = [Annotation(d['_source'], id=d['_id'])
+                           for d in docs]
+            cursor = docs[-1]['sort'] if docs else None
+            packet = _annotation_packet(annotations, 'past')
+            return json.dumps(packet), len(annotations), cursor
+
+        # Clients opening the same page at the same time send the same
+        # filter, so share the results between them.
+        if user is None:
+            user_key = None
+        else:
+            user_key = (user.id, user.consumer.key, user.is_admin)
+        key = (json.dumps(query, sort_keys=True), user_key)
+        data, received, cursor = past_cache.get(key, self.filter, fetch)
+
+        self.received = received
+        if cursor is not None:
+            self.cursor = cursor
+        self.enqueue(data)
 
     def _expand_clauses(self, payload):
         for clause in payload['clauses']:
@@ -506,7 +1319,6 @@ class WebSocket(_WebSocket):
 
             if msg_type == 'filter':
                 payload = data['filter']
-                self.offsetFrom = 0
 
                 # Let's try to validate the schema
                 validate(payload, filter_schema)
@@ -516,15 +1328,14 @@ class WebSocket(_WebSocket):
 
                 self.filter = FilterHandler(payload)
                 self.query = FilterToElasticFilter(payload, self.request)
-                self.offsetFrom = 0
+                self.cursor = None
+                self.instances.update(self)
             elif msg_type == 'more_hits':
                 if self.query is not None:
                     more_hits = data.get('moreHits', 10)
 
-                    self.query.query['from'] = self.offsetFrom
                     self.query.query['size'] = more_hits
                     self.send_annotations()
-                    self.offsetFrom += self.received
             elif msg_type == 'client_id':
                 self.client_id = data.get('value')
         except:
@@ -547,27 +1358,349 @@ def _annotation_packet(annotations, action):
     }
 
 
+class FanoutStats(object):
+    """
+    Counters for the queue messages fanned out to sockets in this process:
+    the time spent on them, how long they waited in the queue beforehand,
+    and how long the messages sent to sockets waited in their outboxes.
+
+    The message rate is over the last ``rate_window`` seconds, and the
+    percentiles of each timing are of its last ``samples`` values, so that
+    they describe how the process is doing now rather than since it
+    started.
+    """
+
+    percentiles = (50, 95, 99)
+
+    def __init__(self, clock=time.time, rate_window=60, samples=1000):
+        self.clock = clock
+        self.rate_window = rate_window
+        self.samples = samples
+        self.reset()
+
+    def reset(self):
+        self.since = self.clock()
+        self._counts = collections.deque()
+        self._recent = {
+            'seconds': collections.deque(maxlen=self.samples),
+            'lag_seconds': collections.deque(maxlen=self.samples),
+            'write_seconds': collections.deque(maxlen=self.samples),
+        }
+        self.messages = 0
+        self.sockets = 0
+        self.sent = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
+        self.writes = 0
+        self.write_seconds = 0.0
+        self.max_write_seconds = 0.0
+        self.dropped = 0
+        self.disconnected = 0
+        self.coalesced = 0
+
+    def record(self, seconds, sockets, sent, lag=0.0):
+        self.messages += 1
+        self.sockets += sockets
+        self.sent += sent
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.lag_seconds += lag
+        self.max_lag_seconds = max(self.max_lag_seconds, lag)
+        self._recent['seconds'].append(seconds)
+        self._recent['lag_seconds'].append(lag)
+
+        # Messages are counted per second, for the rate over the window
+        second = int(self.clock())
+        if self._counts and self._counts[-1][0] == second:
+            self._counts[-1][1] += 1
+        else:
+            self._counts.append([second, 1])
+        self._expire(second)
+
+    def record_write(self, seconds):
+        """Record the time from queueing a message to writing it."""
+        self.writes += 1
+        self.write_seconds += seconds
+        self.max_write_seconds = max(self.max_write_seconds, seconds)
+        self._recent['write_seconds'].append(seconds)
+
+    def _expire(self, now):
+        while self._counts and self._counts[0][0] <= now - self.rate_window:
+            self._counts.popleft()
+
+    def stats(self):
+        now = self.clock()
+        self._expire(now)
+        window = min(now - self.since, self.rate_window)
+        recent = sum(count for _, count in self._counts)
+        result = {
+            'messages': self.messages,
+            'messages_per_second': _ratio(recent, window),
+            'sockets': self.sockets,
+            'sent': self.sent,
+            'match_rate': _ratio(self.sent, self.sockets),
+            'seconds': self.seconds,
+            'mean_seconds': _ratio(self.seconds, self.messages),
+            'max_seconds': self.max_seconds,
+            'mean_lag_seconds': _ratio(self.lag_seconds, self.messages),
+            'max_lag_seconds': self.max_lag_seconds,
+            'writes': self.writes,
+            'mean_write_seconds': _ratio(self.write_seconds, self.writes),
+            'max_write_seconds': self.max_write_seconds,
+            'dropped': self.dropped,
+            'disconnected': self.disconnected,
+            'coalesced': self.coalesced,
+        }
+        for name, samples in self._recent.items():
+            ordered = sorted(samples)
+            for p in self.percentiles:
+                key = 'p{}_{}'.format(p, name)
+                result[key] = _percentile(ordered, p)
+        return result
+
+
+def _ratio(a, b):
+    return float(a) / b if b else 0.0
+
+
+def _percentile(ordered, p):
+    """Return the ``p``th percentile of a sorted list, by nearest rank."""
+    if not ordered:
+        return 0.0
+    return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+
+
+def outbox_stats(sockets):
+    """Return the depths of the outboxes of some sockets."""
+    depths = [len(s.outbox) for s in sockets if s.outbox is not None]
+    return {
+        'outboxes': len(depths),
+        'queued': sum(depths),
+        'max_queued': max(depths) if depths else 0,
+    }
+
+
+fanout_stats = FanoutStats()
+
+
+class ReadACL(object):
+    """
+    Decides who may read an annotation, by checking principals against the
+    entries of its ACL which grant or deny the read permission, in the same
+    way that :class:`pyramid.authorization.ACLAuthorizationPolicy` does.
+
+    The ACL is only evaluated once, when first needed, so that a broadcast
+    can check the principals of every socket against it rather than run
+    the authorization policy for each of them.
+    """
+
+    def __init__(self, annotation):
+        self.annotation = annotation
+
+    @reify
+    def entries(self):
+        acl = self.annotation.__acl__
+        if callable(acl):
+            acl = acl()
+        entries = []
+        for action, principal, permissions in acl:
+            if isinstance(permissions, basestring):
+                permissions = [permissions]
+            if 'read' in permissions:
+                entries.append((action == Allow, principal))
+        return entries
+
+    @reify
+    def allowed(self):
+        # Without any deny entries the order of the entries doesn't matter.
+        if all(allow for allow, _ in self.entries):
+            return frozenset(principal for _, principal in self.entries)
+        return None
+
+    def permits(self, principals):
+        if self.allowed is not None:
+            return not self.allowed.isdisjoint(principals)
+        for allow, principal in self.entries:
+            if principal in principals:
+                return allow
+        return False
+
+
+class QueueEvent(object):
+    """
+    An annotation event from the queue, parsed once however many sockets
+    it is broadcast to.
+
+    ``timestamp`` is when NSQ received the message, in nanoseconds.
+    """
+
+    def __init__(self, data, timestamp=None, packet=None):
+        self.data = data
+        self.timestamp = timestamp
+        if packet is not None:
+            self.packet = packet
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(decode_message(message.body),
+                   getattr(message, 'timestamp', None))
+
+    @reify
+    def annotation(self):
+        return Annotation(**self.data['annotation'])
+
+    @reify
+    def packet(self):
+        """The serialized packet to send to sockets."""
+        payload = _annotation_packet([self.annotation], self.data['action'])
+        return json.dumps(payload)
+
+
 def broadcast_from_queue(queue, sockets):
     """
     Pulls messages from a passed queue object, and handles dispatching them to
     appropriate active sessions.
+
+    The queue may hold NSQ messages or :class:`QueueEvent` objects.
     """
     for message in queue:
-        data_in = json.loads(message.body)
+        if isinstance(message, QueueEvent):
+            event = message
+        else:
+            event = QueueEvent.from_message(message)
+        data_in = event.data
         action = data_in['action']
-        annotation = Annotation(**data_in['annotation'])
-        payload = _annotation_packet([annotation], action)
-        data_out = json.dumps(payload)
-        for socket in list(sockets):
-            if should_send_event(socket, annotation, data_in):
-                socket.send(data_out)
+        if action == 'read':
+            continue
+
+        start = time.time()
+        timestamp = event.timestamp
+        lag = start - timestamp / 1e9 if timestamp else 0.0
+
+        annotation = event.annotation
+        read_acl = ReadACL(annotation)
+        folded = FoldedAnnotation(annotation)
+        past_cache.invalidate(folded)
+        data_out = event.packet
+        if isinstance(sockets, SubscriptionIndex):
+            candidates = sockets.candidates(folded)
+        else:
+            candidates = list(sockets)
+        sent = 0
+        for socket in candidates:
+            if should_send_event(socket, annotation, data_in, read_acl,
+                                 folded):
+                if socket.coalesce_window:
+                    socket.coalesce(annotation, action)
+                else:
+                    socket.enqueue(data_out, key=annotation.get('id'))
+                sent += 1
+        fanout_stats.record(time.time() - start, len(candidates), sent, lag)
+
+
+def _relay_frame(event):
+    """Serialize a :class:`QueueEvent` for passing to a streamer process."""
+    data = marshal.dumps((dict(event.data), event.timestamp, event.packet))
+    return struct.pack('!I', len(data)) + data
+
+
+def relay(request):
+    """
+    Read annotation events from the queue once for the host, and pass them
+    on to the streamer processes connected to the unix socket at the
+    ``h.streamer.relay_socket`` setting, already parsed and serialized.
 
+    Streamer processes read the events from the socket, rather than each
+    from its own queue reader, when the setting is given to them too.
+    """
+    path = request.registry.settings['h.streamer.relay_socket']
+    clients = set()
 
-def should_send_event(socket, annotation, event_data):
+    def handle_client(sock, address):
+        frames = gevent.queue.Queue(RELAY_BUFFER_SIZE)
+        clients.add(frames)
+        try:
+            while True:
+                sock.sendall(frames.get())
+        except _socket.error:
+            log.info("streamer process disconnected from relay")
+        finally:
+            clients.discard(frames)
+            sock.close()
+
+    def handle_message(reader, message=None):
+        if message is None:
+            return
+        event = QueueEvent.from_message(message)
+        if event.data['action'] == 'read':
+            return
+        frame = _relay_frame(event)
+        for frames in list(clients):
+            try:
+                frames.put_nowait(frame)
+            except gevent.queue.Full:
+                log.warn("streamer process too slow, dropping relayed event")
+
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = gevent.socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+    server = gevent.server.StreamServer(listener, handle_client)
+    server.start()
+
+    reader_id = 'stream-relay-{}#ephemeral'.format(_random_id())
+    reader = request.get_queue_reader('annotations', reader_id)
+    reader.on_message.connect(handle_message)
+    try:
+        reader.start(block=True)
+    finally:
+        server.stop()
+
+
+def read_relay(path, queue, retry_delay=1):
+    """
+    Put the events passed on by the relay at the unix socket ``path`` into
+    ``queue``, reconnecting if the connection is lost.
+    """
+    while True:
+        sock = gevent.socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            stream = sock.makefile('rb')
+            while True:
+                header = stream.read(4)
+                if len(header) != 4:
+                    break
+                length, = struct.unpack('!I', header)
+                frame = stream.read(length)
+                if len(frame) != length:
+                    # A short read means the relay went away mid-frame
+                    break
+                data, timestamp, packet = marshal.loads(frame)
+                queue.put(QueueEvent(data, timestamp, packet))
+        except _socket.error as exc:
+            log.warn("can't read from streamer relay at %s: %s", path, exc)
+        except (EOFError, TypeError, ValueError) as exc:
+            log.warn("bad frame from streamer relay at %s: %s", path, exc)
+        finally:
+            sock.close()
+        gevent.sleep(retry_delay)
+
+
+def should_send_event(socket, annotation, event_data, read_acl=None,
+                      folded=None):
     """
     Inspects the passed annotation and action and decides whether or not
     the underlying session should receive the event. If it should, the
     action is wrapped up in a websocket packet and sent to the client.
+
+    A :class:`ReadACL` for the annotation, shared between the sockets that
+    a message is broadcast to, saves checking the read permission of each
+    socket with its request's authorization policy. Likewise a shared
+    :class:`FoldedAnnotation` saves folding its fields for each socket.
     """
     if socket.terminated:
         return False
@@ -578,14 +1711,20 @@ def should_send_event(socket, annotation, event_data):
     if event_data['src_client_id'] == socket.client_id:
         return False
 
-    if not socket.request.has_permission('read', annotation):
+    principals = socket.effective_principals if read_acl else None
+    if principals is not None:
+        if not read_acl.permits(principals):
+            return False
+    elif not socket.request.has_permission('read', annotation):
         return False
 
     # We don't send anything until we have received a filter from the client
     if socket.filter is None:
         return False
 
-    if not socket.filter.match(annotation, event_data['action']):
+    if folded is None:
+        folded = FoldedAnnotation(annotation)
+    if not socket.filter.match(folded, event_data['action']):
         return False
 
     return True
@@ -609,16 +1748,66 @@ def websocket(request):
     return request.get_response(request.registry.websocket)
 
 
+def stats(request):
+    """
+    Report on the streamer in this worker process, to requests which give
+    the ``h.streamer.stats_token`` setting in the ``X-Stats-Token`` header.
+    """
+    token = request.registry.settings.get('h.streamer.stats_token')
+    given = request.headers.get('X-Stats-Token', '')
+    if not token or not constant_time_compare(given, token):
+        raise HTTPForbidden()
+
+    sockets = list(WebSocket.instances)
+    event_queue = WebSocket.event_queue
+    return {
+        'pid': os.getpid(),
+        'sockets': len(sockets),
+        'filtered_sockets': sum(1 for s in sockets if s.filter is not None),
+        'event_queue': event_queue.qsize() if event_queue is not None else 0,
+        'fanout': fanout_stats.stats(),
+        'outboxes': outbox_stats(sockets),
+        'past_cache': past_cache.stats(),
+    }
+
+
 def bad_handshake(exc, request):
     log.error("streamer websocket handshake error: %s", exc)
     return HTTPBadRequest()
 
 
 def includeme(config):
-    origins = aslist(config.registry.settings.get('origins', ''))
-    config.registry.websocket = WebSocketWSGIApplication(handler_cls=WebSocket)
+    settings = config.registry.settings
+    origins = aslist(settings.get('origins', ''))
+
+    if 'h.streamer.outbox_size' in settings:
+        WebSocket.outbox_size = int(settings['h.streamer.outbox_size'])
+    if 'h.streamer.overflow_policy' in settings:
+        policy = settings['h.streamer.overflow_policy']
+        if policy not in Outbox.policies:
+            raise ValueError('Unknown overflow policy: {}'.format(policy))
+        WebSocket.overflow_policy = policy
+    if 'h.streamer.coalesce_window' in settings:
+        window_ms = int(settings['h.streamer.coalesce_window'])
+        WebSocket.coalesce_window = window_ms / 1000.0
+
+    if 'h.streamer.past_cache_ttl' in settings:
+        past_cache.ttl = float(settings['h.streamer.past_cache_ttl'])
+
+    WebSocket.relay_socket = settings.get('h.streamer.relay_socket')
+
+    deflate = asbool(settings.get('h.streamer.permessage_deflate', False))
+    threshold = int(settings.get('h.streamer.deflate_threshold', 1024))
+    config.registry.websocket = WebSocketWSGIApplication(
+        handler_cls=WebSocket,
+        deflate=deflate,
+        deflate_threshold=threshold)
     config.registry.websocket_origins = origins
     config.add_route('ws', 'ws')
     config.add_view(websocket, route_name='ws')
+    # The stats are only served when a token to protect them is configured
+    if settings.get('h.streamer.stats_token'):
+        config.add_route('streamer_stats', '_streamer/stats')
+        config.add_view(stats, route_name='streamer_stats', renderer='json')
     config.add_view(bad_handshake, context=HandshakeError)
     config.scan(__name__)
@@ -5,6 +5,7 @@ import re
 import unittest
 import urllib
 
+from mock import patch
 from pytest import raises
 from pyramid import security
 
@@ -63,6 +64,147 @@ class TestAnnotationPermissions(unittest.TestCase):
         assert actual == expect
 
 
+@patch('annotator.annotation.Annotation.save')
+def test_save_refreshes_by_default(save):
+    models.Annotation().save()
+
+    save.assert_called_once_with(refresh=True)
+
+
+@patch('annotator.annotation.Annotation.save')
+@patch.object(models.Annotation, 'refresh_on_write', False)
+def test_save_without_refresh_on_write(save):
+    models.Annotation().save()
+
+    save.assert_called_once_with(refresh=False)
+
+
+@patch('annotator.annotation.Annotation.save')
+@patch.object(models.Annotation, 'refresh_on_write', False)
+def test_save_with_explicit_refresh(save):
+    models.Annotation().save(refresh=True)
+
+    save.assert_called_once_with(refresh=True)
+
+
+@patch.object(models.Annotation, 'es')
+@patch.object(models.Annotation, 'refresh_on_write', False)
+def test_bulk_without_refresh_on_write(es):
+    es.conn.bulk.return_value = {'items': [{'delete': {'_id': 'a'}}]}
+
+    models.Annotation.bulk([('delete', models.Annotation(id='a'))])
+
+    assert es.conn.bulk.call_args[1]['refresh'] is False
+
+
+@patch.object(models.Annotation, 'es')
+def test_fetch_all(es):
+    es.conn.mget.return_value = {'docs': [
+        {'_id': 'a', 'found': True, '_source': {'text': 'foo'}},
+        {'_id': 'b', 'found': False},
+        {'_id': 'c', 'found': True, '_source': {'text': 'bar'}},
+    ]}
+
+    result = models.Annotation.fetch_all(['a', 'b', 'c'])
+
+    assert es.conn.mget.call_args[1]['body'] == {'ids': ['a', 'b', 'c']}
+    assert result == [{'id': 'a', 'text': 'foo'},
+                      None,
+                      {'id': 'c', 'text': 'bar'}]
+    assert isinstance(result[0], models.Annotation)
+
+
+@patch.object(models.Annotation, 'es')
+def test_fetch_all_without_ids(es):
+    assert models.Annotation.fetch_all([]) == []
+    assert not es.conn.mget.called
+
+
+@patch('h.models.document')
+@patch.object(models.Annotation, 'es')
+def test_bulk(es, document):
+    es.index = 'annotator'
+    es.conn.bulk.return_value = {'items': [
+        {'create': {'_id': 'new', 'status': 201}},
+        {'index': {'_id': 'old', 'status': 200}},
+        {'delete': {'_id': 'gone', 'status': 200}},
+    ]}
+    created = models.Annotation({'text': 'new',
+                                 'document': {'title': 'foo'}})
+    updated = models.Annotation({'text': 'updated'}, id='old')
+    deleted = models.Annotation({'text': 'deleted'}, id='gone')
+
+    errors = models.Annotation.bulk([('index', created),
+                                     ('index', updated),
+                                     ('delete', deleted)])
+
+    assert errors == [None, None, None]
+    assert created['id'] == 'new'
+    assert 'created' in created and 'updated' in created
+    assert created['permissions'] == {'read': ['group:__consumer__']}
+    document.Document.assert_called_once_with({'title': 'foo'})
+    assert document.Document.return_value.save.called
+    body = es.conn.bulk.call_args[1]['body']
+    assert body == [
+        {'index': {'_index': 'annotator', '_type': 'annotation'}},
+        created,
+        {'index': {'_index': 'annotator', '_type': 'annotation',
+                   '_id': 'old'}},
+        updated,
+        {'delete': {'_index': 'annotator', '_type': 'annotation',
+                    '_id': 'gone'}},
+    ]
+
+
+@patch('h.models.document')
+@patch.object(models.Annotation, 'es')
+def test_bulk_saves_each_document_once(es, document):
+    es.conn.bulk.return_value = {'items': [
+        {'create': {'_id': str(i), 'status': 201}} for i in range(4)]}
+    page = {'link': [{'href': 'http://example.com'}]}
+    other = {'link': [{'href': 'http://example.org'}]}
+
+    models.Annotation.bulk([('index', models.Annotation(document=page)),
+                            ('index', models.Annotation(document=page)),
+                            ('index', models.Annotation(document=other)),
+                            ('index', models.Annotation(document={}))])
+
+    assert [c[0][0] for c in document.Document.call_args_list] == [
+        page, other, {}]
+    assert document.Document.return_value.save.call_count == 3
+
+
+@patch.object(models.Annotation, 'es')
+def test_bulk_reports_errors_per_item(es):
+    es.conn.bulk.return_value = {'items': [
+        {'create': {'_id': 'a', 'status': 400, 'error': 'MapperParsing'}},
+        {'create': {'_id': 'b', 'status': 201}},
+    ]}
+    first = models.Annotation({'text': 'a'})
+    second = models.Annotation({'text': 'b'})
+
+    errors = models.Annotation.bulk([('index', first), ('index', second)])
+
+    assert errors == ['MapperParsing', None]
+    assert 'id' not in first
+    assert second['id'] == 'b'
+
+
+@patch.object(models.Annotation, 'es')
+def test_bulk_without_operations(es):
+    assert models.Annotation.bulk([]) == []
+    assert not es.conn.bulk.called
+
+
+def test_raw_fields_ignore_long_values():
+    mapping = models.Annotation.__mapping__
+    for raw in (mapping['tags']['fields']['raw'],
+                mapping['uri']['fields']['raw'],
+                mapping['user']['fields']['raw']):
+        assert raw['index'] == 'not_analyzed'
+        assert raw['ignore_above'] == 256
+
+
 analysis = models.Annotation.__analysis__
 
 
@@ -1,6 +1,12 @@
+import json
+import struct
+
+import gevent
+import gevent.server
+import gnsq.errors
 import pytest
 from pyramid import testing
-from mock import patch
+from mock import Mock, patch
 
 from h import queue
 
@@ -76,3 +82,309 @@ def test_get_writer_namespace(fake_nsqd):
 
     writer.publish('sometopic', 'somedata')
     fake_client.publish.assert_called_with('abc123-sometopic', 'somedata')
+
+
+@patch('gnsq.Nsqd')
+def test_get_writer_namespace_multipublish(fake_nsqd):
+    fake_client = fake_nsqd.return_value
+    req = testing.DummyRequest()
+    req.registry.settings.update({
+        'nsq.namespace': "abc123"
+    })
+
+    writer = queue.get_writer(req)
+
+    writer.multipublish('sometopic', ['foo', 'bar'])
+    fake_client.multipublish.assert_called_with('abc123-sometopic',
+                                                ['foo', 'bar'])
+
+
+class FakeNsqd(object):
+    """
+    Enough of an nsqd to accept TCP connections from writers, and record
+    the messages published with ``MPUB``.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.batches = []
+        self.server = gevent.server.StreamServer(('127.0.0.1', 0),
+                                                 self.handle)
+        self.server.start()
+        self.port = self.server.server_port
+
+    def handle(self, sock, address):
+        self.connections += 1
+        stream = sock.makefile('rb')
+        assert stream.read(4) == '  V2'
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            params = line.split()
+            size, = struct.unpack('>l', stream.read(4))
+            body = stream.read(size)
+            if params[0] == 'MPUB':
+                self.batches.append((params[1], self._unpack(body)))
+            sock.sendall(struct.pack('>ll', 6, 0) + 'OK')
+
+    @staticmethod
+    def _unpack(body):
+        count, = struct.unpack('>l', body[:4])
+        messages, offset = [], 4
+        for _ in range(count):
+            size, = struct.unpack('>l', body[offset:offset + 4])
+            messages.append(body[offset + 4:offset + 4 + size])
+            offset += 4 + size
+        return messages
+
+
+@pytest.fixture
+def nsqd(request):
+    server = FakeNsqd()
+    request.addfinalizer(server.server.stop)
+    return server
+
+
+def test_batch_writer_publishes_batch_after_interval(nsqd):
+    writer = queue.BatchWriter(None, '127.0.0.1', tcp_port=nsqd.port,
+                               batch_interval=0.01)
+    writer.publish('annotations', 'foo')
+    writer.publish('annotations', 'bar')
+    assert nsqd.batches == []
+    gevent.sleep(0.1)
+    assert nsqd.batches == [('annotations', ['foo', 'bar'])]
+
+
+def test_batch_writer_publishes_full_batch_immediately(nsqd):
+    writer = queue.BatchWriter(None, '127.0.0.1', tcp_port=nsqd.port,
+                               batch_size=2, batch_interval=10)
+    writer.multipublish('annotations', ['foo', 'bar'])
+    gevent.sleep(0.1)
+    assert nsqd.batches == [('annotations', ['foo', 'bar'])]
+
+
+def test_batch_writer_keeps_connection_open(nsqd):
+    writer = queue.BatchWriter(None, '127.0.0.1', tcp_port=nsqd.port)
+    writer.publish('annotations', 'foo')
+    writer.flush()
+    writer.publish('annotations', 'bar')
+    writer.flush()
+    assert nsqd.batches == [('annotations', ['foo']),
+                            ('annotations', ['bar'])]
+    assert nsqd.connections == 1
+
+
+def test_batch_writer_namespace(nsqd):
+    writer = queue.BatchWriter('abc123', '127.0.0.1', tcp_port=nsqd.port)
+    writer.publish('annotations', 'foo')
+    writer.flush()
+    assert nsqd.batches == [('abc123-annotations', ['foo'])]
+
+
+@patch('gnsq.Nsqd.multipublish_http')
+def test_batch_writer_falls_back_to_http(multipublish_http, nsqd):
+    nsqd.server.stop()
+    writer = queue.BatchWriter(None, '127.0.0.1', tcp_port=nsqd.port)
+    writer.publish('annotations', 'foo')
+    writer.flush()
+    multipublish_http.assert_called_once_with('annotations', ['foo'])
+
+
+@patch('gnsq.Nsqd.multipublish_http')
+def test_batch_writer_keeps_batches_it_cant_publish(multipublish_http, nsqd):
+    def fail_annotations(topic, messages):
+        if topic == 'annotations':
+            raise gnsq.errors.NSQException('nope')
+    multipublish_http.side_effect = fail_annotations
+    nsqd.server.stop()
+    writer = queue.BatchWriter(None, '127.0.0.1', tcp_port=nsqd.port,
+                               retry_delay=10)
+    writer.publish('annotations', 'foo')
+    writer.publish('users', 'bar')
+    writer.publish('annotations', 'baz')
+
+    assert writer.flush() is False
+
+    multipublish_http.assert_any_call('users', ['bar'])
+    assert writer.pending == {'annotations': ['foo', 'baz']}
+    assert writer.pending_count == 2
+    writer.flusher.kill()
+
+
+def test_batch_writer_drops_messages_when_full():
+    writer = queue.BatchWriter(None, batch_interval=10, max_pending=3)
+    writer.multipublish('annotations', ['a', 'b'])
+    writer.multipublish('annotations', ['c', 'd'])
+    writer.publish('annotations', 'e')
+    assert writer.pending == {'annotations': ['a', 'b', 'e']}
+    assert writer.dropped == 2
+    writer.flusher.kill()
+
+
+def test_batch_writer_flush_times_out_while_publishing():
+    writer = queue.BatchWriter(None, batch_interval=10, flush_timeout=0.01)
+    writer.publish('annotations', 'foo')
+    with writer._lock:
+        assert writer.flush() is False
+    assert writer.pending == {'annotations': ['foo']}
+    writer.flusher.kill()
+
+
+@patch('h.queue.BatchWriter')
+def test_get_writer_batch(fake_writer):
+    req = testing.DummyRequest()
+    req.registry.settings.update({
+        'nsq.writer.batch': 'true',
+        'nsq.writer.address': 'philae:2014',
+        'nsq.writer.tcp_address': 'philae:2013',
+        'nsq.writer.batch_size': '10',
+        'nsq.writer.batch_interval': '20',
+        'nsq.writer.max_pending': '1000',
+    })
+    writer = queue.get_writer(req)
+    assert queue.get_writer(req) is writer
+    fake_writer.assert_called_once_with(None, 'philae',
+                                        tcp_port=2013,
+                                        http_port='2014',
+                                        batch_size=10,
+                                        batch_interval=0.02,
+                                        max_pending=1000)
+
+
+def test_outbox_publishes_in_background():
+    writer = Mock()
+    outbox = queue.PublishOutbox()
+    outbox.put(writer, 'annotations', ['foo', 'bar'])
+    assert not writer.multipublish.called
+    gevent.sleep(0)
+    writer.multipublish.assert_called_once_with('annotations', ['foo', 'bar'])
+    assert outbox.size == 0
+
+
+def test_outbox_retries():
+    writer = Mock()
+    writer.multipublish.side_effect = [IOError, IOError, None]
+    outbox = queue.PublishOutbox(retry_delay=0.001)
+    outbox.put(writer, 'annotations', ['foo'])
+    gevent.sleep(0.05)
+    assert writer.multipublish.call_count == 3
+    assert outbox.size == 0
+
+
+@patch('h.queue.log')
+def test_outbox_gives_up_after_max_attempts(log):
+    writer = Mock()
+    writer.multipublish.side_effect = IOError
+    outbox = queue.PublishOutbox(retry_delay=0.001, max_attempts=3)
+    outbox.put(writer, 'annotations', ['foo'])
+    outbox.put(writer, 'annotations', ['bar'])
+    gevent.sleep(0.05)
+    assert writer.multipublish.call_count == 6
+    assert outbox.size == 0
+    assert outbox.dropped == 2
+    assert log.error.call_count == 2
+    assert log.error.call_args[0][-1] == ['bar']
+
+
+def test_outbox_drops_messages_when_full():
+    writer = Mock()
+    outbox = queue.PublishOutbox(maxsize=2)
+    outbox.put(writer, 'annotations', ['foo'])
+    outbox.put(writer, 'annotations', ['bar', 'baz'])
+    outbox.put(writer, 'annotations', ['qux'])
+    assert outbox.size == 2
+    assert outbox.dropped == 2
+    gevent.sleep(0)
+    assert writer.multipublish.call_count == 2
+
+
+def test_outbox_gauge():
+    gauge = Mock()
+    outbox = queue.PublishOutbox(gauge=gauge)
+    outbox.put(Mock(), 'annotations', ['foo', 'bar'])
+    gevent.sleep(0)
+    sizes = [c[0][1] for c in gauge.send.call_args_list]
+    assert sizes == [2, 0]
+
+
+@patch('h.queue.stats')
+def test_get_outbox(stats):
+    req = testing.DummyRequest()
+    req.registry.settings.update({'nsq.outbox.size': '20',
+                                  'nsq.outbox.max_attempts': '5'})
+    outbox = queue.get_outbox(req)
+    assert queue.get_outbox(req) is outbox
+    assert outbox.maxsize == 20
+    assert outbox.max_attempts == 5
+    assert outbox.gauge == stats.get_client.return_value.get_gauge.return_value
+
+
+@pytest.mark.parametrize('codec', ['json', 'msgpack'])
+def test_message_round_trip(codec):
+    if codec == 'msgpack':
+        pytest.importorskip('msgpack')
+    data = {'action': 'create',
+            'annotation': {'id': 'abc', 'text': u'caf\xe9', 'tags': ['a']},
+            'src_client_id': None}
+    message = queue.decode_message(queue.encode_message(data, codec=codec))
+    assert dict(message) == data
+
+
+def test_encode_message_plain_json_by_default():
+    data = {'action': 'create', 'annotation': {'id': 'abc'}}
+    assert json.loads(queue.encode_message(data)) == data
+
+
+def test_decode_message_plain_json():
+    data = {'action': 'create', 'annotation': {'id': 'abc'}}
+    assert dict(queue.decode_message(json.dumps(data))) == data
+
+
+def test_decode_message_reads_envelope_without_annotation():
+    body = queue.encode_message({'action': 'read',
+                                 'annotation': {'id': 'abc'}},
+                                codec='json')
+    with patch.object(queue.JSONCodec, 'loads', wraps=json.loads) as loads:
+        message = queue.decode_message(body)
+        assert message['action'] == 'read'
+        assert loads.call_count == 1
+        assert message['annotation'] == {'id': 'abc'}
+        assert loads.call_count == 2
+
+
+def test_decode_message_unknown_version():
+    body = queue.encode_message({'action': 'create', 'annotation': {}},
+                                codec='json')
+    with pytest.raises(ValueError):
+        queue.decode_message('\x02' + body[1:])
+
+
+def test_decode_message_unknown_codec():
+    body = queue.encode_message({'action': 'create', 'annotation': {}},
+                                codec='json')
+    with pytest.raises(ValueError):
+        queue.decode_message(body[:1] + '\xff' + body[2:])
+
+
+def test_register_codec():
+    class ReprCodec(object):
+        name = 'repr'
+        id = 99
+        dumps = staticmethod(repr)
+        loads = staticmethod(eval)
+
+    queue.register_codec(ReprCodec)
+    try:
+        data = {'action': 'create', 'annotation': {'id': 'abc'}}
+        body = queue.encode_message(data, codec='repr')
+        assert dict(queue.decode_message(body)) == data
+    finally:
+        del queue._codecs_by_name['repr']
+        del queue._codecs_by_id[99]
+
+
+def test_includeme_bad_codec(config):
+    config.registry.settings.update({'nsq.codec': 'pickle'})
+    with pytest.raises(ValueError):
+        config.include('h.queue')
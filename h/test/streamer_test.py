@@ -5,24 +5,60 @@ import unittest
 
 from collections import namedtuple
 import json
+import socket
+import struct
+import zlib
 
+import gevent
+import gevent.queue
+import gevent.server
 from mock import ANY
+import pytest
 from mock import MagicMock, Mock
 from mock import patch
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.security import ALL_PERMISSIONS, Allow, Authenticated, Deny
+from pyramid.security import Everyone
+from pyramid import testing
 from pyramid.testing import DummyRequest
-
+from ws4py.framing import Frame, OPCODE_CONTINUATION, OPCODE_PING
+from ws4py.framing import OPCODE_TEXT
+
+from h.streamer import FanoutStats
+from h.streamer import FilterHandler
+from h.streamer import FoldedAnnotation
+from h.streamer import Outbox
+from h.streamer import PastResultsCache
+from h.streamer import PerMessageDeflate
+from h.streamer import QueueEvent
+from h.streamer import _relay_frame
+from h.streamer import ReadACL
 from h.streamer import FilterToElasticFilter
+from h.streamer import SubscriptionIndex
 from h.streamer import WebSocket
 from h.streamer import should_send_event
+from h.streamer import stats
+from h.streamer import uni_fold
+from h.streamer import WebSocketWSGIApplication
 from h.streamer import broadcast_from_queue
+from h.streamer import fanout_stats
+from h.streamer import negotiate_deflate
+from h.streamer import outbox_stats
+from h.streamer import past_cache
+from h.streamer import read_relay
+from h.streamer import relay
 from h.streamer import websocket
 
 
 FakeMessage = namedtuple('FakeMessage', 'body')
+TimestampedMessage = namedtuple('TimestampedMessage', 'body timestamp')
 
 
 class FakeSocket(object):
     client_id = None
+    coalesce_window = 0
+    effective_principals = None
     filter = None
     request = None
     terminated = None
@@ -33,6 +69,7 @@ class FakeSocket(object):
         self.filter = MagicMock()
         self.request = MagicMock()
         self.send = MagicMock()
+        self.enqueue = MagicMock()
 
 
 def has_ordered_sublist(lst, sublist):
@@ -187,6 +224,142 @@ def test_operator_call():
     assert query['term']['text'] == expected
 
 
+def test_uni_fold_ascii():
+    assert uni_fold('Hello World') == u'hello world'
+    assert isinstance(uni_fold('Hello'), unicode)
+
+
+def test_uni_fold_strips_combining_characters():
+    assert uni_fold(u'Ünïcödé') == u'unicode'
+    assert uni_fold(u'Ünïcödé'.encode('utf-8')) == u'unicode'
+
+
+def test_uni_fold_leaves_other_types():
+    assert uni_fold(5) == 5
+    assert uni_fold(None) is None
+
+
+def test_folded_annotation_get():
+    folded = FoldedAnnotation({'text': u'Héllo', 'tags': ['A', 'B'],
+                               'target': [{'source': 'X'}]})
+    assert folded.get('/text') == u'hello'
+    assert folded.get('/tags') == [u'a', u'b']
+    assert folded.get('/target/0/source') == u'x'
+    assert folded.get('/quote') is None
+
+
+@patch('h.streamer.uni_fold')
+def test_folded_annotation_folds_each_field_once(uni_fold):
+    uni_fold.side_effect = lambda x: x
+    folded = FoldedAnnotation({'text': 'Hello'})
+
+    folded.get('/text')
+    folded.get('/text')
+
+    uni_fold.assert_called_once_with('Hello')
+
+
+def test_filter_handler_matches_folded_annotation():
+    handler = _handler([{'field': '/text', 'operator': 'matches',
+                         'value': 'hello'}])
+    folded = FoldedAnnotation({'text': 'Well HELLO'})
+    assert handler.match(folded)
+
+
+def _handler(clauses, match_policy='include_all'):
+    return FilterHandler({
+        'match_policy': match_policy,
+        'actions': {'create': True},
+        'clauses': clauses,
+    })
+
+
+def test_filter_handler_folds_values():
+    handler = _handler([{'field': '/uri', 'operator': 'equals',
+                         'value': u'http://EXÄMPLE.com'}])
+    assert handler.match({'uri': u'http://exämple.com'})
+    assert handler.match({'uri': 'http://example.com'})
+    assert not handler.match({'uri': 'http://example.org'})
+
+
+def test_filter_handler_one_of():
+    handler = _handler([{'field': '/uri', 'operator': 'one_of',
+                         'value': ['http://example.com/a',
+                                   'http://example.com/b']}])
+    assert handler.match({'uri': 'http://example.com/b'})
+    assert not handler.match({'uri': 'http://example.com'})
+
+
+def test_filter_handler_matches_list_field():
+    handler = _handler([{'field': '/tags', 'operator': 'matches',
+                         'value': 'Foo'}])
+    assert handler.match({'tags': ['bar', 'FOO']})
+    assert not handler.match({'tags': ['bar']})
+    assert not handler.match({})
+
+
+def test_filter_handler_multiple_fields():
+    handler = _handler([{'field': ['/text', '/quote'], 'operator': 'matches',
+                         'value': 'hello'}])
+    assert handler.match({'text': 'Hi', 'quote': 'Hello there'})
+    assert not handler.match({'text': 'Hi', 'quote': 'Bye'})
+
+
+def test_filter_handler_actions():
+    handler = _handler([])
+    assert handler.match({}, 'create')
+    assert handler.match({}, 'past')
+    assert not handler.match({}, 'delete')
+
+
+@patch('h.streamer.uni_fold')
+def test_filter_handler_folds_clause_values_once(uni_fold):
+    uni_fold.side_effect = lambda x: x
+    handler = _handler([{'field': '/tags', 'operator': 'one_of',
+                         'value': ['foo', 'bar']}])
+    uni_fold.reset_mock()
+
+    handler.match({'tags': 'bar'})
+
+    uni_fold.assert_called_once_with('bar')
+
+
+@patch.object(WebSocket, 'overflow_policy', 'drop_oldest')
+@patch.object(WebSocket, 'outbox_size', 100)
+@patch.object(WebSocket, 'coalesce_window', 0)
+def test_includeme_outbox_settings(config):
+    config.registry.settings.update({'h.streamer.outbox_size': '5',
+                                     'h.streamer.overflow_policy': 'coalesce',
+                                     'h.streamer.coalesce_window': '250'})
+    config.include('h.streamer')
+    assert WebSocket.outbox_size == 5
+    assert WebSocket.overflow_policy == 'coalesce'
+    assert WebSocket.coalesce_window == 0.25
+
+
+def test_includeme_deflate_settings(config):
+    config.registry.settings.update({'h.streamer.permessage_deflate': 'true',
+                                     'h.streamer.deflate_threshold': '512'})
+    config.include('h.streamer')
+    assert config.registry.websocket.deflate is True
+    assert config.registry.websocket.deflate_threshold == 512
+
+
+def test_includeme_relay_socket(config):
+    config.registry.settings.update({'h.streamer.relay_socket': '/tmp/r'})
+    try:
+        config.include('h.streamer')
+        assert WebSocket.relay_socket == '/tmp/r'
+    finally:
+        WebSocket.relay_socket = None
+
+
+def test_includeme_bad_overflow_policy(config):
+    config.registry.settings.update({'h.streamer.overflow_policy': 'ignore'})
+    with pytest.raises(ValueError):
+        config.include('h.streamer')
+
+
 def test_websocket_bad_origin(config):
     config.registry.settings.update({'origins': 'http://good'})
     config.include('h.streamer')
@@ -215,6 +388,7 @@ def test_websocket_same_origin(config):
 
 class TestWebSocket(unittest.TestCase):
     def setUp(self):
+        past_cache.clear()
         fake_request = MagicMock()
         fake_socket = MagicMock()
 
@@ -225,6 +399,19 @@ class TestWebSocket(unittest.TestCase):
         self.s.opened()
         self.s.request.get_queue_reader.assert_called_once_with('annotations', ANY)
 
+    @patch('h.streamer.gevent.spawn')
+    def test_opened_reads_from_relay(self, spawn):
+        event_queue = WebSocket.event_queue
+        WebSocket.event_queue = None
+        WebSocket.relay_socket = '/tmp/relay.sock'
+        try:
+            self.s.opened()
+        finally:
+            WebSocket.event_queue = event_queue
+            WebSocket.relay_socket = None
+        assert not self.s.request.get_queue_reader.called
+        spawn.assert_any_call(read_relay, '/tmp/relay.sock', ANY)
+
     def test_filter_message_with_uri_gets_expanded(self):
         filter_message = json.dumps({
             'filter': {
@@ -280,6 +467,65 @@ class TestWebSocket(unittest.TestCase):
             uri_values = uri_filter['value']
             assert 'http://example.com' == uri_values
 
+    def test_filter_message_indexes_socket(self):
+        filter_message = json.dumps({
+            'filter': _uri_filter(['http://example.com']),
+        })
+        msg = MagicMock()
+        msg.data = filter_message
+
+        with patch('annotator.document.Document.get_by_uri') as doc:
+            doc.return_value = []
+            self.s.received_message(msg)
+
+        candidates = WebSocket.instances.candidates
+        assert self.s in candidates({'uri': 'http://example.com'})
+        assert self.s not in candidates({'uri': 'http://example.org'})
+
+
+    @patch('h.streamer.get_user')
+    @patch('h.streamer.Annotation.search_raw')
+    def test_more_hits_pages_with_cursor(self, search_raw, get_user):
+        search_raw.return_value = {'hits': {'total': 3, 'hits': [
+            {'_id': 'a', '_source': {}, 'sort': [2, 'annotation#a']},
+            {'_id': 'b', '_source': {}, 'sort': [1, 'annotation#b']},
+        ]}}
+        self.s.send = MagicMock()
+        self.s.query = FilterToElasticFilter({'clauses': []}, self.s.request)
+        msg = MagicMock()
+        msg.data = json.dumps({'messageType': 'more_hits', 'moreHits': 2})
+
+        self.s.received_message(msg)
+        self.s.received_message(msg)
+
+        first_query = search_raw.call_args_list[0][1]['query']
+        second_query = search_raw.call_args_list[1][1]['query']
+        assert 'from' not in first_query
+        assert first_query['query'] == {'match_all': {}}
+        cursor_filter = second_query['query']['filtered']['filter']
+        assert cursor_filter['or'][0] == {'range': {'updated': {'lt': 1}}}
+        assert self.s.query.query['query'] == {'match_all': {}}
+
+    @patch('h.streamer.get_user')
+    @patch('h.streamer.Annotation.search_raw')
+    def test_same_past_results_are_shared(self, search_raw, get_user):
+        search_raw.return_value = {'hits': {'total': 1, 'hits': [
+            {'_id': 'a', '_source': {}, 'sort': [2, 'annotation#a']},
+        ]}}
+        get_user.return_value = None
+        other = WebSocket(MagicMock())
+        for sock in (self.s, other):
+            sock.enqueue = MagicMock()
+            sock.filter = FilterHandler({'match_policy': 'include_any',
+                                         'clauses': [], 'actions': {}})
+            sock.query = FilterToElasticFilter({'clauses': []}, sock.request)
+            sock.send_annotations()
+
+        assert search_raw.call_count == 1
+        assert other.enqueue.call_args == self.s.enqueue.call_args
+        assert other.cursor == [2, 'annotation#a']
+        assert other.received == 1
+
 
 class TestBroadcast(unittest.TestCase):
     def setUp(self):
@@ -309,13 +555,861 @@ class TestBroadcast(unittest.TestCase):
         self.should.return_value = True
         sock = FakeSocket('giraffe')
         broadcast_from_queue(self.queue, [sock])
-        assert sock.send.called
+        assert sock.enqueue.called
 
     def test_no_send_when_socket_should_not_receive_event(self):
         self.should.return_value = False
         sock = FakeSocket('pidgeon')
         broadcast_from_queue(self.queue, [sock])
-        assert sock.send.called is False
+        assert sock.enqueue.called is False
+
+
+    def test_enqueues_with_annotation_id_as_key(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        broadcast_from_queue(self.queue, [sock])
+        keys = [c[1]['key'] for c in sock.enqueue.call_args_list]
+        assert keys == [1, 2, 3]
+
+    def test_coalesces_when_socket_has_coalescing_window(self):
+        self.should.return_value = True
+        sock = FakeSocket('giraffe')
+        sock.coalesce_window = 0.1
+        sock.coalesce = MagicMock()
+        broadcast_from_queue(self.queue, [sock])
+        actions = [c[0][1] for c in sock.coalesce.call_args_list]
+        assert actions == ['delete', 'update', 'delete']
+        assert not sock.enqueue.called
+
+    @patch('h.streamer.time.time')
+    def test_records_queue_lag(self, time):
+        time.return_value = 1000.0
+        fanout_stats.reset()
+        self.queue.__iter__.return_value = [
+            TimestampedMessage(m.body, int(998.5e9)) for m in self.messages]
+        broadcast_from_queue(self.queue, [])
+        assert fanout_stats.stats()['max_lag_seconds'] == 1.5
+
+    @patch('h.streamer.past_cache')
+    def test_invalidates_past_results(self, cache):
+        broadcast_from_queue(self.queue, [])
+        annotations = [c[0][0].annotation for c in
+                       cache.invalidate.call_args_list]
+        assert [a['id'] for a in annotations] == [1, 2, 3]
+
+    def test_shares_read_acl_between_sockets(self):
+        self.should.return_value = True
+        socks = [FakeSocket('giraffe'), FakeSocket('elephant')]
+        broadcast_from_queue(self.queue, socks)
+        acls = [c[0][3] for c in self.should.call_args_list]
+        assert acls[0] is acls[1]
+        assert acls[0] is not acls[2]
+
+    def test_records_fanout_stats(self):
+        self.should.return_value = True
+        fanout_stats.reset()
+        broadcast_from_queue(self.queue, [FakeSocket('giraffe')])
+        stats = fanout_stats.stats()
+        assert stats['messages'] == 3
+        assert stats['sockets'] == 3
+        assert stats['sent'] == 3
+        assert stats['seconds'] >= stats['max_seconds'] > 0
+
+    def test_sends_only_to_candidates_of_a_subscription_index(self):
+        self.should.return_value = True
+        sockets = SubscriptionIndex()
+        sock = FakeSocket('giraffe')
+        sock.filter = FilterHandler(_uri_filter(['http://example.com']))
+        sockets.add(sock)
+        broadcast_from_queue(self.queue, sockets)
+        assert sock.enqueue.called is False
+
+
+def test_queue_event_from_message():
+    message = Mock(body=json.dumps({'annotation': {'id': 1},
+                                    'action': 'create'}),
+                   timestamp=1000)
+    event = QueueEvent.from_message(message)
+    assert event.data['action'] == 'create'
+    assert event.timestamp == 1000
+    assert json.loads(event.packet) == {'payload': [{'id': 1}],
+                                        'type': 'annotation-notification',
+                                        'options': {'action': 'create'}}
+
+
+def test_broadcast_uses_queue_event_packet():
+    event = QueueEvent({'annotation': {'id': 1}, 'action': 'create'},
+                       packet='packet')
+    sock = FakeSocket('giraffe')
+    with patch('h.streamer.should_send_event') as should:
+        should.return_value = True
+        broadcast_from_queue([event], [sock])
+    sock.enqueue.assert_called_once_with('packet', key=1)
+
+
+def test_relay(tmpdir):
+    path = str(tmpdir.join('relay.sock'))
+    request = MagicMock()
+    request.registry.settings = {'h.streamer.relay_socket': path}
+    reader = request.get_queue_reader.return_value
+    events = gevent.queue.Queue()
+    received = []
+
+    def start(block):
+        handle_message = reader.on_message.connect.call_args[0][0]
+        greenlet = gevent.spawn(read_relay, path, events, retry_delay=0.01)
+        gevent.sleep(0.05)
+        for action in ('read', 'create'):
+            data = {'annotation': {'id': 1}, 'action': action}
+            message = Mock(body=json.dumps(data), timestamp=1000)
+            handle_message(reader, message)
+        received.append(events.get(timeout=1))
+        greenlet.kill()
+
+    reader.start.side_effect = start
+    relay(request)
+
+    request.get_queue_reader.assert_called_once_with('annotations', ANY)
+    [event] = received
+    assert event.data == {'annotation': {'id': 1}, 'action': 'create'}
+    assert event.timestamp == 1000
+    assert json.loads(event.packet)['options'] == {'action': 'create'}
+    assert events.empty()
+
+
+def test_read_relay_reconnects_after_bad_frames(tmpdir):
+    path = str(tmpdir.join('relay.sock'))
+    frame = _relay_frame(QueueEvent({'action': 'create'}, 1000, 'packet'))
+    frames = [frame[:-3], struct.pack('!I', 7) + 'garbage', frame]
+
+    def handle(sock, address):
+        if frames:
+            sock.sendall(frames.pop(0))
+        sock.close()
+
+    listener = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    server = gevent.server.StreamServer(listener, handle)
+    server.start()
+    events = gevent.queue.Queue()
+    greenlet = gevent.spawn(read_relay, path, events, retry_delay=0.01)
+    try:
+        event = events.get(timeout=1)
+    finally:
+        greenlet.kill()
+        server.stop()
+
+    assert event.data == {'action': 'create'}
+    assert event.timestamp == 1000
+    assert event.packet == 'packet'
+    assert events.empty()
+
+
+class TestFanoutStats(unittest.TestCase):
+    def test_stats(self):
+        now = [100.0]
+        fanout_stats = FanoutStats(clock=lambda: now[0])
+        fanout_stats.record(0.01, sockets=10, sent=2, lag=0.5)
+        fanout_stats.record(0.03, sockets=10, sent=3, lag=1.5)
+        fanout_stats.record_write(0.2)
+        now[0] += 4
+
+        result = fanout_stats.stats()
+
+        assert result['messages'] == 2
+        assert result['messages_per_second'] == 0.5
+        assert result['match_rate'] == 0.25
+        assert round(result['mean_seconds'], 6) == 0.02
+        assert result['max_seconds'] == 0.03
+        assert result['mean_lag_seconds'] == 1.0
+        assert result['max_lag_seconds'] == 1.5
+        assert result['writes'] == 1
+        assert result['max_write_seconds'] == 0.2
+
+    def test_stats_without_messages(self):
+        result = FanoutStats().stats()
+        assert result['match_rate'] == 0.0
+        assert result['mean_seconds'] == 0.0
+        assert result['p99_seconds'] == 0.0
+
+    def test_messages_per_second_is_recent(self):
+        now = [100.0]
+        fanout_stats = FanoutStats(clock=lambda: now[0], rate_window=10)
+        for _ in range(50):
+            fanout_stats.record(0.01, sockets=1, sent=1)
+        now[0] += 20
+        for _ in range(5):
+            fanout_stats.record(0.01, sockets=1, sent=1)
+        now[0] += 1
+
+        result = fanout_stats.stats()
+
+        assert result['messages'] == 55
+        assert result['messages_per_second'] == 0.5
+
+    def test_percentiles_of_recent_samples(self):
+        fanout_stats = FanoutStats(samples=100)
+        for i in range(1, 201):
+            fanout_stats.record(i / 1000.0, sockets=1, sent=1, lag=i)
+        fanout_stats.record_write(0.2)
+
+        result = fanout_stats.stats()
+
+        assert result['p50_lag_seconds'] == 151
+        assert result['p95_lag_seconds'] == 195
+        assert result['p99_lag_seconds'] == 199
+        assert result['p99_seconds'] == 0.199
+        assert result['p50_write_seconds'] == 0.2
+
+
+def _stats_request(token='s3cret'):
+    request = DummyRequest(headers={'X-Stats-Token': token})
+    request.registry.settings['h.streamer.stats_token'] = 's3cret'
+    return request
+
+
+def test_stats_view():
+    sock = FakeSocket('giraffe')
+    sock.outbox = Outbox(10)
+    sock.outbox.put('a')
+    unfiltered = FakeSocket('elephant')
+    unfiltered.filter = None
+    unfiltered.outbox = None
+
+    with patch.object(WebSocket, 'instances', [sock, unfiltered]):
+        result = stats(_stats_request())
+
+    assert result['sockets'] == 2
+    assert result['filtered_sockets'] == 1
+    assert result['outboxes'] == {'outboxes': 1, 'queued': 1,
+                                  'max_queued': 1}
+    assert 'fanout' in result
+    assert 'past_cache' in result
+
+
+def test_stats_view_requires_token():
+    with pytest.raises(HTTPForbidden):
+        stats(_stats_request(token='guess'))
+    with pytest.raises(HTTPForbidden):
+        stats(DummyRequest())
+
+
+def test_includeme_stats_route_needs_token(config):
+    config.include('h.streamer')
+    assert config.get_routes_mapper().get_route('streamer_stats') is None
+
+
+def test_includeme_stats_route(config):
+    config.registry.settings['h.streamer.stats_token'] = 's3cret'
+    config.include('h.streamer')
+    assert config.get_routes_mapper().get_route('streamer_stats') is not None
+
+
+class TestOutbox(unittest.TestCase):
+    def test_get_returns_oldest(self):
+        outbox = Outbox(3)
+        outbox.put('a')
+        outbox.put('b')
+        assert outbox.get() == 'a'
+        assert outbox.get() == 'b'
+        assert len(outbox) == 0
+
+    def test_get_waits_for_message(self):
+        outbox = Outbox(3)
+        getter = gevent.spawn(outbox.get)
+        gevent.sleep(0)
+        assert not getter.ready()
+        outbox.put('a')
+        assert getter.get(timeout=1) == 'a'
+
+    def test_drop_oldest(self):
+        outbox = Outbox(2, 'drop_oldest')
+        for message in 'abc':
+            assert outbox.put(message)
+        assert list(outbox.messages) == [(None, 'b'), (None, 'c')]
+        assert outbox.dropped == 1
+
+    def test_coalesce_drops_message_with_same_key(self):
+        outbox = Outbox(2, 'coalesce')
+        outbox.put('a1', key='a')
+        outbox.put('b1', key='b')
+        outbox.put('b2', key='b')
+        assert list(outbox.messages) == [('a', 'a1'), ('b', 'b2')]
+        assert outbox.dropped == 1
+
+    def test_coalesce_drops_oldest_without_same_key(self):
+        outbox = Outbox(2, 'coalesce')
+        outbox.put('a1', key='a')
+        outbox.put('b1', key='b')
+        outbox.put('c1', key='c')
+        assert list(outbox.messages) == [('b', 'b1'), ('c', 'c1')]
+
+    def test_disconnect_refuses_message(self):
+        outbox = Outbox(1, 'disconnect')
+        assert outbox.put('a')
+        assert not outbox.put('b')
+        assert list(outbox.messages) == [(None, 'a')]
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            Outbox(1, 'ignore')
+
+
+class TestWebSocketOutbox(unittest.TestCase):
+    def setUp(self):
+        fanout_stats.reset()
+        self.s = WebSocket(MagicMock())
+        self.s.request = MagicMock()
+        self.s.send = MagicMock()
+        self.s.close_connection = MagicMock()
+
+    def tearDown(self):
+        if self.s.writer is not None:
+            self.s.writer.kill()
+
+    def test_enqueue_writes_in_order(self):
+        self.s.enqueue('a')
+        self.s.enqueue('b')
+        gevent.sleep(0)
+        assert self.s.send.call_args_list == [(('a',),), (('b',),)]
+        assert fanout_stats.writes == 2
+
+    def test_slow_client_does_not_block_others(self):
+        slow = WebSocket(MagicMock())
+        slow.send = MagicMock(side_effect=lambda data: gevent.sleep(60))
+        try:
+            slow.enqueue('a')
+            self.s.enqueue('a')
+            gevent.sleep(0)
+            assert self.s.send.called
+        finally:
+            slow.writer.kill()
+
+    def test_drop_counts_towards_stats(self):
+        self.s.outbox = Outbox(1)
+        self.s.writer = MagicMock()
+        self.s.enqueue('a')
+        self.s.enqueue('b')
+        assert fanout_stats.dropped == 1
+        assert outbox_stats([self.s]) == {'outboxes': 1, 'queued': 1,
+                                         'max_queued': 1}
+
+    def test_coalesce_keeps_latest_event_per_annotation(self):
+        self.s.coalesce_window = 60
+        self.s.enqueue = MagicMock()
+        self.s.coalesce({'id': 'a', 'text': '1'}, 'create')
+        self.s.coalesce({'id': 'b', 'text': '1'}, 'update')
+        self.s.coalesce({'id': 'a', 'text': '2'}, 'update')
+        self.s.coalesce({'id': 'c', 'text': '1'}, 'delete')
+
+        self.s.flush_pending()
+
+        packets = [json.loads(c[0][0]) for c in self.s.enqueue.call_args_list]
+        assert [p['options']['action'] for p in packets] == ['update',
+                                                             'delete']
+        assert packets[0]['payload'] == [{'id': 'b', 'text': '1'},
+                                         {'id': 'a', 'text': '2'}]
+        assert packets[1]['payload'] == [{'id': 'c', 'text': '1'}]
+        assert fanout_stats.coalesced == 1
+
+    def test_coalesce_flushes_after_window(self):
+        self.s.coalesce_window = 0.01
+        self.s.enqueue = MagicMock()
+        self.s.coalesce({'id': 'a'}, 'create')
+        assert not self.s.enqueue.called
+        gevent.sleep(0.05)
+        assert self.s.enqueue.call_count == 1
+        assert self.s.pending is None
+
+    def test_disconnect_when_full(self):
+        self.s.outbox = Outbox(1, 'disconnect')
+        self.s.writer = MagicMock()
+        self.s.enqueue('a')
+        self.s.enqueue('b')
+        assert self.s.close_connection.called
+        assert self.s.writer.kill.called
+        assert fanout_stats.disconnected == 1
+
+    def test_disconnect_once(self):
+        """A refused socket isn't broadcast to or counted again."""
+        self.s.outbox = Outbox(1, 'disconnect')
+        self.s.writer = MagicMock()
+        assert self.s in set(WebSocket.instances)
+        self.s.enqueue('a')
+        self.s.enqueue('b')
+        self.s.enqueue('c')
+        assert self.s not in set(WebSocket.instances)
+        assert self.s.close_connection.call_count == 1
+        assert fanout_stats.disconnected == 1
+
+
+def _client_frame(opcode, body, fin=1, rsv1=0):
+    return Frame(opcode, body, masking_key=b'abcd', fin=fin, rsv1=rsv1).build()
+
+
+def _client_deflate(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4]
+
+
+def _client_inflate(data, decompressor=None):
+    if decompressor is None:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    return decompressor.decompress(data + b'\x00\x00\xff\xff')
+
+
+def _parse_frame(data):
+    frame = Frame()
+    frame.parser.send(data)
+    return frame
+
+
+class TestPastResultsCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.cache = PastResultsCache(ttl=2, clock=lambda: self.now)
+        self.filter = _handler([{'field': '/uri', 'operator': 'equals',
+                                 'value': 'http://example.com'}])
+        self.fetch = MagicMock(return_value='packet')
+
+    def test_caches_results(self):
+        assert self.cache.get('key', self.filter, self.fetch) == 'packet'
+        assert self.cache.get('key', self.filter, self.fetch) == 'packet'
+        assert self.fetch.call_count == 1
+        assert self.cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+    def test_results_expire(self):
+        self.cache.get('key', self.filter, self.fetch)
+        self.now += 3
+        self.cache.get('key', self.filter, self.fetch)
+        assert self.fetch.call_count == 2
+
+    def test_results_are_not_cached_without_a_filter(self):
+        self.cache.get('key', None, self.fetch)
+        self.cache.get('key', None, self.fetch)
+        assert self.fetch.call_count == 2
+
+    def test_evicts_oldest(self):
+        self.cache.maxsize = 1
+        self.cache.get('a', self.filter, self.fetch)
+        self.cache.get('b', self.filter, self.fetch)
+        self.cache.get('a', self.filter, self.fetch)
+        assert self.fetch.call_count == 3
+
+    def test_invalidate_drops_matching_results(self):
+        other_filter = _handler([{'field': '/uri', 'operator': 'equals',
+                                  'value': 'http://example.org'}])
+        self.cache.get('key', self.filter, self.fetch)
+        self.cache.get('other', other_filter, self.fetch)
+
+        self.cache.invalidate({'uri': 'http://example.com'})
+
+        self.cache.get('key', self.filter, self.fetch)
+        self.cache.get('other', other_filter, self.fetch)
+        assert self.fetch.call_count == 3
+
+    def test_invalidate_purges_expired_results(self):
+        self.cache.get('a', self.filter, self.fetch)
+        self.now += 1
+        self.cache.get('b', self.filter, self.fetch)
+        self.now += 1.5
+
+        self.cache.invalidate({'uri': 'http://example.org'})
+
+        assert self.cache.stats()['size'] == 1
+
+    def test_invalidate_only_matches_indexed_candidates(self):
+        other_filter = _handler([{'field': '/uri', 'operator': 'equals',
+                                  'value': 'http://example.org'}])
+        self.cache.get('key', self.filter, self.fetch)
+        self.cache.get('other', other_filter, self.fetch)
+
+        with patch.object(other_filter, 'match') as match:
+            self.cache.invalidate({'uri': 'http://example.com'})
+
+        assert not match.called
+        assert self.cache.stats()['size'] == 1
+
+    def test_invalidate_unindexed_filters(self):
+        everything = _handler([])
+        self.cache.get('key', everything, self.fetch)
+
+        self.cache.invalidate({'uri': 'http://example.com'})
+
+        assert self.cache.stats()['size'] == 0
+
+    def test_concurrent_requests_share_one_fetch(self):
+        def fetch():
+            gevent.sleep(0.01)
+            return 'packet'
+        fetch = MagicMock(side_effect=fetch)
+
+        getters = [gevent.spawn(self.cache.get, 'key', self.filter, fetch)
+                   for _ in range(3)]
+        gevent.joinall(getters)
+
+        assert [g.value for g in getters] == ['packet'] * 3
+        assert fetch.call_count == 1
+
+    def test_invalidate_during_fetch_prevents_caching(self):
+        def fetch():
+            self.cache.invalidate({'uri': 'http://example.com'})
+            return 'packet'
+
+        assert self.cache.get('key', self.filter, fetch) == 'packet'
+        self.cache.get('key', self.filter, self.fetch)
+        assert self.fetch.call_count == 1
+
+    def test_fetch_errors_reach_waiters(self):
+        def fetch():
+            gevent.sleep(0.01)
+            raise RuntimeError('search failed')
+
+        getters = [gevent.spawn(self.cache.get, 'key', self.filter, fetch)
+                   for _ in range(2)]
+        gevent.joinall(getters)
+
+        assert all(isinstance(g.exception, RuntimeError) for g in getters)
+        assert self.cache.stats()['size'] == 0
+
+
+class TestNegotiateDeflate(unittest.TestCase):
+    def test_accepts_offer(self):
+        header, deflate = negotiate_deflate(
+            'permessage-deflate; client_max_window_bits')
+        assert header == 'permessage-deflate'
+        assert deflate.no_context_takeover is False
+        assert deflate.max_window_bits == 15
+
+    def test_accepts_server_parameters(self):
+        header, deflate = negotiate_deflate(
+            'permessage-deflate; server_no_context_takeover; '
+            'server_max_window_bits=10', threshold=10)
+        assert header == ('permessage-deflate; server_no_context_takeover; '
+                          'server_max_window_bits=10')
+        assert deflate.no_context_takeover is True
+        assert deflate.max_window_bits == 10
+        assert deflate.threshold == 10
+
+    def test_falls_back_to_acceptable_offer(self):
+        header, _ = negotiate_deflate(
+            'permessage-deflate; server_max_window_bits=8, '
+            'permessage-deflate; foo, permessage-deflate')
+        assert header == 'permessage-deflate'
+
+    def test_no_acceptable_offer(self):
+        assert negotiate_deflate('x-webkit-deflate-frame') is None
+        assert negotiate_deflate(
+            'permessage-deflate; server_max_window_bits=20') is None
+
+
+class TestPerMessageDeflate(unittest.TestCase):
+    message = json.dumps({'payload': [{'text': 'Hello world'}] * 20})
+
+    def test_compress_shares_context(self):
+        deflate = PerMessageDeflate()
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        first = deflate.compress(self.message)
+        second = deflate.compress(self.message)
+
+        assert _client_inflate(first, decompressor) == self.message
+        assert _client_inflate(second, decompressor) == self.message
+        assert len(second) < len(first)
+
+    def test_compress_without_context_takeover(self):
+        deflate = PerMessageDeflate(no_context_takeover=True)
+        deflate.compress(self.message)
+        assert _client_inflate(deflate.compress(self.message)) == self.message
+
+    def test_feed_decompresses_messages(self):
+        deflate = PerMessageDeflate()
+        data = _client_frame(OPCODE_TEXT, _client_deflate(self.message),
+                             rsv1=1)
+
+        frames = deflate.feed(data)
+
+        frame = _parse_frame(frames[0])
+        assert frame.rsv1 == 0
+        assert bytes(frame.unmask(frame.body)) == self.message
+
+    def test_feed_reassembles_fragments(self):
+        deflate = PerMessageDeflate()
+        compressed = _client_deflate(self.message)
+        ping = _client_frame(OPCODE_PING, b'ping')
+        data = (_client_frame(OPCODE_TEXT, compressed[:10], fin=0, rsv1=1) +
+                ping +
+                _client_frame(OPCODE_CONTINUATION, compressed[10:]))
+
+        frames = deflate.feed(data)
+
+        assert frames[0] == ping
+        frame = _parse_frame(frames[1])
+        assert frame.fin == 1
+        assert bytes(frame.unmask(frame.body)) == self.message
+
+    def test_feed_passes_on_uncompressed_frames(self):
+        deflate = PerMessageDeflate()
+        data = _client_frame(OPCODE_TEXT, b'hello')
+        assert deflate.feed(data) == [data]
+
+    def test_feed_waits_for_whole_frame(self):
+        deflate = PerMessageDeflate()
+        data = _client_frame(OPCODE_TEXT, b'hello')
+
+        assert deflate.feed(data[:3]) == []
+        assert deflate.wanted == len(data) - 3
+        assert deflate.feed(data[3:]) == [data]
+        assert deflate.wanted == 2
+
+    def test_feed_refuses_huge_messages(self):
+        deflate = PerMessageDeflate()
+        deflate.max_message_size = 10
+        data = _client_frame(OPCODE_TEXT, _client_deflate(self.message),
+                             rsv1=1)
+        with self.assertRaises(ValueError):
+            deflate.feed(data)
+
+
+class TestWebSocketDeflate(unittest.TestCase):
+    message = json.dumps({'filter': {'clauses': [{'value': 'x' * 100}]}})
+
+    def setUp(self):
+        self.s = WebSocket(MagicMock())
+        self.s.deflate = PerMessageDeflate(threshold=100)
+        self.s._write = MagicMock()
+        self.s.received_message = MagicMock()
+
+    def receive(self, data):
+        # Read from the "socket" as ws4py's WebSocket.once() would
+        while data:
+            size = self.s.reading_buffer_size
+            assert self.s.process(data[:size])
+            data = data[size:]
+
+    def test_receives_compressed_messages(self):
+        compressed = _client_deflate(self.message)
+        self.receive(_client_frame(OPCODE_TEXT, compressed, rsv1=1) +
+                     _client_frame(OPCODE_TEXT, b'plain') +
+                     _client_frame(OPCODE_TEXT, compressed[:5], fin=0,
+                                   rsv1=1) +
+                     _client_frame(OPCODE_CONTINUATION, compressed[5:]))
+
+        messages = [c[0][0] for c in self.s.received_message.call_args_list]
+        assert len(messages) == 3
+
+    def test_closes_on_invalid_compressed_message(self):
+        self.s.close = MagicMock()
+        data = _client_frame(OPCODE_TEXT, b'not deflated', rsv1=1)
+        assert not self.s.process(data)
+        self.s.close.assert_called_once_with(1007, ANY)
+
+    def test_sends_large_messages_compressed(self):
+        self.s.send(self.message)
+        data = self.s._write.call_args[0][0]
+        # ws4py won't parse a frame with RSV1 set, so check it by hand
+        assert ord(data[0]) == 0xc1  # FIN, RSV1, text
+        length = ord(data[1])
+        assert length < 126
+        assert _client_inflate(data[2:]) == self.message
+
+    def test_sends_small_messages_uncompressed(self):
+        self.s.send(b'hello')
+        frame = _parse_frame(self.s._write.call_args[0][0])
+        assert frame.rsv1 == 0
+        assert frame.body == b'hello'
+
+
+class TestWebSocketWSGIApplication(unittest.TestCase):
+    def setUp(self):
+        self.environ = {
+            'REQUEST_METHOD': 'GET',
+            'HTTP_UPGRADE': 'websocket',
+            'HTTP_CONNECTION': 'Upgrade',
+            'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+            'HTTP_SEC_WEBSOCKET_VERSION': '13',
+            'HTTP_SEC_WEBSOCKET_EXTENSIONS': 'permessage-deflate',
+            'ws4py.socket': MagicMock(),
+        }
+        self.start_response = MagicMock()
+
+    def headers(self):
+        return dict(self.start_response.call_args[0][1])
+
+    @patch.object(WebSocketWSGIApplication, 'make_websocket')
+    def test_negotiates_deflate(self, make_websocket):
+        app = WebSocketWSGIApplication(deflate=True, deflate_threshold=10)
+        app(self.environ, self.start_response)
+        headers = self.headers()
+        assert headers['Sec-WebSocket-Extensions'] == 'permessage-deflate'
+        environ = make_websocket.call_args[0][3]
+        assert environ['h.ws.deflate'].threshold == 10
+
+    @patch.object(WebSocketWSGIApplication, 'make_websocket')
+    def test_deflate_disabled(self, make_websocket):
+        app = WebSocketWSGIApplication()
+        app(self.environ, self.start_response)
+        assert 'Sec-WebSocket-Extensions' not in self.headers()
+        environ = make_websocket.call_args[0][3]
+        assert 'h.ws.deflate' not in environ
+
+
+def _uri_filter(uris, match_policy='include_any'):
+    return {
+        'match_policy': match_policy,
+        'actions': {'create': True, 'update': True, 'delete': True},
+        'clauses': [{'field': '/uri', 'operator': 'one_of', 'value': uris,
+                     'options': {}}],
+    }
+
+
+def _filtered_socket(filter_json):
+    sock = FakeSocket('giraffe')
+    sock.filter = FilterHandler(filter_json)
+    return sock
+
+
+class TestSubscriptionIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex()
+
+    def test_candidates_by_uri(self):
+        sock = _filtered_socket(_uri_filter(['http://Example.com/a']))
+        other = _filtered_socket(_uri_filter(['http://example.com/b']))
+        self.index.add(sock)
+        self.index.add(other)
+
+        result = self.index.candidates({'uri': 'http://example.com/A'})
+
+        assert result == set([sock])
+
+    def test_unindexable_filters_are_always_candidates(self):
+        filter_json = _uri_filter(['http://example.com'], 'exclude_any')
+        sock = _filtered_socket(filter_json)
+        self.index.add(sock)
+
+        assert self.index.candidates({'uri': 'http://foo.com'}) == set([sock])
+
+    def test_sockets_without_filters_are_never_candidates(self):
+        sock = FakeSocket('giraffe')
+        sock.filter = None
+        self.index.add(sock)
+
+        assert list(self.index) == [sock]
+        assert self.index.candidates({'uri': 'http://foo.com'}) == set()
+
+    def test_update_reindexes(self):
+        sock = _filtered_socket(_uri_filter(['http://example.com/a']))
+        self.index.add(sock)
+        sock.filter = FilterHandler(_uri_filter(['http://example.com/b']))
+
+        self.index.update(sock)
+
+        assert self.index.candidates({'uri': 'http://example.com/a'}) == set()
+        assert self.index.candidates({'uri': 'http://example.com/b'}) == \
+            set([sock])
+
+    def test_discard(self):
+        sock = _filtered_socket(_uri_filter(['http://example.com/a']))
+        self.index.add(sock)
+
+        self.index.discard(sock)
+
+        assert list(self.index) == []
+        assert self.index.candidates({'uri': 'http://example.com/a'}) == set()
+
+    def test_list_values_match_any_socket_indexed_on_the_field(self):
+        filter_json = {
+            'match_policy': 'include_all',
+            'actions': {},
+            'clauses': [
+                {'field': '/tags', 'operator': 'equals', 'value': 'foo'},
+            ],
+        }
+        sock = _filtered_socket(filter_json)
+        self.index.add(sock)
+
+        assert self.index.candidates({'tags': ['bar']}) == set([sock])
+
+    def test_candidates_agree_with_filter_matching(self):
+        uri = {'field': '/uri', 'operator': 'one_of',
+               'value': ['http://example.com/a', u'http://exämple.com/b']}
+        user = {'field': '/user', 'operator': 'equals',
+                'value': 'acct:Bob@example.com'}
+        tags = {'field': '/tags', 'operator': 'one_of', 'value': ['foo']}
+        text = {'field': '/text', 'operator': 'matches', 'value': 'hello'}
+        clause_sets = [[], [uri], [user], [tags], [text], [uri, user],
+                       [uri, text], [user, tags], [text, tags]]
+        policies = ['include_any', 'include_all', 'exclude_any',
+                    'exclude_all']
+        sockets = []
+        for clauses in clause_sets:
+            for policy in policies:
+                sock = _filtered_socket({'match_policy': policy,
+                                         'actions': {},
+                                         'clauses': clauses})
+                self.index.add(sock)
+                sockets.append(sock)
+        annotations = [
+            {},
+            {'uri': 'http://example.com/a'},
+            {'uri': 'http://EXAMPLE.com/a', 'user': 'acct:bob@example.com'},
+            {'uri': 'http://example.com/b', 'tags': ['foo', 'bar']},
+            {'uri': 'http://example.com/c', 'text': 'Why hello there'},
+            {'user': 'acct:bob@example.com', 'tags': 'foo'},
+            {'uri': ['http://example.com/a'], 'user': None},
+        ]
+
+        for annotation in annotations:
+            candidates = self.index.candidates(annotation)
+            for sock in sockets:
+                if sock.filter.match(annotation):
+                    assert sock in candidates
+
+
+class FakeAnnotation(dict):
+    def __init__(self, acl):
+        self.__acl__ = acl
+
+
+class TestReadACL(unittest.TestCase):
+    principal_sets = [
+        [Everyone],
+        [Everyone, Authenticated, 'acct:alice@example.com'],
+        [Everyone, Authenticated, 'acct:bob@example.com'],
+        [Everyone, Authenticated, 'acct:bob@example.com', 'group:admin'],
+    ]
+
+    acls = [
+        [],
+        [(Allow, Everyone, ALL_PERMISSIONS)],
+        [(Allow, 'acct:alice@example.com', 'read'),
+         (Allow, 'acct:alice@example.com', 'update')],
+        [(Allow, Authenticated, ['read', 'update'])],
+        [(Allow, 'acct:bob@example.com', 'delete')],
+        [(Deny, 'group:admin', 'read'), (Allow, Authenticated, 'read')],
+        [(Allow, 'acct:bob@example.com', 'read'), (Deny, Everyone, 'read')],
+    ]
+
+    def test_agrees_with_acl_authorization_policy(self):
+        policy = ACLAuthorizationPolicy()
+        for acl in self.acls:
+            annotation = FakeAnnotation(acl)
+            read_acl = ReadACL(annotation)
+            for principals in self.principal_sets:
+                expected = bool(policy.permits(annotation, principals, 'read'))
+                assert read_acl.permits(principals) is expected
+
+    def test_evaluates_acl_once(self):
+        acl = MagicMock(return_value=[(Allow, Everyone, 'read')])
+        read_acl = ReadACL(FakeAnnotation(acl))
+
+        for principals in self.principal_sets:
+            read_acl.permits(principals)
+
+        assert acl.call_count == 1
 
 
 class TestShouldSendEvent(unittest.TestCase):
@@ -361,3 +1455,52 @@ class TestShouldSendEvent(unittest.TestCase):
         sock = self.sock_giraffe
         assert should_send_event(sock, anno, data) is False
         assert sock.request.has_permission.called_with('read', anno)
+
+    def test_should_send_event_check_read_acl(self):
+        read_acl = MagicMock()
+        read_acl.permits.return_value = False
+        sock = self.sock_giraffe
+        sock.effective_principals = [Everyone]
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+        assert should_send_event(sock, {}, data, read_acl) is False
+        read_acl.permits.assert_called_once_with([Everyone])
+        assert not sock.request.has_permission.called
+
+    def test_should_send_event_matches_folded_annotation(self):
+        folded = FoldedAnnotation({})
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+        sock = self.sock_giraffe
+        assert should_send_event(sock, {}, data, None, folded)
+        sock.filter.match.assert_called_once_with(folded, 'update')
+
+    def test_should_send_event_read_acl_without_principals(self):
+        read_acl = MagicMock()
+        self.sock_giraffe.request.has_permission.return_value = False
+        data = {'action': 'update', 'src_client_id': 'pigeon'}
+        sock = self.sock_giraffe
+        assert should_send_event(sock, {}, data, read_acl) is False
+        assert not read_acl.permits.called
+
+
+class TestWebSocketEffectivePrincipals(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.s = WebSocket(MagicMock())
+        self.s.request = DummyRequest()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_none_without_authentication_policy(self):
+        assert self.s.effective_principals is None
+
+    def test_none_without_acl_authorization_policy(self):
+        self.config.testing_securitypolicy(userid='acct:bob@example.com')
+        assert self.s.effective_principals is None
+
+    def test_principals_of_request(self):
+        self.config.testing_securitypolicy(userid='acct:bob@example.com')
+        self.config.set_authorization_policy(ACLAuthorizationPolicy())
+        principals = self.s.effective_principals
+        assert principals == frozenset([Everyone, Authenticated,
+                                        'acct:bob@example.com'])
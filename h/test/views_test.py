@@ -239,6 +239,24 @@ class TestStreamAtomView(object):
         assert params["tags"] == "JavaScript"
         assert params["foo"] == "bar"
 
+    def test_it_only_requests_the_fields_the_feed_needs(self):
+        request = mock.MagicMock()
+        request.params = {}
+
+        views.stream_atom(request)
+
+        params = request.api_client.get.call_args[1]["params"]
+        assert params["fields"].split(",") == list(views.ATOM_FEED_FIELDS)
+
+    def test_it_forwards_user_supplied_fields(self):
+        request = mock.MagicMock()
+        request.params = {"fields": "text"}
+
+        views.stream_atom(request)
+
+        params = request.api_client.get.call_args[1]["params"]
+        assert params["fields"] == "text"
+
     def test_it_raises_httpserviceunavailable_for_connectionerror(self):
         request = mock.MagicMock()
         request.api_client.get.side_effect = api_client.ConnectionError
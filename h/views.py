@@ -19,6 +19,10 @@ log = logging.getLogger(__name__)
 
 _ = i18n.TranslationStringFactory(__package__)
 
+# The annotation fields used to render Atom feed entries.
+ATOM_FEED_FIELDS = ('user', 'created', 'updated', 'text', 'document.title',
+                    'target.source', 'target.selector.exact')
+
 
 @view_config(context=Exception, accept='text/html',
              renderer='h:templates/5xx.html')
@@ -166,6 +170,9 @@ def stream_atom(request):
     if params["limit"] > max_limit:
         params["limit"] = max_limit
 
+    # Only fetch the fields that the feed needs.
+    params.setdefault("fields", ",".join(ATOM_FEED_FIELDS))
+
     try:
         annotations = request.api_client.get(
             "/search", params=params)["rows"]
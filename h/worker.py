@@ -6,7 +6,13 @@ preconfigured with a dummy request. This request can be used to interrogate the
 routing table, fetch parts of the application, etc.
 
 Workers are registered under the setuptools entry point ``h.worker``.
+
+Workers are run with the standard library patched by gevent, as the web
+application is, so that they can do I/O concurrently in greenlets.
 """
+from gevent import monkey
+monkey.patch_all()
+
 import argparse
 import logging
 import os
@@ -77,6 +77,7 @@ DEV_EXTRAS = ['pyramid_debugtoolbar>=2.1', 'prospector[with_pyroma]', 'pep257',
 TESTING_EXTRAS = ['mock', 'pytest>=2.5', 'pytest-cov', 'factory-boy']
 CLAIM_EXTRAS = ['mandrill']
 YAML_EXTRAS = ['PyYAML']
+MSGPACK_EXTRAS = ['msgpack-python']
 
 setup(
     name='h',
@@ -108,6 +109,7 @@ setup(
         'testing': TESTING_EXTRAS,
         'claim': CLAIM_EXTRAS,
         'YAML': YAML_EXTRAS,
+        'msgpack': MSGPACK_EXTRAS,
     },
     tests_require=DEV_EXTRAS + TESTING_EXTRAS,
     setup_requires=['setuptools_git'],
@@ -145,6 +147,7 @@ setup(
         ],
         'h.worker': [
             'notification=h.notification.worker:run',
+            'streamer-relay=h.streamer:relay',
         ]
     },
 )